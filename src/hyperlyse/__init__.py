@@ -1,7 +1,32 @@
+import importlib
 from hyperlyse.config import Config
+from hyperlyse.profiling import Profiler, profiler
+from hyperlyse.envi import EnviWriter, EnviReader, save_envi
+from hyperlyse.products import ProductWriter, ProductFile, Product
+from hyperlyse.container import ContainerWriter, ContainerFile
 from hyperlyse.cube import Cube
-from hyperlyse.customwidgets import PlotCanvas, SaveSpectrumDialog
-from hyperlyse.qrangeslider import QRangeSlider
-from hyperlyse.database import Database, Metadata, Spectrum
-from hyperlyse.analysis import principal_component_analysis
-from hyperlyse.mainwindow import MainWindow
\ No newline at end of file
+from hyperlyse.sharedcube import SharedCube, CubeDescriptor, attach_cube, detach_cube
+from hyperlyse.preprocessing import Preprocessing
+from hyperlyse.resampling import resampling_matrix, resample, project_cube
+from hyperlyse.database import Database, Metadata, Spectrum, SpectrumStore
+from hyperlyse.sampling import PixelSampler
+from hyperlyse.analysis import principal_component_analysis, PCAModel, linear_unmixing, kmeans_clustering, grow_region
+from hyperlyse.roi import polygon_mask, load_label_map, region_statistics, save_region_statistics
+from hyperlyse import rendering
+from hyperlyse import batch
+from hyperlyse.bandmath import Expression, BandMath
+from hyperlyse.tileserver import TileRenderer, TileServer
+
+# the GUI needs PyQt6: its classes are imported on first use, such that everything else (e.g. the tile server) can be
+# used without Qt
+_GUI_CLASSES = {'PlotCanvas': 'customwidgets', 'SaveSpectrumDialog': 'customwidgets',
+                'ExportCubeDialog': 'customwidgets', 'BatchExtractDialog': 'customwidgets',
+                'PreprocessingDialog': 'customwidgets', 'SelectSpectraDialog': 'customwidgets',
+                'Throttle': 'customwidgets', 'QRangeSlider': 'qrangeslider', 'MainWindow': 'mainwindow'}
+
+
+def __getattr__(name):
+    if name in _GUI_CLASSES:
+        module = importlib.import_module(f'hyperlyse.{_GUI_CLASSES[name]}')
+        return getattr(module, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,37 +1,424 @@
+import os
+import json
+import weakref
+import collections
 import numpy as np
-from sklearn import decomposition
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse
+from sklearn import decomposition, cluster
+from hyperlyse.sampling import PixelSampler
+from hyperlyse.profiling import profiler
+from hyperlyse.database import Database
 
-def principal_component_analysis(cube_data, p_keep=1.0, n_components=0):
+@profiler.timed('principal_component_analysis')
+def principal_component_analysis(cube_data, p_keep=1.0, n_components=0, seed=0):
     """
     Do PCA
     :param cube_data: the original spectral cube
     :param p_keep: compute pca on random sample of p_keep of data
     :param n_components: number of principal components that should be returned
+    :param seed: seed for the random sample
     :return: stack of principal components
     """
+    pca_model = PCAModel.fit(cube_data, p_keep=p_keep, n_components=n_components, seed=seed)
+    return pca_model.transform(cube_data)
 
+
+class PCAModel:
+    """
+    A fitted (whitened) PCA of a band range of a cube. Principal components are projected lazily, one at a time.
+    """
+    def __init__(self, mean, components, explained_variance, band_min=0, band_max=None, seed=None):
+        """
+        :param mean: b np.array, mean spectrum of the fitted data
+        :param components: n*b np.array, principal axes
+        :param explained_variance: n np.array, variance explained by each component
+        :param band_min: first band of the cube used for fitting
+        :param band_max: end (exclusive) of the band range used for fitting; None -> all bands
+        :param seed: seed of the random sample used for fitting
+        """
+        self.mean = np.asarray(mean)
+        self.components = np.asarray(components)
+        self.explained_variance = np.asarray(explained_variance)
+        self.band_min = band_min
+        self.band_max = band_max
+        self.seed = seed
+        self.__projections = {}
+        self.__projected = None     # weak reference to the cube the cached projections belong to
+
+    @staticmethod
+    @profiler.timed('PCAModel.fit')
+    def fit(cube_data, band_min=0, band_max=None, p_keep=1.0, n_components=0, seed=0, sampler=None):
+        """
+        Fit a PCA on (a random sample of) the pixels of a cube
+        :param cube_data: the original spectral cube
+        :param band_min: first band used for fitting
+        :param band_max: end (exclusive) of the band range used for fitting; None -> all bands
+        :param p_keep: fit on random sample of p_keep of data
+        :param n_components: number of principal components; <1 means one per band. At most the number of bands
+                             and of pixels.
+        :param seed: seed for the random sample
+        :param sampler: PixelSampler used to draw the sample; default: PixelSampler(seed=seed)
+        :return: PCAModel
+        """
+        cube_rows, cube_cols, _ = cube_data.shape
+        n_bands = len(range(cube_data.shape[2])[band_min:band_max])
+
+        # if n_components undefined, use number of input features
+        if n_components < 1:
+            n_components = n_bands
+
+        # extract the data that should actually be used for the fitting
+        n_samples = cube_rows * cube_cols
+        # no more components than the data has dimensions (narrow band ranges, small cubes)
+        n_components = min(n_components, n_bands, n_samples)
+        if p_keep < 1.0:
+            if sampler is None:
+                sampler = PixelSampler(seed=seed)
+            seed = sampler.seed
+            fitting_data = sampler.sample(cube_data,
+                                          n_samples=max(int(n_samples * p_keep), n_components),
+                                          bands=slice(band_min, band_max))
+        else:
+            fitting_data = np.reshape(cube_data[:, :, band_min:band_max], (n_samples, n_bands))
+
+        # do the fitting
+        pca = decomposition.PCA(n_components=n_components, svd_solver='auto', whiten=True)
+        pca.fit(fitting_data)
+
+        return PCAModel(pca.mean_, pca.components_, pca.explained_variance_,
+                        band_min=band_min, band_max=band_max, seed=seed)
+
+    @property
+    def n_components(self):
+        return self.components.shape[0]
+
+    def key(self):
+        return PCAModel.make_key(self.band_min, self.band_max, self.seed)
+
+    @staticmethod
+    def make_key(band_min, band_max, seed):
+        return band_min, band_max, seed
+
+    @profiler.timed('PCAModel.project')
+    def project(self, cube_data, component):
+        """
+        Get a single (whitened) principal component of a cube. Results are cached per component for the last cube
+        (array object) passed; another cube replaces the cache.
+        :param cube_data: the original spectral cube (all bands)
+        :param component: index of the principal component
+        :return: r*c np.array
+        """
+        if self.__projected is None or self.__projected() is not cube_data:
+            self.__projections = {}
+            self.__projected = weakref.ref(cube_data)
+        if component not in self.__projections:
+            self.__projections[component] = self.project_pixels(cube_data, component)
+        return self.__projections[component]
+
+    def clear_projections(self):
+        """
+        Free the cached projections (each one has the size of a band image)
+        """
+        self.__projections = {}
+        self.__projected = None
+
+    def project_pixels(self, pixels, component):
+        """
+        Like project, but not cached; for parts of a cube (tiles, samples)
+        :param pixels: ...*b np.array of spectra (all bands)
+        :param component: index of the principal component
+        :return: np.array of the shape of pixels, without the last axis
+        """
+        axis = self.components[component]
+        scale = np.sqrt(self.explained_variance[component])
+        # (x - mean) @ axis == x @ axis - mean @ axis; one matrix-vector product, no centered copy of the cube
+        projection = np.matmul(pixels[..., self.band_min:self.band_max], axis.astype(pixels.dtype))
+        return (projection - self.mean @ axis) / scale
+
+    def transform_pixels(self, pixels, n_components=None, whiten=True):
+        """
+        The first principal components of many spectra at once; not cached
+        :param pixels: ...*b np.array of spectra (all bands)
+        :param n_components: number of components, default all
+        :param whiten: scale each component to unit variance (as project); if False, the plain coordinates along the
+                       principal axes
+        :return: ...*n np.array
+        """
+        axes = self.components[:n_components]
+        projection = np.matmul(pixels[..., self.band_min:self.band_max], axes.T.astype(pixels.dtype))
+        projection = projection - self.mean @ axes.T
+        if whiten:
+            projection /= np.sqrt(self.explained_variance[:n_components])
+        return projection
+
+    def transform(self, cube_data):
+        """
+        :param cube_data: the original spectral cube (all bands)
+        :return: r*c*n stack of all principal components
+        """
+        return np.dstack([self.project(cube_data, c) for c in range(self.n_components)])
+
+    @staticmethod
+    def save_models(file, models, signature=''):
+        """
+        Save fitted models to a single .npz file
+        :param file: target file
+        :param models: iterable of PCAModel
+        :param signature: identifies the data the models were fitted on; checked on loading
+        """
+        arrays = {}
+        meta = {'signature': signature, 'models': []}
+        for i, model in enumerate(models):
+            arrays[f'mean_{i}'] = model.mean
+            arrays[f'components_{i}'] = model.components
+            arrays[f'explained_variance_{i}'] = model.explained_variance
+            meta['models'].append({'band_min': model.band_min, 'band_max': model.band_max, 'seed': model.seed})
+        if os.path.dirname(file) and not os.path.isdir(os.path.dirname(file)):
+            os.makedirs(os.path.dirname(file))
+        np.savez(file, meta=json.dumps(meta), **arrays)
+
+    @staticmethod
+    def load_models(file, signature=''):
+        """
+        Load models saved with save_models
+        :param file: .npz file
+        :param signature: expected signature of the data; models fitted on other data are discarded
+        :return: dict, key -> PCAModel
+        """
+        models = {}
+        if os.path.isfile(file):
+            with np.load(file) as data:
+                meta = json.loads(str(data['meta']))
+                if meta['signature'] == signature:
+                    for i, m in enumerate(meta['models']):
+                        model = PCAModel(data[f'mean_{i}'],
+                                         data[f'components_{i}'],
+                                         data[f'explained_variance_{i}'],
+                                         band_min=m['band_min'],
+                                         band_max=m['band_max'],
+                                         seed=m['seed'])
+                        models[model.key()] = model
+        return models
+
+
+@profiler.timed('linear_unmixing')
+def linear_unmixing(cube_data, endmembers, sum_to_one=False, chunk_rows=32, n_jobs=0, max_iter=500, tol=1e-5):
+    """
+    Per-pixel linear unmixing with non-negative (or fully constrained) abundances
+    :param cube_data: the original spectral cube, r*c*b
+    :param endmembers: N*b np.array, endmember spectra, sampled at the bands of the cube
+    :param sum_to_one: additionally constrain abundances to sum up to 1 (fully constrained least squares)
+    :param chunk_rows: number of cube rows solved in one batch
+    :param n_jobs: number of worker threads; <1 means one per cpu
+    :param max_iter: maximum number of (accelerated projected gradient) iterations per batch
+    :param tol: stop iterating a batch when no abundance changes by more than tol
+    :return: (abundances, residuals) - r*c*N stack of abundance maps and r*c map of RMS reconstruction errors
+    """
     cube_rows, cube_cols, cube_bands = cube_data.shape
+    endmembers = np.atleast_2d(np.asarray(endmembers, dtype=np.float64))
+    n_endmembers = endmembers.shape[0]
+    if endmembers.shape[1] != cube_bands:
+        raise ValueError(f'endmembers have {endmembers.shape[1]} bands, cube has {cube_bands}')
+    if n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+
+    abundances = np.zeros((cube_rows, cube_cols, n_endmembers), dtype=np.float32)
+    residuals = np.zeros((cube_rows, cube_cols), dtype=np.float32)
+
+    # everything the solver needs from the endmembers is precomputed once for all batches
+    gram = endmembers @ endmembers.T
+    lipschitz = max(np.linalg.eigvalsh(gram)[-1], np.finfo(np.float64).tiny)
+    pinv = np.linalg.pinv(endmembers.T)
+    project = _project_simplex if sum_to_one else _project_nonnegative
 
-    # if n_components undefined, use number of input features
-    if n_components < 1:
-        n_components = cube_bands
+    def solve_rows(row_start):
+        row_end = min(row_start + chunk_rows, cube_rows)
+        y = np.reshape(cube_data[row_start:row_end], (-1, cube_bands)).T.astype(np.float64)
+        b = endmembers @ y
+        # start from the projected unconstrained solution, then refine with FISTA
+        x = project(pinv @ y)
+        z = x
+        t = 1.0
+        for _ in range(max_iter):
+            x_new = project(z - (gram @ z - b) / lipschitz)
+            t_new = (1 + np.sqrt(1 + 4 * t * t)) / 2
+            z = x_new + ((t - 1) / t_new) * (x_new - x)
+            converged = np.max(np.abs(x_new - x), initial=0) < tol
+            x = x_new
+            t = t_new
+            if converged:
+                break
+        abundances[row_start:row_end] = np.reshape(x.T, (row_end - row_start, cube_cols, n_endmembers))
+        residual = np.sqrt(np.mean((y - endmembers.T @ x) ** 2, axis=0))
+        residuals[row_start:row_end] = np.reshape(residual, (row_end - row_start, cube_cols))
 
-    source_data = np.reshape(cube_data, (cube_data.shape[0] * cube_data.shape[1], cube_data.shape[2]))
-    n_samples, n_features = source_data.shape
+    row_starts = range(0, cube_rows, chunk_rows)
+    if n_jobs == 1:
+        for row_start in row_starts:
+            solve_rows(row_start)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(solve_rows, row_starts))
+
+    return abundances, residuals
+
+
+@profiler.timed('kmeans_clustering')
+def kmeans_clustering(cube_data, n_clusters=8, feature_bands=None, n_components=0, p_keep=0.01,
+                      chunk_rows=64, n_jobs=0, seed=0, sampler=None, pca_model=None):
+    """
+    Unsupervised segmentation of the cube with mini-batch k-means. The clustering is fitted on a random sample of
+    pixels; labels for the whole cube are then assigned in chunks of rows.
+    :param cube_data: the original spectral cube, r*c*b
+    :param n_clusters: number of clusters
+    :param feature_bands: slice or index array of the bands used for clustering (default: all)
+    :param n_components: if > 0, cluster the first n_components principal components instead of the spectra (of the
+                         band range feature_bands, which has to be a slice)
+    :param p_keep: fit on a random sample of p_keep of the pixels
+    :param chunk_rows: number of cube rows labelled in one batch
+    :param n_jobs: number of worker threads; <1 means one per cpu
+    :param seed: seed for sampling and clustering
+    :param sampler: PixelSampler used to draw the sample; default: PixelSampler(seed=seed)
+    :param pca_model: PCAModel used if n_components > 0, e.g. the one already fitted for the PCA view (its band range
+                      replaces feature_bands); default: PCAModel.fit on the same sample settings
+    :return: (labels, means) - r*c label map and n_clusters*b mean spectra (over all bands) of the clusters
+    """
+    cube_rows, cube_cols, cube_bands = cube_data.shape
+    if feature_bands is None:
+        feature_bands = slice(None)
+    if n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
 
     # extract the data that should actually be used for the fitting
-    fitting_data = source_data
-    if p_keep < 1.0:
-        idx = np.arange(n_samples)
-        np.random.shuffle(idx)
-        idx = idx[:int(n_samples * p_keep)]
-        fitting_data = fitting_data[idx, :]
+    n_pixels = cube_rows * cube_cols
+    n_fit = min(n_pixels, max(int(n_pixels * p_keep), 100 * n_clusters))
+    if sampler is None:
+        sampler = PixelSampler(seed=seed)
+    fitting_data = sampler.sample(cube_data, n_samples=n_fit)
 
     # do the fitting
-    pca = decomposition.PCA(n_components=n_components, svd_solver='auto', whiten=True)
-    pca.fit(fitting_data)
+    if n_components > 0:
+        if pca_model is None:
+            if not isinstance(feature_bands, slice) or feature_bands.step not in (None, 1):
+                raise ValueError('clustering principal components requires a contiguous range of feature bands')
+            pca_model = PCAModel.fit(cube_data, band_min=feature_bands.start or 0, band_max=feature_bands.stop,
+                                     p_keep=p_keep, n_components=n_components, seed=sampler.seed, sampler=sampler)
+        n_components = min(n_components, pca_model.n_components)
+
+        def features_of(pixels):
+            # coordinates along the principal axes, not whitened: components keep their share of the variance
+            return pca_model.transform_pixels(pixels, n_components, whiten=False)
+    else:
+        def features_of(pixels):
+            return pixels[:, feature_bands]
+    kmeans = cluster.MiniBatchKMeans(n_clusters=n_clusters, n_init=3, random_state=seed)
+    kmeans.fit(features_of(fitting_data))
+
+    # assign labels and accumulate the per-cluster sums for the mean spectra, chunk by chunk
+    labels = np.zeros((cube_rows, cube_cols), dtype=np.int32)
+
+    def assign_rows(row_start):
+        row_end = min(row_start + chunk_rows, cube_rows)
+        chunk = np.reshape(cube_data[row_start:row_end], (-1, cube_bands))
+        chunk_labels = kmeans.predict(features_of(chunk))
+        labels[row_start:row_end] = np.reshape(chunk_labels, (row_end - row_start, cube_cols))
+        n = chunk_labels.size
+        membership = sparse.csr_matrix((np.ones(n), (chunk_labels, np.arange(n))), shape=(n_clusters, n))
+        return membership @ chunk, np.bincount(chunk_labels, minlength=n_clusters)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        partial_results = list(executor.map(assign_rows, range(0, cube_rows, chunk_rows)))
+
+    sums = np.sum([r[0] for r in partial_results], axis=0)
+    counts = np.sum([r[1] for r in partial_results], axis=0)
+    means = sums / np.maximum(counts, 1)[:, np.newaxis]
+
+    return labels, means
 
-    result_data = pca.transform(source_data)
-    result_data = np.reshape(result_data, (cube_rows, cube_cols, n_components))
 
-    return result_data
+@profiler.timed('grow_region')
+def grow_region(cube, seed, threshold, custom_range=None, use_gradient=False, squared_errs=True, metric='error',
+                connectivity=4, max_pixels=0, preprocessing=None):
+    """
+    Region growing ("select similar"): starting at the seed pixel, the region grows over spatially connected pixels
+    whose distance (see Database.compare_spectra) to the spectrum of the seed is at most threshold.
+    Distances are evaluated lazily: a queue holds the fronts of newly added pixels, and only their unvisited
+    neighbours are read and compared (in one batch per front), so the cost depends on the size of the region, not on
+    the size of the cube.
+    :param cube: hyper.Cube, loaded or opened lazily
+    :param seed: (row, col) of the start pixel
+    :param threshold: maximum distance of a pixel in the region
+    :param custom_range, use_gradient, squared_errs, metric, preprocessing: see Database.compare_spectra
+    :param connectivity: 4 (edges) or 8 (edges and corners)
+    :param max_pixels: stop growing at this number of pixels; <1 means no limit
+    :return: (mask, mean) - r*c boolean np.array of the region, and its mean spectrum
+    """
+    if connectivity not in [4, 8]:
+        raise ValueError(f'connectivity must be 4 or 8, not {connectivity}')
+    offsets = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+    if connectivity == 8:
+        offsets += [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+    d_rows = np.array([o[0] for o in offsets])
+    d_cols = np.array([o[1] for o in offsets])
+    bands = np.asarray(cube.bands)
+    row, col = seed
+    reference = np.asarray(cube.pixel_spectrum(row, col))
+
+    visited = np.zeros((cube.nrows, cube.ncols), dtype=bool)
+    mask = np.zeros((cube.nrows, cube.ncols), dtype=bool)
+    visited[row, col] = mask[row, col] = True
+    n_pixels = 1
+    sums = reference.astype(np.float64)
+    fronts = collections.deque([(np.array([row]), np.array([col]))])
+    while fronts and (max_pixels < 1 or n_pixels < max_pixels):
+        rows, cols = fronts.popleft()
+        # unvisited neighbours of the front, each one once
+        rows = (rows[:, np.newaxis] + d_rows).ravel()
+        cols = (cols[:, np.newaxis] + d_cols).ravel()
+        inside = (rows >= 0) & (rows < cube.nrows) & (cols >= 0) & (cols < cube.ncols)
+        idx = np.unique(rows[inside] * cube.ncols + cols[inside])
+        rows, cols = np.divmod(idx, cube.ncols)
+        new = ~visited[rows, cols]
+        rows, cols = rows[new], cols[new]
+        if rows.size == 0:
+            continue
+        visited[rows, cols] = True
+
+        spectra = cube.pixels(rows, cols)
+        distances = Database.compare_spectra(bands, spectra, bands, reference,
+                                             custom_range=custom_range,
+                                             use_gradient=use_gradient,
+                                             squared_errs=squared_errs,
+                                             metric=metric,
+                                             preprocessing=preprocessing)
+        if distances is None:
+            raise ValueError('the wavelength range is too small for comparing spectra')
+        accepted = np.flatnonzero(distances <= threshold)
+        if max_pixels > 0:
+            accepted = accepted[:max_pixels - n_pixels]
+        if accepted.size:
+            mask[rows[accepted], cols[accepted]] = True
+            n_pixels += accepted.size
+            sums += spectra[accepted].sum(axis=0, dtype=np.float64)
+            fronts.append((rows[accepted], cols[accepted]))
+
+    return mask, (sums / n_pixels).astype(np.float32)
+
+
+def _project_nonnegative(v):
+    return np.maximum(v, 0)
+
+
+def _project_simplex(v):
+    """
+    Euclidean projection of each column of v onto the probability simplex (Duchi et al. 2008)
+    """
+    n = v.shape[0]
+    u = -np.sort(-v, axis=0)
+    css = np.cumsum(u, axis=0) - 1
+    k = np.arange(1, n + 1)[:, np.newaxis]
+    # index of the last component that stays positive after the shift
+    rho = n - 1 - np.argmax((u - css / k > 0)[::-1], axis=0)
+    theta = css[rho, np.arange(v.shape[1])] / (rho + 1)
+    return np.maximum(v - theta, 0)
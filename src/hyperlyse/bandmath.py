@@ -0,0 +1,219 @@
+import ast
+import operator
+import collections
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from hyperlyse.profiling import profiler
+
+
+class Expression:
+    """
+    A band-math formula over wavelengths, parsed once into an expression tree, e.g.
+        R(700) / R(550)                       ratio of the bands closest to 700nm and 550nm
+        (R(800) - R(670)) / (R(800) + R(670)) normalized difference
+        R(540, 560)                           mean of the bands from 540nm to 560nm
+        depth(650, 680, 720)                  band depth at 680nm, relative to the straight continuum from 650 to 720nm
+    Operators: + - * / ** and parentheses; functions: sqrt, log, exp, abs, min(a, b), max(a, b).
+    """
+
+    BINARY = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+              ast.Pow: operator.pow}
+    UNARY = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+    FUNCTIONS = {'sqrt': (np.sqrt, 1), 'log': (np.log, 1), 'exp': (np.exp, 1), 'abs': (np.abs, 1),
+                 'min': (np.minimum, 2), 'max': (np.maximum, 2)}
+
+    def __init__(self, text):
+        """
+        :param text: the formula; raises ValueError if it is invalid
+        """
+        self.text = text.strip()
+        try:
+            tree = ast.parse(self.text, mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f'invalid expression: {e.msg}')
+        # nodes: ('const', value), ('bands', x_min, x_max), ('unary', op, a), ('binary', op, a, b), ('call', f, args)
+        self.root = self.__compile(tree.body)
+
+    def key(self):
+        """
+        :return: canonical form of the formula (independent of blanks and redundant parentheses)
+        """
+        return repr(self.root)
+
+    def __str__(self):
+        return self.text
+
+    def wavelength_ranges(self):
+        """
+        :return: list of the (x_min, x_max) ranges the formula reads
+        """
+        ranges = []
+
+        def collect(node):
+            if node[0] == 'bands':
+                ranges.append(node[1:])
+            elif node[0] in ('unary', 'binary'):
+                for child in node[2:]:
+                    collect(child)
+            elif node[0] == 'call':
+                for child in node[2]:
+                    collect(child)
+        collect(self.root)
+        return ranges
+
+    def __compile(self, node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and \
+                not isinstance(node.value, bool):
+            return 'const', float(node.value)
+        if isinstance(node, ast.BinOp) and type(node.op) in Expression.BINARY:
+            return 'binary', Expression.BINARY[type(node.op)], self.__compile(node.left), self.__compile(node.right)
+        if isinstance(node, ast.UnaryOp) and type(node.op) in Expression.UNARY:
+            return 'unary', Expression.UNARY[type(node.op)], self.__compile(node.operand)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            name = node.func.id
+            if name == 'R':
+                x = [self.__wavelength(a) for a in node.args]
+                if len(x) not in (1, 2):
+                    raise ValueError('R takes a wavelength, or the first and last wavelength of a range')
+                return 'bands', min(x), max(x)
+            if name == 'depth':
+                if len(node.args) != 3:
+                    raise ValueError('depth takes three wavelengths: left shoulder, center, right shoulder')
+                left, center, right = [self.__wavelength(a) for a in node.args]
+                if not left < center < right:
+                    raise ValueError('depth: the center has to be between the shoulders')
+                # 1 - R(center) / continuum(center), continuum linear between the shoulders
+                w = (center - left) / (right - left)
+                continuum = ('binary', operator.add,
+                             ('binary', operator.mul, ('const', 1 - w), ('bands', left, left)),
+                             ('binary', operator.mul, ('const', w), ('bands', right, right)))
+                return ('binary', operator.sub, ('const', 1.0),
+                        ('binary', operator.truediv, ('bands', center, center), continuum))
+            if name in Expression.FUNCTIONS:
+                function, n_args = Expression.FUNCTIONS[name]
+                if len(node.args) != n_args:
+                    raise ValueError(f'{name} takes {n_args} argument(s)')
+                return 'call', function, tuple(self.__compile(a) for a in node.args)
+            raise ValueError(f'unknown function: {name}')
+        raise ValueError(f'unsupported element: {ast.unparse(node)}')
+
+    @staticmethod
+    def __wavelength(node):
+        if not isinstance(node, ast.Constant) or not isinstance(node.value, (int, float)) or \
+                isinstance(node.value, bool):
+            raise ValueError(f'wavelengths have to be numbers, not {ast.unparse(node)}')
+        return float(node.value)
+
+
+class BandMath:
+    """
+    Evaluates band-math expressions on a cube. Each expression is evaluated in one pass over blocks of rows (on
+    multiple threads): only the bands the expression refers to are read, and all intermediate results have the size
+    of a block, never of the cube. Results are cached per expression.
+    """
+    def __init__(self, cube, chunk_rows=64, n_jobs=0, cache_size=8):
+        """
+        :param cube: hyper.Cube, loaded or opened lazily
+        :param chunk_rows: number of rows evaluated at once
+        :param n_jobs: number of worker threads; <1 means one per cpu
+        :param cache_size: number of results kept
+        """
+        self.cube = cube
+        self.chunk_rows = chunk_rows
+        self.n_jobs = n_jobs
+        self.cache_size = cache_size
+        self.__expressions = {}                         # text -> Expression
+        self.__results = collections.OrderedDict()      # Expression.key() -> image
+        self.__lock = threading.Lock()
+
+    def parse(self, text):
+        """
+        :return: Expression; each text is parsed once
+        """
+        if text not in self.__expressions:
+            self.__expressions[text] = Expression(text)
+        return self.__expressions[text]
+
+    def layers(self, expression):
+        """
+        :param expression: Expression or text
+        :return: {(x_min, x_max): list of layers}, the bands of the cube each range of the expression refers to
+        """
+        expression = self.parse(expression) if isinstance(expression, str) else expression
+        bands = np.asarray(self.cube.bands)
+        spacing = np.median(np.diff(bands)) if bands.size > 1 else 0
+        result = {}
+        for x_min, x_max in expression.wavelength_ranges():
+            if x_max < bands[0] - spacing or x_min > bands[-1] + spacing:
+                raise ValueError(f'{x_min:g}nm is outside of the wavelength range of the cube '
+                                 f'({bands[0]:g}-{bands[-1]:g}nm)')
+            layers = np.flatnonzero((bands >= x_min) & (bands <= x_max)).tolist()
+            if not layers:
+                # single wavelength (or a range between two bands): the closest band
+                layers = [self.cube.lambda2layer((x_min + x_max) / 2)]
+            result[(x_min, x_max)] = layers
+        return result
+
+    @profiler.timed('BandMath.evaluate')
+    def evaluate(self, expression):
+        """
+        :param expression: Expression or text
+        :return: r*c float32 np.array, read-only (it is cached); nan where the result is undefined (e.g. division by
+                 zero)
+        """
+        expression = self.parse(expression) if isinstance(expression, str) else expression
+        key = expression.key()
+        with self.__lock:
+            if key in self.__results:
+                self.__results.move_to_end(key)
+                return self.__results[key]
+
+        ranges = self.layers(expression)
+        needed = sorted({layer for layers in ranges.values() for layer in layers})
+        position = {layer: i for i, layer in enumerate(needed)}
+        # range -> positions of its bands in a block
+        ranges = {r: [position[layer] for layer in layers] for r, layers in ranges.items()}
+        if self.cube.data is None:
+            # lazily opened: the needed bands are read once, as whole band images
+            data = np.dstack([self.cube.band_image(layer) for layer in needed])
+            needed = slice(None)
+        else:
+            data = self.cube.data
+        result = np.empty((self.cube.nrows, self.cube.ncols), dtype=np.float32)
+
+        def evaluate_rows(row_start):
+            block = data[row_start:row_start + self.chunk_rows][:, :, needed]
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                values = BandMath.__evaluate_node(expression.root, block, ranges)
+            result[row_start:row_start + self.chunk_rows] = values
+            block_result = result[row_start:row_start + self.chunk_rows]
+            block_result[~np.isfinite(block_result)] = np.nan
+
+        with ThreadPoolExecutor(max_workers=self.n_jobs if self.n_jobs > 0 else None) as executor:
+            list(executor.map(evaluate_rows, range(0, self.cube.nrows, self.chunk_rows)))
+
+        # cached results are shared by all callers, nobody may change them
+        result.flags.writeable = False
+        with self.__lock:
+            self.__results[key] = result
+            while len(self.__results) > self.cache_size:
+                self.__results.popitem(last=False)
+        return result
+
+    @staticmethod
+    def __evaluate_node(node, block, ranges):
+        kind = node[0]
+        if kind == 'const':
+            return np.float32(node[1])
+        if kind == 'bands':
+            positions = ranges[node[1:]]
+            if len(positions) == 1:
+                return block[:, :, positions[0]]
+            return block[:, :, positions].mean(axis=-1, dtype=np.float32)
+        if kind == 'unary':
+            return node[1](BandMath.__evaluate_node(node[2], block, ranges))
+        if kind == 'binary':
+            return node[1](BandMath.__evaluate_node(node[2], block, ranges),
+                           BandMath.__evaluate_node(node[3], block, ranges))
+        return node[1](*[BandMath.__evaluate_node(a, block, ranges) for a in node[2]])
@@ -0,0 +1,121 @@
+import csv
+import numpy as np
+from scipy import sparse
+from hyperlyse.profiling import profiler
+
+
+def grid_regions(nrows, ncols, step, size=1, rect=None):
+    """
+    Regular grid of square regions, e.g. the patches of a sample panel
+    :param nrows: number of rows of the image
+    :param ncols: number of columns of the image
+    :param step: distance of the grid points (pixels)
+    :param size: edge length of each region (1: single pixels); regions are centered on the grid points
+    :param rect: optional (x, y, w, h): the grid only covers this rectangle
+    :return: n*4 int np.array of regions (x, y, w, h), row by row
+    """
+    x0, y0, w, h = rect if rect is not None else (0, 0, ncols, nrows)
+    step = max(int(step), 1)
+    size = max(int(size), 1)
+    # grid points in the middle of the rectangle
+    xs = np.arange(x0 + (w - 1) % step // 2, x0 + w, step)
+    ys = np.arange(y0 + (h - 1) % step // 2, y0 + h, step)
+    gx, gy = np.meshgrid(xs, ys)
+    regions = np.column_stack([gx.ravel() - size // 2, gy.ravel() - size // 2,
+                               np.full(gx.size, size), np.full(gx.size, size)])
+    return clip_regions(regions, nrows, ncols)
+
+
+def clip_regions(regions, nrows, ncols):
+    """
+    Clip regions (x, y, w, h) to the image; regions that are completely outside get w = h = 0
+    :return: n*4 int np.array
+    """
+    regions = np.asarray(regions, dtype=np.int64).reshape(-1, 4)
+    x0 = np.clip(regions[:, 0], 0, ncols)
+    y0 = np.clip(regions[:, 1], 0, nrows)
+    x1 = np.clip(regions[:, 0] + regions[:, 2], 0, ncols)
+    y1 = np.clip(regions[:, 1] + regions[:, 3], 0, nrows)
+    return np.column_stack([x0, y0, np.maximum(x1 - x0, 0), np.maximum(y1 - y0, 0)])
+
+
+def read_regions_csv(file):
+    """
+    Read points or rectangles from a CSV file: one per line, "x,y" (a single pixel), "x,y,w,h" (a rectangle),
+    each optionally followed by a name. A header line and empty lines are skipped.
+    :param file: CSV file (comma, semicolon or tab separated)
+    :return: n*4 int np.array of regions (x, y, w, h), and the n names ('' if not given)
+    """
+    regions = []
+    names = []
+    with open(file, newline='') as f:
+        content = f.read()
+    lines = content.splitlines()
+    # the separator is the one that occurs most in the first line
+    delimiter = max(',;\t', key=lines[0].count) if lines else ','
+    for line_number, row in enumerate(csv.reader(lines, delimiter=delimiter), 1):
+        row = [v.strip() for v in row]
+        if not row or not any(row):
+            continue
+        numbers = []
+        for v in row[:4]:
+            try:
+                numbers.append(int(round(float(v))))
+            except ValueError:
+                break
+        if len(numbers) not in (2, 4):
+            if line_number == 1 and not numbers:
+                continue    # header
+            raise ValueError(f'{file}, line {line_number}: expected x,y[,w,h][,name]')
+        names.append(row[len(numbers)] if len(row) > len(numbers) else '')
+        regions.append(numbers if len(numbers) == 4 else numbers + [1, 1])
+    return np.array(regions, dtype=np.int64).reshape(-1, 4), names
+
+
+@profiler.timed('region_means')
+def region_means(cube, regions):
+    """
+    Mean spectra of many regions, read from the cube in one vectorized gather
+    :param cube: hyper.Cube, loaded or opened lazily
+    :param regions: n*4 np.array of regions (x, y, w, h), within the image
+    :return: n*b float32 np.array of mean spectra (0 for empty regions)
+    """
+    regions = np.asarray(regions, dtype=np.int64).reshape(-1, 4)
+    areas = regions[:, 2] * regions[:, 3]
+    # pixel coordinates of all regions: region index, and position within the region
+    region_index = np.repeat(np.arange(len(regions)), areas)
+    offset = np.arange(areas.sum()) - np.repeat(np.cumsum(areas) - areas, areas)
+    widths = np.maximum(regions[region_index, 2], 1)
+    rows = regions[region_index, 1] + offset // widths
+    cols = regions[region_index, 0] + offset % widths
+    if rows.size == 0:
+        return np.zeros((len(regions), cube.nbands), dtype=np.float32)
+    # each pixel is read once, even if regions overlap
+    flat, inverse = np.unique(rows * cube.ncols + cols, return_inverse=True)
+    pixels = cube.pixels(flat // cube.ncols, flat % cube.ncols).astype(np.float64)
+    membership = sparse.csr_matrix((np.ones(rows.size), (region_index, inverse.ravel())),
+                                   shape=(len(regions), flat.size))
+    return np.float32((membership @ pixels) / np.maximum(areas, 1)[:, np.newaxis])
+
+
+def thumbnail(img, region, padding=16, color=(255, 0, 0)):
+    """
+    Crop of an image around a region, with the region outlined
+    :param img: r*c*3 uint8 np.array (e.g. the rgb image of the cube)
+    :param region: (x, y, w, h)
+    :param padding: pixels of context around the region
+    :param color: color of the outline
+    :return: uint8 np.array
+    """
+    x, y, w, h = [int(v) for v in region]
+    r0, c0 = max(y - padding, 0), max(x - padding, 0)
+    r1, c1 = min(y + h + padding, img.shape[0]), min(x + w + padding, img.shape[1])
+    thumb = img[r0:r1, c0:c1].copy()
+    # outline just outside the region (inside, for regions at the border of the image)
+    top, left = max(y - 1, r0) - r0, max(x - 1, c0) - c0
+    bottom, right = min(y + h, r1 - 1) - r0, min(x + w, c1 - 1) - c0
+    thumb[top, left:right + 1] = color
+    thumb[bottom, left:right + 1] = color
+    thumb[top:bottom + 1, left] = color
+    thumb[top:bottom + 1, right] = color
+    return thumb
@@ -17,6 +17,23 @@ class Config:
         self.cross_size = cfg['CROSS_SIZE']
         self.marker_colors = cfg['MARKER_COLORS']
         self.marker_alpha = cfg['MARKER_ALPHA']
+        self.pca_seed = cfg.get('PCA_SEED', 0)
+        self.live_update_interval = cfg.get('LIVE_UPDATE_INTERVAL_MS', 30)
+        # keeping the database up to date with its directory
+        self.db_watch = cfg.get('DB_WATCH', False)
+        self.db_poll_interval = cfg.get('DB_POLL_INTERVAL_S', 0)
+        # headless tile server (main.py --serve)
+        self.server_host = cfg.get('SERVER_HOST', '127.0.0.1')
+        self.server_port = cfg.get('SERVER_PORT', 8000)
+        self.tile_size = cfg.get('TILE_SIZE', 256)
+        self.tile_cache_size = cfg.get('TILE_CACHE_SIZE', 1024)
+        # profiling / instrumentation, all optional
+        self.profiling = cfg.get('PROFILING', False)
+        self.profiling_status_bar = cfg.get('PROFILING_STATUS_BAR', True)
+        self.profiling_log = cfg.get('PROFILING_LOG', '')
+        self.profiling_trace = cfg.get('PROFILING_TRACE', '')
+        self.profiling_memory = cfg.get('PROFILING_MEMORY', False)
+        self.profiling_cprofile = cfg.get('PROFILING_CPROFILE', '')
         self.initial_image_width_ratio = 0.45
 
 
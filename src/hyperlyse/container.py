@@ -0,0 +1,265 @@
+import io
+import json
+import time
+import zlib
+import zipfile
+import threading
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from hyperlyse.products import ProductFile
+
+FORMAT = 'hyperlyse-cube'
+EXTENSION = '.hlc'
+
+
+def _encode(chunk, level):
+    # byte shuffle (all first bytes of the values, then all second bytes, ...) makes float data compress much better
+    chunk = np.ascontiguousarray(chunk)
+    shuffled = chunk.view(np.uint8).reshape(-1, chunk.dtype.itemsize).T
+    return zlib.compress(shuffled.tobytes(), level)
+
+
+def _decode(data, shape, dtype):
+    dtype = np.dtype(dtype)
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(shuffled.T).view(dtype).reshape(shape)
+
+
+class ContainerWriter:
+    """
+    Writes a calibrated cube into a Hyperlyse container (.hlc): a zip archive with the cube in
+    rows*cols*bands chunks (byte-shuffled and zlib-compressed, one member per chunk), an embedded header with band
+    centers and metadata, and optionally an RGB pyramid and derived products (see ProductWriter).
+    """
+    def __init__(self, file, shape, bands, chunk_shape=(64, 64, 32), dtype=np.float32, level=1, metadata=None,
+                 n_jobs=0):
+        """
+        :param file: target file (.hlc)
+        :param shape: (rows, cols, bands) of the cube
+        :param bands: band centers (wavelengths)
+        :param chunk_shape: (rows, cols, bands) of the chunks
+        :param dtype: data type of the stored values
+        :param level: zlib compression level, 1 (fast) to 9 (small)
+        :param metadata: dict, stored with the header (e.g. rgb_layers, device, source file)
+        :param n_jobs: number of threads compressing chunks; <1 means one per cpu
+        """
+        self.file = file
+        self.shape = tuple(int(s) for s in shape)
+        self.chunk_shape = tuple(int(c) for c in chunk_shape)
+        self.dtype = np.dtype(dtype)
+        self.level = level
+        self.n_jobs = n_jobs if n_jobs > 0 else None
+        self.header = {'format': FORMAT,
+                       'version': 1,
+                       'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'shape': self.shape,
+                       'chunk_shape': self.chunk_shape,
+                       'dtype': self.dtype.str,
+                       'codec': 'shuffle-zlib',
+                       'bands': [float(b) for b in bands],
+                       'pyramid': [],
+                       'metadata': metadata if metadata is not None else {}}
+        # chunks are compressed with zlib before they are added, so the zip members themselves are stored
+        self.zip = zipfile.ZipFile(file, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_rows(self, row, data):
+        """
+        Write a block of rows; row and the block height must be multiples of the chunk height (except at the end)
+        :param row: index of the first row
+        :param data: n*cols*bands np.array
+        """
+        cr, cc, cb = self.chunk_shape
+        blocks = [(r, c, b) for r in range(0, data.shape[0], cr)
+                  for c in range(0, self.shape[1], cc)
+                  for b in range(0, self.shape[2], cb)]
+
+        def encode(block):
+            r, c, b = block
+            return _encode(data[r:r + cr, c:c + cc, b:b + cb].astype(self.dtype), self.level)
+
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            # zlib releases the GIL, so chunks are compressed in parallel
+            for (r, c, b), encoded in zip(blocks, executor.map(encode, blocks)):
+                self.zip.writestr(ContainerWriter.chunk_name(row + r, c, b), encoded)
+
+    def write_cube(self, cube, chunk_rows=0):
+        """
+        Write all data of a hyper.Cube (which may be opened lazily), block by block
+        """
+        rows_per_block = max(chunk_rows // self.chunk_shape[0], 1) * self.chunk_shape[0]
+        for row in range(0, self.shape[0], rows_per_block):
+            self.write_rows(row, cube.roi((row, min(row + rows_per_block, self.shape[0])), (0, self.shape[1])))
+
+    def add_pyramid(self, rgb, min_size=256):
+        """
+        Store an RGB image and downsampled versions of it (each level half the size of the previous one), e.g. for
+        overviews and tiles
+        :param rgb: r*c*3 np.array, values in 0..1
+        :param min_size: smallest level that is stored (size of the longer side)
+        """
+        img = np.uint8(np.clip(rgb, 0, 1) * 255)
+        level = 0
+        while True:
+            buffer = io.BytesIO()
+            np.save(buffer, img, allow_pickle=False)
+            self.zip.writestr(f'pyramid/{level}.npy', buffer.getvalue(), compress_type=zipfile.ZIP_DEFLATED)
+            self.header['pyramid'].append(list(img.shape[:2]))
+            if max(img.shape[:2]) <= min_size:
+                break
+            # 2x2 mean
+            h, w = img.shape[0] // 2 * 2, img.shape[1] // 2 * 2
+            img = np.uint8(img[:h, :w].reshape(h // 2, 2, w // 2, 2, 3).mean(axis=(1, 3)) + 0.5)
+            level += 1
+
+    def add_products(self, products_file):
+        """
+        Embed a file written by ProductWriter
+        """
+        self.zip.write(products_file, 'products.npz')
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.writestr('header.json', json.dumps(self.header, indent=1, default=str))
+            self.zip.close()
+            self.zip = None
+
+    @staticmethod
+    def chunk_name(row, col, band):
+        return f'cube/{row}_{col}_{band}'
+
+
+class ContainerFile:
+    """
+    Lazy reader for Hyperlyse containers. Only the chunks touched by a request are read and decompressed; recently
+    used chunks are kept in a small cache. Offers the same queries as EnviReader (pixel, band, roi, ...), so it can be
+    used by Cube.
+    """
+    def __init__(self, file, cache_size=256):
+        """
+        :param file: .hlc file
+        :param cache_size: number of decompressed chunks kept in memory
+        """
+        self.file = file
+        self.zip = zipfile.ZipFile(file, 'r')
+        self.header = json.loads(self.zip.read('header.json'))
+        if self.header.get('format') != FORMAT:
+            raise ValueError(f'{file} is not a hyperlyse cube container')
+        self.shape = tuple(self.header['shape'])
+        self.nrows, self.ncols, self.nbands = self.shape
+        self.chunk_shape = tuple(self.header['chunk_shape'])
+        self.dtype = np.dtype(self.header['dtype'])
+        self.bands = self.header['bands']
+        self.metadata = self.header['metadata']
+        self.interleave = 'chunked'
+        self.__cache = collections.OrderedDict()
+        self.__cache_size = cache_size
+        self.__lock = threading.Lock()
+
+    def close(self):
+        self.zip.close()
+
+    def __chunk(self, row, col, band):
+        key = (row, col, band)
+        with self.__lock:
+            if key in self.__cache:
+                self.__cache.move_to_end(key)
+                return self.__cache[key]
+        shape = (min(self.chunk_shape[0], self.nrows - row),
+                 min(self.chunk_shape[1], self.ncols - col),
+                 min(self.chunk_shape[2], self.nbands - band))
+        chunk = _decode(self.zip.read(ContainerWriter.chunk_name(row, col, band)), shape, self.dtype)
+        with self.__lock:
+            self.__cache[key] = chunk
+            while len(self.__cache) > self.__cache_size:
+                self.__cache.popitem(last=False)
+        return chunk
+
+    def read(self, rows, cols, bands=(0, None)):
+        """
+        :param rows: (start, end) rows
+        :param cols: (start, end) columns
+        :param bands: (start, end) bands
+        :return: r*c*b np.array
+        """
+        (r0, r1), (c0, c1) = rows, cols
+        b0, b1 = bands[0], self.nbands if bands[1] is None else bands[1]
+        cr, cc, cb = self.chunk_shape
+        result = np.empty((r1 - r0, c1 - c0, b1 - b0), dtype=self.dtype)
+        for r in range(r0 // cr * cr, r1, cr):
+            for c in range(c0 // cc * cc, c1, cc):
+                for b in range(b0 // cb * cb, b1, cb):
+                    chunk = self.__chunk(r, c, b)
+                    # intersection of chunk and request
+                    ir0, ir1 = max(r, r0), min(r + chunk.shape[0], r1)
+                    ic0, ic1 = max(c, c0), min(c + chunk.shape[1], c1)
+                    ib0, ib1 = max(b, b0), min(b + chunk.shape[2], b1)
+                    result[ir0 - r0:ir1 - r0, ic0 - c0:ic1 - c0, ib0 - b0:ib1 - b0] = \
+                        chunk[ir0 - r:ir1 - r, ic0 - c:ic1 - c, ib0 - b:ib1 - b]
+        return result
+
+    def pixel(self, row, col):
+        return self.read((row, row + 1), (col, col + 1))[0, 0]
+
+    def pixels(self, rows, cols):
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        result = np.empty((rows.size, self.nbands), dtype=self.dtype)
+        if rows.size == 0:
+            return result
+        cr, cc, cb = self.chunk_shape
+        # pixels in the same chunks are gathered together, such that each chunk is decoded once
+        tile = rows // cr * ((self.ncols + cc - 1) // cc) + cols // cc
+        order = np.argsort(tile, kind='stable')
+        for group in np.split(order, np.flatnonzero(np.diff(tile[order])) + 1):
+            r, c = rows[group[0]] // cr * cr, cols[group[0]] // cc * cc
+            for b in range(0, self.nbands, cb):
+                chunk = self.__chunk(r, c, b)
+                result[group, b:b + chunk.shape[2]] = chunk[rows[group] - r, cols[group] - c]
+        return result
+
+    def band(self, band):
+        return self.read((0, self.nrows), (0, self.ncols), (band, band + 1))[:, :, 0]
+
+    def rows(self, row_start, row_end):
+        return self.read((row_start, row_end), (0, self.ncols))
+
+    def roi(self, rows, cols):
+        return self.read(rows, cols)
+
+    def roi_column_means(self, rows, cols):
+        (r0, r1), (c0, c1) = rows, cols
+        sums = np.zeros((c1 - c0, self.nbands))
+        step = self.chunk_shape[0]
+        # one row of chunks at a time
+        for r in range(r0 // step * step, r1, step):
+            sums += self.read((max(r, r0), min(r + step, r1)), cols).sum(axis=0, dtype=np.float64)
+        return sums / max(r1 - r0, 1)
+
+    def pyramid_levels(self):
+        """
+        :return: list of (rows, cols) of the stored RGB pyramid levels (empty if there is none)
+        """
+        return [tuple(s) for s in self.header['pyramid']]
+
+    def pyramid(self, level):
+        """
+        :return: RGB image (uint8) of a pyramid level
+        """
+        with self.zip.open(f'pyramid/{level}.npy') as f:
+            return np.load(io.BytesIO(f.read()), allow_pickle=False)
+
+    def has_products(self):
+        return 'products.npz' in self.zip.namelist()
+
+    def products(self):
+        """
+        :return: the embedded derived products (ProductFile), read lazily from the container
+        """
+        return ProductFile(self.zip.open('products.npz'))
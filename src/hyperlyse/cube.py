@@ -2,24 +2,70 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 import spectral
+from spectral.utilities.errors import SpyException
+from hyperlyse.profiling import profiler
+from hyperlyse.envi import EnviWriter, EnviReader
+from hyperlyse.container import ContainerWriter, ContainerFile, EXTENSION as CONTAINER_EXTENSION
 
 
 class Cube:
 
     DEFAULT_RGB = (598, 548, 449) # wavelengths of red, green, blue, as in the standard settings of SpecimIQ Studio
 
-    def __init__(self, file_data):
+    def __init__(self, file_data, lazy=False):
+        """
+        :param file_data: ENVI data file (header and references are looked up next to it), or Hyperlyse container
+                          (.hlc, see save_container)
+        :param lazy: if True, the cube is not loaded to memory (data stays None); pixels, bands and regions are read
+                     from the file (and calibrated) when requested, see pixel_spectrum, band_image, roi, roi_mean
+        """
         self.data = None
+        self.reader = None                      # file access: hyper.EnviReader (lazy only) or hyper.ContainerFile
         self.nrows = 0
         self.ncols = 0
         self.nbands = 0
         self.bands = []
         self.rgb_layers = (0, 0, 0)
         self.device = 'unknown device'
-        self.__read_data(file_data)
+        self.file_data = file_data
+        self.__dark = None                      # c*b dark reference, for calibrating lazily read data
+        self.__gain = None                      # c*b 1/(white reference - dark reference)
+        self.__scale = 1.0                      # used instead, if there are no references
+        if os.path.splitext(file_data)[1].lower() == CONTAINER_EXTENSION:
+            self.__read_container(file_data, lazy=lazy)
+        else:
+            self.__read_data(file_data, lazy=lazy)
+
 
+    @staticmethod
+    def from_array(data, bands, rgb_layers=None, device='unknown device', file_data=''):
+        """
+        Wrap an array of calibrated data (e.g. in shared memory, see SharedCube) as Cube, without reading any file
+        :param data: r*c*b np.array; not copied
+        :param bands: band centers (wavelengths)
+        :param rgb_layers: bands shown as red, green, blue; default: Cube.DEFAULT_RGB
+        :param device: name of the capturing device
+        :param file_data: file the data came from (used for cache_file and signature)
+        :return: Cube
+        """
+        cube = Cube.__new__(Cube)
+        cube.data = data
+        cube.reader = None
+        cube.nrows, cube.ncols, cube.nbands = data.shape
+        cube.bands = list(bands)
+        if rgb_layers is not None:
+            cube.rgb_layers = tuple(rgb_layers)
+        else:
+            cube.rgb_layers = tuple(cube.lambda2layer(l) for l in Cube.DEFAULT_RGB)
+        cube.device = device
+        cube.file_data = file_data
+        cube.__dark = None
+        cube.__gain = None
+        cube.__scale = 1.0
+        return cube
 
-    def __read_data(self, file_data, verbose=False):
+    @profiler.timed('Cube.read_data')
+    def __read_data(self, file_data, lazy=False, verbose=False):
         # assemble additional filepaths
         dir_data = os.path.dirname(file_data)
         capture_id, ext = os.path.splitext(os.path.basename(file_data))
@@ -35,10 +81,11 @@ class Cube:
 
         # read main data
         header = spectral.envi.open(file_header, file_data)
-        data = header.load()
-        self.nrows = data.shape[0]
-        self.ncols = data.shape[1]
-        self.nbands = data.shape[2]
+        self.nrows, self.ncols, self.nbands = header.shape
+        # the reader keeps the data file mapped; loaded data does not need it
+        self.reader = EnviReader(file_header, file_data) if lazy else None
+        # plain arrays: calibrating spectral's ImageArray goes through its deprecated __array_wrap__
+        data = None if lazy else np.asarray(header.load())
 
         # read meta
         self.bands = header.bands.centers
@@ -62,9 +109,9 @@ class Cube:
         # read white and black ref
         try:
             dref_header = spectral.envi.open(file_dref_header, file_dref_data)
-            dref_data = dref_header.load()
+            dref_data = np.asarray(dref_header.load())
             wref_header = spectral.envi.open(file_wref_header, file_wref_data)
-            wref_data = wref_header.load()
+            wref_data = np.asarray(wref_header.load())
 
             dref_mean = np.mean(dref_data, axis=1)
             wref_mean = np.mean(wref_data, axis=1)
@@ -79,11 +126,20 @@ class Cube:
                 plt.show()
 
             # use mean? or use all values? who knows?
-            self.data = (data - dref_data) / (wref_data - dref_data)
+            # every line is calibrated with the mean over the lines of the references (c*b)
+            dark = np.mean(dref_data, axis=0, dtype=np.float64)
+            white = np.mean(wref_data, axis=0, dtype=np.float64)
+            if lazy:
+                self.__dark = dark.astype(np.float32)
+                self.__gain = np.float32(1 / (white - dark))
+            else:
+                self.data = (data - dark.astype(data.dtype)) / (white - dark).astype(data.dtype)
 
-        except:
+        except (OSError, SpyException):
             #self.data = np.clip(data / scale_factor, 0, 1)
-            self.data = data / scale_factor
+            self.__scale = scale_factor
+            if not lazy:
+                self.data = data / scale_factor
             print("WARNING: No reference spectra found, cube might be uncalibrated.")
 
         if verbose:
@@ -93,11 +149,164 @@ class Cube:
             plt.imshow(rgb, extent=(0, 50, 0, 50))
             plt.show()
 
+    @profiler.timed('Cube.read_container')
+    def __read_container(self, file_data, lazy=False):
+        # containers hold calibrated data, nothing to do but reading
+        self.reader = ContainerFile(file_data)
+        self.nrows, self.ncols, self.nbands = self.reader.shape
+        self.bands = self.reader.bands
+        metadata = self.reader.metadata
+        if 'rgb_layers' in metadata:
+            self.rgb_layers = tuple(metadata['rgb_layers'])
+        else:
+            self.rgb_layers = tuple(self.lambda2layer(l) for l in Cube.DEFAULT_RGB)
+        self.device = metadata.get('device', self.device)
+        if not lazy:
+            self.data = self.reader.read((0, self.nrows), (0, self.ncols))
+
+    @profiler.timed('Cube.save_container')
+    def save_container(self, file, chunk_shape=(64, 64, 32), level=1, pyramid=True, products_file=None):
+        """
+        Save the calibrated cube as Hyperlyse container (chunked, compressed; see ContainerWriter), which can be
+        opened (lazily) like ENVI data
+        :param file: target file (.hlc)
+        :param chunk_shape: (rows, cols, bands) of the chunks
+        :param level: zlib compression level, 1 (fast) to 9 (small)
+        :param pyramid: also store the RGB image and downsampled versions of it
+        :param products_file: optional analysis results (written by ProductWriter) to embed
+        """
+        metadata = {'rgb_layers': list(self.rgb_layers),
+                    'device': self.device,
+                    'source_file': self.file_data}
+        with ContainerWriter(file, (self.nrows, self.ncols, self.nbands), self.bands, chunk_shape=chunk_shape,
+                             level=level, metadata=metadata) as writer:
+            writer.write_cube(self, chunk_rows=256)
+            if pyramid:
+                writer.add_pyramid(self.to_rgb())
+            if products_file:
+                writer.add_products(products_file)
+
+    def cache_file(self, name):
+        """
+        Path of a file in the cache for derived data of this cube (stored next to the capture)
+        :param name: name of the cached item, e.g. 'pca.npz'
+        :return: file path
+        """
+        dir_data = os.path.dirname(self.file_data)
+        capture_id = os.path.splitext(os.path.basename(self.file_data))[0]
+        return os.path.join(dir_data, 'hyperlyse_cache', f'{capture_id}_{name}')
+
+    def signature(self):
+        """
+        :return: a string that changes whenever the raw data file changes; used to validate cached data
+        """
+        stat = os.stat(self.file_data)
+        return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+    @profiler.timed('Cube.save_envi')
+    def save_envi(self, file_header, interleave='bsq', rows=None, cols=None, bands=None, binning=1,
+                  dtype=np.float32, chunk_rows=64):
+        """
+        Save the (calibrated) cube, or a subset of it, as ENVI image. Written in blocks of rows.
+        :param file_header: target .hdr file
+        :param interleave: 'bsq', 'bil' or 'bip'
+        :param rows: (start, end) rows to save, default all
+        :param cols: (start, end) columns to save, default all
+        :param bands: (start, end) band indices to save, default all
+        :param binning: spatial binning; blocks of binning*binning pixels are averaged
+        :param dtype: data type of the stored values
+        :param chunk_rows: number of (output) rows processed at once
+        :return: path of the data file
+        """
+        r0, r1 = rows if rows is not None else (0, self.nrows)
+        c0, c1 = cols if cols is not None else (0, self.ncols)
+        b0, b1 = bands if bands is not None else (0, self.nbands)
+        r0, r1 = max(r0, 0), min(r1, self.nrows)
+        c0, c1 = max(c0, 0), min(c1, self.ncols)
+        b0, b1 = max(b0, 0), min(b1, self.nbands)
+        # incomplete bins at the borders are dropped
+        nrows_out = (r1 - r0) // binning
+        ncols_out = (c1 - c0) // binning
+        nbands_out = b1 - b0
+
+        metadata = {'wavelength': list(self.bands[b0:b1]),
+                    'wavelength units': 'nm',
+                    'sensor type': self.device}
+        if all(b0 <= l < b1 for l in self.rgb_layers):
+            metadata['default bands'] = [l - b0 for l in self.rgb_layers]
+
+        with EnviWriter(file_header, nrows_out, ncols_out, nbands_out, dtype, interleave,
+                        metadata=metadata) as writer:
+            for row in range(0, nrows_out, chunk_rows):
+                n = min(chunk_rows, nrows_out - row)
+                chunk = self.roi((r0 + row * binning, r0 + (row + n) * binning),
+                                 (c0, c0 + ncols_out * binning))[:, :, b0:b1]
+                if binning > 1:
+                    chunk = chunk.reshape(n, binning, ncols_out, binning, nbands_out).mean(axis=(1, 3))
+                writer.write_rows(row, chunk)
+        return writer.file_data
+
     def lambda2layer(self, lmd):
         diffs = [abs(lmd-l) for l in self.bands]
         return diffs.index(min(diffs))
 
+    def __calibrate(self, raw, cols=slice(None), bands=slice(None)):
+        raw = raw.astype(np.float32)
+        if self.__dark is None:
+            return raw / np.float32(self.__scale)
+        return (raw - self.__dark[cols, bands]) * self.__gain[cols, bands]
+
+    def pixel_spectrum(self, row, col):
+        """
+        :return: calibrated spectrum of a pixel, np.array of nbands values
+        """
+        if self.data is not None:
+            return self.data[row, col, :]
+        return self.__calibrate(self.reader.pixel(row, col), col)
+
+    def pixels(self, rows, cols):
+        """
+        :param rows: np.array of row indices
+        :param cols: np.array of column indices (same length)
+        :return: calibrated spectra of the pixels, n*nbands np.array
+        """
+        if self.data is not None:
+            return self.data[rows, cols, :]
+        return self.__calibrate(self.reader.pixels(rows, cols), np.asarray(cols))
+
+    def band_image(self, band):
+        """
+        :return: calibrated image of a band, nrows*ncols np.array
+        """
+        if self.data is not None:
+            return self.data[:, :, band]
+        return self.__calibrate(self.reader.band(band), bands=band)
+
+    def roi(self, rows, cols):
+        """
+        :param rows: (start, end) rows
+        :param cols: (start, end) columns
+        :return: calibrated pixels of a rectangle, r*c*nbands np.array
+        """
+        if self.data is not None:
+            return self.data[rows[0]:rows[1], cols[0]:cols[1], :]
+        return self.__calibrate(self.reader.roi(rows, cols), slice(cols[0], cols[1]))
+
+    def roi_mean(self, rows, cols):
+        """
+        :param rows: (start, end) rows
+        :param cols: (start, end) columns
+        :return: mean calibrated spectrum of a rectangle, np.array of nbands values
+        """
+        if self.data is not None:
+            return np.mean(self.data[rows[0]:rows[1], cols[0]:cols[1], :], axis=(0, 1))
+        # calibration is linear per column: average the raw rows first
+        column_means = self.__calibrate(self.reader.roi_column_means(rows, cols), slice(cols[0], cols[1]))
+        return column_means.mean(axis=0)
+
     def to_rgb(self):
+        if self.data is None:
+            return np.clip(np.dstack([self.band_image(layer) for layer in self.rgb_layers]), None, 1)
         rgb = self.data[:,:,self.rgb_layers]
         # clip anything above white
         rgb[rgb > 1] = 1
@@ -1,7 +1,10 @@
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
 from PyQt6.QtWidgets import QSizePolicy, QDialog, QFormLayout, QLabel, QLineEdit, QComboBox, QDialogButtonBox
-from PyQt6.QtCore import QSize
+from PyQt6.QtWidgets import QVBoxLayout, QListWidget, QListWidgetItem, QAbstractItemView, QCheckBox, QSpinBox
+from PyQt6.QtWidgets import QHBoxLayout, QPushButton, QFileDialog
+from PyQt6.QtCore import QSize, Qt, QObject, QTimer
+from hyperlyse.preprocessing import Preprocessing
 
 class PlotCanvas(FigureCanvas):
     def __init__(self, parent=None, width=5, height=4, dpi=100):
@@ -19,6 +22,17 @@ class PlotCanvas(FigureCanvas):
         self.ymin = 0.0
         self.ymax = 1.0
 
+        # persistent artists, re-used between updates
+        self.lines = []
+        self.span = None
+        self.span_range = None
+        self.legend_labels = None
+        self.live_line = None
+        self.live_background = None
+        self.overlay_line = None
+        self.overlay_background = None
+        self.mpl_connect('draw_event', self.__handle_draw)
+
     def set_ranges(self, xmin, xmax, ymin, ymax):
         self.xmin = xmin
         self.xmax = xmax
@@ -34,6 +48,9 @@ class PlotCanvas(FigureCanvas):
         if not hold:
             self.figure.clear()
             self.ax = self.figure.add_subplot(111)
+            self.lines = []
+            self.span = None
+            self.legend_labels = None
             color = 'green' if self.xmin < self.xmax else 'red'
             self.ax.axvspan(self.xmin, self.xmax, alpha=0.1, color=color)
         self.ax.plot(x, y, label=label, linewidth=linewidth)
@@ -42,9 +59,128 @@ class PlotCanvas(FigureCanvas):
             self.ax.legend()
         self.draw()
 
+    def plot_spectra(self, spectra):
+        """
+        Show a set of spectra with a single redraw. Line artists are re-used and only get new data.
+        :param spectra: list of dicts with keys 'x', 'y' and optionally 'label', 'linewidth'
+        """
+        self.stop_live()
+        if len(self.figure.axes) != 1 or self.ax not in self.figure.axes:
+            # something (e.g. plot()) replaced the axes
+            self.lines = []
+            self.span = None
+            self.legend_labels = None
+
+        # comparison range
+        if self.span is None or self.span_range != (self.xmin, self.xmax):
+            if self.span is not None:
+                self.span.remove()
+            color = 'green' if self.xmin < self.xmax else 'red'
+            self.span = self.ax.axvspan(self.xmin, self.xmax, alpha=0.1, color=color)
+            self.span_range = (self.xmin, self.xmax)
+
+        # lines: update existing ones, create missing ones, hide the rest
+        for i, spectrum in enumerate(spectra):
+            if i < len(self.lines):
+                line = self.lines[i]
+                line.set_data(spectrum['x'], spectrum['y'])
+            else:
+                line, = self.ax.plot(spectrum['x'], spectrum['y'])
+                self.lines.append(line)
+            line.set_label(spectrum.get('label', ''))
+            line.set_linewidth(spectrum.get('linewidth', 2))
+            line.set_visible(True)
+        for line in self.lines[len(spectra):]:
+            line.set_visible(False)
+            line.set_label('_hidden')
+
+        self.ax.relim(visible_only=True)
+        self.ax.autoscale_view(scaley=False)
+        self.ax.set_ylim(self.ymin, self.ymax)
+
+        labels = [s.get('label', '') for s in spectra]
+        if labels != self.legend_labels:
+            self.legend_labels = labels
+            if self.ax.get_legend() is not None:
+                self.ax.get_legend().remove()
+            if any(labels):
+                self.ax.legend(handles=[line for line, label in zip(self.lines, labels) if label])
+        self.draw_idle()
+
+    def start_live(self, index=0):
+        """
+        Prepare fast updates of one line (e.g. while the mouse is dragged): everything else is rendered once
+        into a background buffer, afterwards update_live only redraws the line itself (blitting).
+        :param index: index of the line in the last plot_spectra call
+        """
+        if index >= len(self.lines) or not self.lines[index].get_visible() or not self.supports_blit:
+            return False
+        self.live_line = self.lines[index]
+        self.live_line.set_animated(True)
+        self.draw()
+        self.live_background = self.copy_from_bbox(self.ax.bbox)
+        return True
+
+    def update_live(self, x, y):
+        """
+        Update the line selected with start_live, without redrawing the rest of the figure
+        """
+        if self.live_line is None:
+            return False
+        self.restore_region(self.live_background)
+        self.live_line.set_data(x, y)
+        self.ax.draw_artist(self.live_line)
+        self.blit(self.ax.bbox)
+        return True
+
+    def stop_live(self):
+        if self.live_line is not None:
+            self.live_line.set_animated(False)
+            self.live_line = None
+            self.live_background = None
+            self.draw_idle()
+
+    def set_overlay(self, x, y):
+        """
+        Show (or move) an additional dashed line, e.g. the spectrum under the mouse cursor. Only the line itself is
+        redrawn (blitting), on top of a buffer of the rest of the figure that is kept up to date on every full redraw.
+        """
+        if self.overlay_line is None or self.overlay_line.axes is not self.ax:
+            self.overlay_line, = self.ax.plot(x, y, linestyle='--', linewidth=1, color='black', animated=True)
+            self.overlay_background = None
+        self.overlay_line.set_data(x, y)
+        self.overlay_line.set_visible(True)
+        if self.overlay_background is None or not self.supports_blit:
+            self.draw()
+        else:
+            self.restore_region(self.overlay_background)
+            self.ax.draw_artist(self.overlay_line)
+            self.blit(self.ax.bbox)
+
+    def clear_overlay(self):
+        if self.overlay_line is not None and self.overlay_line.get_visible():
+            self.overlay_line.set_visible(False)
+            if self.overlay_background is not None and self.supports_blit:
+                self.restore_region(self.overlay_background)
+                self.blit(self.ax.bbox)
+
+    def __handle_draw(self, event):
+        # a full redraw just happened (without animated artists): remember it and put the overlay back on top
+        if self.overlay_line is not None and self.overlay_line.axes is self.ax and self.supports_blit:
+            self.overlay_background = self.copy_from_bbox(self.ax.bbox)
+            if self.overlay_line.get_visible():
+                self.ax.draw_artist(self.overlay_line)
+
     def reset(self):
         self.figure.clear()
         self.ax = self.figure.add_subplot(111)
+        self.lines = []
+        self.span = None
+        self.legend_labels = None
+        self.live_line = None
+        self.live_background = None
+        self.overlay_line = None
+        self.overlay_background = None
         self.draw()
 
     def save(self, fileName):
@@ -85,4 +221,277 @@ class SaveSpectrumDialog(QDialog):
             'description': self.le_description.text(),
             'source': self.le_source.text(),
             'intensity': self.cb_intensity.currentText()
-        }
\ No newline at end of file
+        }
+
+
+class ExportCubeDialog(QDialog):
+    def __init__(self, parent, has_pca=False, has_rect=False):
+        super(QDialog, self).__init__(parent)
+
+        self.setWindowTitle('Export cube as ENVI image')
+
+        layout = QFormLayout(self)
+
+        self.cmb_content = QComboBox(self)
+        self.cmb_content.addItem('calibrated cube', 'cube')
+        if has_pca:
+            self.cmb_content.addItem('principal components', 'pca')
+        self.cmb_interleave = QComboBox(self)
+        self.cmb_interleave.addItem('BSQ (fast band images)', 'bsq')
+        self.cmb_interleave.addItem('BIL (as captured)', 'bil')
+        self.cmb_interleave.addItem('BIP (fast pixel spectra)', 'bip')
+        self.cb_rect = QCheckBox('only selected area', self)
+        self.cb_rect.setEnabled(has_rect)
+        self.cb_range = QCheckBox('only compared wavelength range', self)
+        self.sb_binning = QSpinBox(self)
+        self.sb_binning.setRange(1, 16)
+
+        layout.addRow(QLabel('Content'), self.cmb_content)
+        layout.addRow(QLabel('Interleave'), self.cmb_interleave)
+        layout.addRow(QLabel('Binning'), self.sb_binning)
+        layout.addRow(self.cb_rect)
+        layout.addRow(self.cb_range)
+
+        self.bb = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        self.bb.accepted.connect(self.accept)
+        self.bb.rejected.connect(self.reject)
+        layout.addWidget(self.bb)
+
+    def get_data(self):
+        return {
+            'content': self.cmb_content.currentData(),
+            'interleave': self.cmb_interleave.currentData(),
+            'binning': self.sb_binning.value(),
+            'rect_only': self.cb_rect.isChecked(),
+            'range_only': self.cb_range.isChecked()
+        }
+
+
+class PreprocessingDialog(QDialog):
+    def __init__(self, parent, preprocessing):
+        super(QDialog, self).__init__(parent)
+
+        self.setWindowTitle('Preprocessing of compared spectra')
+
+        layout = QFormLayout(self)
+
+        self.sb_smoothing = QSpinBox(self)
+        self.sb_smoothing.setRange(0, 99)
+        self.sb_smoothing.setSingleStep(2)
+        self.sb_smoothing.setSpecialValueText('off')
+        self.sb_smoothing.setValue(preprocessing.smoothing)
+        self.sb_polyorder = QSpinBox(self)
+        self.sb_polyorder.setRange(1, 5)
+        self.sb_polyorder.setValue(preprocessing.polyorder)
+        self.cb_continuum = QCheckBox('continuum removal', self)
+        self.cb_continuum.setChecked(preprocessing.continuum_removal)
+        self.cmb_derivative = QComboBox(self)
+        for derivative, name in enumerate(['none', '1st derivative', '2nd derivative']):
+            self.cmb_derivative.addItem(name, derivative)
+        self.cmb_derivative.setCurrentIndex(preprocessing.derivative)
+        self.cmb_normalization = QComboBox(self)
+        for normalization, name in Preprocessing.NORMALIZATIONS.items():
+            self.cmb_normalization.addItem(name, normalization)
+        self.cmb_normalization.setCurrentIndex(self.cmb_normalization.findData(preprocessing.normalization))
+        self.le_mask = QLineEdit(self)
+        self.le_mask.setPlaceholderText('e.g. 1340-1460, 1790-1960')
+        self.le_mask.setText(', '.join(f'{lo:g}-{hi:g}' for lo, hi in preprocessing.band_mask))
+        self.lbl_error = QLabel(self)
+
+        layout.addRow(QLabel('Smoothing window (bands)'), self.sb_smoothing)
+        layout.addRow(QLabel('Smoothing polynomial order'), self.sb_polyorder)
+        layout.addRow(self.cb_continuum)
+        layout.addRow(QLabel('Derivative'), self.cmb_derivative)
+        layout.addRow(QLabel('Normalization'), self.cmb_normalization)
+        layout.addRow(QLabel('Excluded wavelengths'), self.le_mask)
+        layout.addRow(self.lbl_error)
+
+        self.bb = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel |
+                                   QDialogButtonBox.StandardButton.Reset)
+        self.bb.accepted.connect(self.handle_accept)
+        self.bb.rejected.connect(self.reject)
+        self.bb.button(QDialogButtonBox.StandardButton.Reset).clicked.connect(self.handle_reset)
+        layout.addWidget(self.bb)
+
+    def handle_reset(self):
+        self.sb_smoothing.setValue(0)
+        self.sb_polyorder.setValue(2)
+        self.cb_continuum.setChecked(False)
+        self.cmb_derivative.setCurrentIndex(0)
+        self.cmb_normalization.setCurrentIndex(0)
+        self.le_mask.clear()
+
+    def handle_accept(self):
+        try:
+            self.get_data()
+        except ValueError as e:
+            self.lbl_error.setText(str(e))
+            return
+        self.accept()
+
+    def get_data(self):
+        return Preprocessing(smoothing=self.sb_smoothing.value(),
+                             polyorder=self.sb_polyorder.value(),
+                             derivative=self.cmb_derivative.currentData(),
+                             continuum_removal=self.cb_continuum.isChecked(),
+                             normalization=self.cmb_normalization.currentData(),
+                             band_mask=Preprocessing.parse_ranges(self.le_mask.text()))
+
+
+class BatchExtractDialog(QDialog):
+    def __init__(self, parent, default_object='', has_rect=False):
+        super(QDialog, self).__init__(parent)
+
+        self.setWindowTitle('Batch extract spectra')
+
+        layout = QFormLayout(self)
+
+        self.resize(QSize(350, 100))
+
+        self.cmb_source = QComboBox(self)
+        self.cmb_source.addItem('regular grid', 'grid')
+        self.cmb_source.addItem('points/rectangles from CSV file', 'csv')
+        self.sb_step = QSpinBox(self)
+        self.sb_step.setRange(1, 10000)
+        self.sb_step.setValue(20)
+        self.sb_size = QSpinBox(self)
+        self.sb_size.setRange(1, 1000)
+        self.sb_size.setValue(5)
+        self.cb_rect = QCheckBox('only selected area', self)
+        self.cb_rect.setEnabled(has_rect)
+        self.cb_rect.setChecked(has_rect)
+        self.le_csv = QLineEdit(self)
+        self.le_csv.setPlaceholderText('x,y[,w,h][,name] per line')
+        self.btn_csv = QPushButton('...', self)
+        self.btn_csv.setFixedWidth(30)
+        self.btn_csv.clicked.connect(self.handle_browse_csv)
+        csv_layout = QHBoxLayout()
+        csv_layout.addWidget(self.le_csv)
+        csv_layout.addWidget(self.btn_csv)
+        self.le_prefix = QLineEdit(self)
+        self.le_prefix.setText('p')
+        self.le_description = QLineEdit(self)
+        self.le_source = QLineEdit(self)
+        self.le_source.setText(default_object)
+        self.cb_intensity = QComboBox(self)
+        for intensity in ['(undefined intensity)', 'light', 'medium', 'dark']:
+            self.cb_intensity.addItem(intensity)
+        self.cmb_format = QComboBox(self)
+        self.cmb_format.addItem('JCAMP-DX (.jdx)', '.jdx')
+        self.cmb_format.addItem('Plain x,y pairs (.dpt)', '.dpt')
+        self.cb_thumbnails = QCheckBox('save thumbnails', self)
+        self.cb_thumbnails.setChecked(True)
+
+        layout.addRow(QLabel('Positions'), self.cmb_source)
+        layout.addRow(QLabel('Grid step'), self.sb_step)
+        layout.addRow(QLabel('Region size'), self.sb_size)
+        layout.addRow(self.cb_rect)
+        layout.addRow(QLabel('CSV file'), csv_layout)
+        layout.addRow(QLabel('Sample ID prefix'), self.le_prefix)
+        layout.addRow(QLabel('Description'), self.le_description)
+        layout.addRow(QLabel('Intensity'), self.cb_intensity)
+        layout.addRow(QLabel('Source object'), self.le_source)
+        layout.addRow(QLabel('Format'), self.cmb_format)
+        layout.addRow(self.cb_thumbnails)
+
+        self.bb = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        self.bb.accepted.connect(self.accept)
+        self.bb.rejected.connect(self.reject)
+        layout.addWidget(self.bb)
+
+        self.cmb_source.currentIndexChanged.connect(self.handle_source_changed)
+        self.handle_source_changed()
+
+    def handle_source_changed(self):
+        grid = self.cmb_source.currentData() == 'grid'
+        self.sb_step.setEnabled(grid)
+        self.sb_size.setEnabled(grid)
+        self.le_csv.setEnabled(not grid)
+        self.btn_csv.setEnabled(not grid)
+
+    def handle_browse_csv(self):
+        file, _ = QFileDialog.getOpenFileName(self, 'Select CSV file', self.le_csv.text(), 'CSV (*.csv *.txt)')
+        if file:
+            self.le_csv.setText(file)
+
+    def get_data(self):
+        return {
+            'source': self.cmb_source.currentData(),
+            'step': self.sb_step.value(),
+            'size': self.sb_size.value(),
+            'rect_only': self.cb_rect.isChecked(),
+            'csv': self.le_csv.text(),
+            'prefix': self.le_prefix.text(),
+            'description': self.le_description.text(),
+            'object': self.le_source.text(),
+            'intensity': self.cb_intensity.currentText(),
+            'format': self.cmb_format.currentData(),
+            'thumbnails': self.cb_thumbnails.isChecked()
+        }
+
+
+class SelectSpectraDialog(QDialog):
+    def __init__(self, parent, spectra, selected_ids=()):
+        super(QDialog, self).__init__(parent)
+
+        self.setWindowTitle('Select database spectra')
+
+        layout = QVBoxLayout(self)
+
+        self.resize(QSize(400, 400))
+
+        self.lst_spectra = QListWidget(self)
+        self.lst_spectra.setSelectionMode(QAbstractItemView.SelectionMode.MultiSelection)
+        for i, s in enumerate(spectra):
+            item = QListWidgetItem(s.display_string(with_description=True))
+            item.setData(Qt.ItemDataRole.UserRole, i)
+            self.lst_spectra.addItem(item)
+            item.setSelected(i in selected_ids)
+        layout.addWidget(self.lst_spectra)
+
+        self.bb = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        self.bb.accepted.connect(self.accept)
+        self.bb.rejected.connect(self.reject)
+        layout.addWidget(self.bb)
+
+    def get_data(self):
+        return sorted(item.data(Qt.ItemDataRole.UserRole) for item in self.lst_spectra.selectedItems())
+
+
+
+class Throttle(QObject):
+    """
+    Coalesces frequent calls (e.g. from mouse move events): the callback runs at most once per interval, and always
+    with the latest arguments only. Calls in between are dropped, so slow callbacks never queue up.
+    """
+    def __init__(self, callback, interval_ms=30, parent=None):
+        super(Throttle, self).__init__(parent)
+        self.callback = callback
+        self.pending = None
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self.__handle_timeout)
+
+    def __call__(self, *args):
+        self.pending = args
+        if not self.timer.isActive():
+            # idle: run right away, then hold back further calls for one interval
+            self.flush()
+
+    def flush(self):
+        """
+        Run the pending call (if any) now
+        """
+        if self.pending is not None:
+            args = self.pending
+            self.pending = None
+            self.timer.start()
+            self.callback(*args)
+
+    def cancel(self):
+        self.pending = None
+        self.timer.stop()
+
+    def __handle_timeout(self):
+        self.flush()
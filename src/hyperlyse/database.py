@@ -1,13 +1,22 @@
 import os
 import re
 import json
+import hashlib
+import functools
 import numpy as np
+from scipy import sparse
 import matplotlib.image
-from scipy.signal import resample
 import collections
+from concurrent.futures import ThreadPoolExecutor
+from hyperlyse.profiling import profiler
+from hyperlyse.preprocessing import Preprocessing
+from hyperlyse.resampling import resampling_matrix
 
 
 class Metadata:
+    __slots__ = ('id', 'description', 'source_object', 'source_file', 'source_coordinates', 'device_info',
+                 'intensity')
+
     def __init__(self,
                  id,
                  description='',
@@ -27,11 +36,27 @@ class Metadata:
 
 
 class Spectrum:
+    __slots__ = ('x', 'y', 'metadata')
+
     def __init__(self, x, y, metadata: Metadata):
         self.x = np.array(x)
         self.y = np.array(y)
         self.metadata = metadata
 
+    @staticmethod
+    def view(x, y, metadata: Metadata):
+        """
+        A spectrum that refers to the given arrays instead of copying them (see SpectrumStore); its x and y are
+        read-only views, so the referenced data cannot be changed through them
+        """
+        spectrum = Spectrum.__new__(Spectrum)
+        spectrum.x = x.view()
+        spectrum.x.flags.writeable = False
+        spectrum.y = y.view()
+        spectrum.y.flags.writeable = False
+        spectrum.metadata = metadata
+        return spectrum
+
     def display_string(self, with_description=False, separator=' | '):
         values = [self.metadata.source_object,
                   self.metadata.id]
@@ -41,10 +66,29 @@ class Spectrum:
         return separator.join(values)
 
     def save_dpt(self, file_name):
-        data = np.transpose([np.float32(self.x), np.float32(self.y)])
-        np.savetxt(file_name, data, fmt='%.4f', delimiter=',')
+        Spectrum.write_text(file_name, self.dpt_text())
+
+    def dpt_text(self):
+        """
+        :return: the content of a .dpt file (x,y pairs)
+        """
+        return ''.join(f'{x:.4f},{y:.4f}\n' for x, y in zip(np.float32(self.x), np.float32(self.y)))
 
     def save_jcamp(self, file_name):
+        Spectrum.write_text(file_name, self.jcamp_text())
+
+    @staticmethod
+    def write_text(file_name, text):
+        # the whole file is written at once
+        if os.path.dirname(file_name) and not os.path.isdir(os.path.dirname(file_name)):
+            os.makedirs(os.path.dirname(file_name))
+        with open(file_name, 'w') as f:
+            f.write(text)
+
+    def jcamp_text(self):
+        """
+        :return: the content of a JCAMP-DX file
+        """
         # prepare output file content
         data = collections.OrderedDict()  # in jcamp, order of elements is kind of important..
         data['##TITLE'] = f'{self.metadata.id} | {self.metadata.source_object}'
@@ -87,23 +131,23 @@ class Spectrum:
 
         data['##END'] = ''
 
-        # write the file
-        if not os.path.isdir(os.path.dirname(file_name)):
-            os.makedirs(os.path.dirname(file_name))
-        with open(file_name, 'w') as f:
-            for k, v in data.items():
-                if k == "##XYDATA":
-                    f.write('##XYDATA= (X++(Y..Y))\n')
-                    for x, y in v:
-                        f.write('%s %s\n' % (str(x), str(y)))
-                else:
-                    f.write('%s= %s\n' % (k.replace('_', ' '), str(v)))
+        lines = []
+        for k, v in data.items():
+            if k == "##XYDATA":
+                lines.append('##XYDATA= (X++(Y..Y))\n')
+                lines.extend('%s %s\n' % (str(x), str(y)) for x, y in v)
+            else:
+                lines.append('%s= %s\n' % (k.replace('_', ' '), str(v)))
+        return ''.join(lines)
+
+    JCAMP_EXTENSIONS = ['.dx', '.jdx', '.jcm']
+    DPT_EXTENSIONS = ['.dpt', '.csv']
 
     @staticmethod
     def __jcamp_line_to_key_value(line):
-        result = re.search(r'##(.*)= (.*)', line)
+        result = re.match(r'\s*##([^=]*)=\s?(.*)', line)
         if result:
-            return (result.group(1), result.group(2))
+            return (result.group(1).strip().upper(), result.group(2).rstrip())
         else:
             return None
 
@@ -115,32 +159,46 @@ class Spectrum:
                 values.append('')
         return values
 
+    @staticmethod
+    def __parse_numbers(line):
+        """
+        Numbers of a line of JCAMP data (AFFN: separated by blanks, commas, semicolons, or just by signs)
+        """
+        line = line.split('$$')[0]  # comments
+        try:
+            return [float(v) for v in line.replace(',', ' ').replace(';', ' ').split()]
+        except ValueError:
+            numbers = re.findall(r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?', line)
+            if re.sub(r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?|[\s,;]', '', line):
+                raise ValueError('compressed (ASDF) data is not supported')
+            return [float(v) for v in numbers]
+
     @staticmethod
     def load_jcamp(file):
         """
-        Only works with files produced by __save_jcamp
+        Load a JCAMP-DX file with a single spectrum, as written by save_jcamp, or by other software:
+        ##XYDATA=(X++(Y..Y)) with one or more y values per line, or ##XYPOINTS/##PEAK TABLE=(XY..XY), uncompressed
+        (AFFN) values; XFACTOR and YFACTOR are applied
         :param file:
         :return:
         """
-        with open(file, 'r') as f:
+        with open(file, 'r', errors='replace') as f:
             lines = f.read().splitlines()
 
-        start_xy_data = False
+        data_format = None
+        data_lines = []
+        labels = {}
         metadata = Metadata('')
-        x = []
-        y = []
         for line in lines:
-            kv = Spectrum.__jcamp_line_to_key_value(line)
+            kv = Spectrum.__jcamp_line_to_key_value(line) if line.lstrip().startswith('##') else None
             if kv is None:
-                if start_xy_data:
-                    vx, vy = Spectrum.__jcamp_split_multi_values(line, 2, ' ')
-                    try:
-                        x.append(float(vx))
-                        y.append(float(vy))
-                    except:
-                        pass
+                if data_format is not None and line.strip():
+                    data_lines.append(line)
             else:
                 k, v = kv
+                if data_format is not None and data_lines:
+                    break  # only the first data block
+                labels[k] = v
                 if k == 'TITLE':
                     id, src_obj = Spectrum.__jcamp_split_multi_values(v, 2)
                     metadata.id = id
@@ -155,14 +213,218 @@ class Spectrum:
                     description, intensity = Spectrum.__jcamp_split_multi_values(v, 2)
                     metadata.description = description
                     metadata.intensity = intensity
-                elif k == 'XYDATA':
-                    start_xy_data = True
+                elif k in ['XYDATA', 'XYPOINTS', 'PEAK TABLE']:
+                    data_format = v.replace(' ', '').upper()
                 elif k == 'END':
                     break
-        return Spectrum(np.array(x),
-                        np.array(y),
+
+        if data_format is None:
+            raise ValueError('no spectral data found')
+        x_factor = float(labels.get('XFACTOR', 1) or 1)
+        y_factor = float(labels.get('YFACTOR', 1) or 1)
+        block = '\n'.join(data_lines).replace(',', ' ').replace(';', ' ')
+        try:
+            # plain numbers: converted at once
+            values = np.array(block.split(), dtype=np.float64)
+            counts = np.array([len(line.split()) for line in block.splitlines()])
+        except ValueError:
+            rows = [Spectrum.__parse_numbers(line) for line in data_lines]
+            values = np.array([v for r in rows for v in r])
+            counts = np.array([len(r) for r in rows])
+        counts = counts[counts > 0]
+
+        if data_format.startswith('(XY..XY)') or np.all(counts == 2):
+            # x,y pairs, or one y value per line (as written by save_jcamp)
+            x = values[0::2]
+            y = values[1::2]
+        else:
+            # several y values per line: x of the following values is given by the spacing of the data
+            starts = np.cumsum(counts) - counts
+            n_points = values.size - counts.size
+            if 'DELTAX' in labels:
+                delta_x = float(labels['DELTAX']) / x_factor
+            elif 'FIRSTX' in labels and 'LASTX' in labels:
+                delta_x = (float(labels['LASTX']) - float(labels['FIRSTX'])) / x_factor / max(n_points - 1, 1)
+            elif counts.size > 1:
+                delta_x = (values[starts[1]] - values[starts[0]]) / (counts[0] - 1)
+            else:
+                raise ValueError('x spacing of the data unknown (no DELTAX, FIRSTX, LASTX)')
+            is_x = np.zeros(values.size, dtype=bool)
+            is_x[starts] = True
+            position = np.arange(values.size) - np.repeat(starts, counts) - 1
+            x = (np.repeat(values[starts], counts) + delta_x * position)[~is_x]
+            y = values[~is_x]
+        if y.size == 0:
+            raise ValueError('no spectral data found')
+        return Spectrum(x * x_factor,
+                        y * y_factor,
                         metadata)
 
+    @staticmethod
+    def load_dpt(file):
+        """
+        Load a plain text file with x,y pairs, one per line (as written by save_dpt). Separators may be commas,
+        semicolons or blanks; lines that do not start with two numbers (e.g. column headers) are skipped.
+        The id of the spectrum is the file name.
+        :param file:
+        :return:
+        """
+        with open(file, 'r', errors='replace') as f:
+            lines = f.read().splitlines()
+        x = []
+        y = []
+        for line in lines:
+            values = re.split(r'[,;\s]+', line.strip())
+            if len(values) >= 2:
+                try:
+                    vx, vy = float(values[0]), float(values[1])
+                except ValueError:
+                    continue
+                x.append(vx)
+                y.append(vy)
+        if not x:
+            raise ValueError('no x,y values found')
+        metadata = Metadata(os.path.splitext(os.path.basename(file))[0])
+        return Spectrum(np.array(x), np.array(y), metadata)
+
+    @staticmethod
+    def load(file):
+        """
+        Load a spectrum file; the format is chosen by the file extension (see JCAMP_EXTENSIONS, DPT_EXTENSIONS)
+        """
+        ext = os.path.splitext(file)[1].lower()
+        if ext in Spectrum.JCAMP_EXTENSIONS:
+            return Spectrum.load_jcamp(file)
+        elif ext in Spectrum.DPT_EXTENSIONS:
+            return Spectrum.load_dpt(file)
+        else:
+            raise ValueError(f'unknown file extension: {ext}')
+
+
+class SpectrumStore:
+    """
+    Columnar storage of many spectra: the y values of all spectra are rows of one contiguous matrix (padded with nan,
+    as spectra may have different lengths), x values are stored once per distinct wavelength grid, and metadata are
+    __slots__ records. Behaves like a list of Spectrum objects: indexing and iteration give read-only Spectrum views
+    of the stored data (no copies); append, item assignment and del are supported.
+    """
+    def __init__(self, dtype=np.float64):
+        """
+        :param dtype: data type of the stored y values; np.float32 halves the memory, but changes the precision of
+                      Spectrum.y (and thus of exports and comparisons)
+        """
+        self.dtype = dtype
+        self.grids = []                                     # distinct x arrays
+        self.__grid_ids = {}                                # x.tobytes() -> index in grids
+        self.__y = np.full((0, 0), np.nan, dtype=dtype)     # capacity * max length
+        self.__grid = np.zeros(0, dtype=np.int32)           # grid index per spectrum
+        self.__length = np.zeros(0, dtype=np.int32)         # number of values per spectrum
+        self.metadata = []                                  # Metadata per spectrum
+        self.__n = 0
+
+    def __len__(self):
+        return self.__n
+
+    def __iter__(self):
+        for i in range(self.__n):
+            yield self[i]
+
+    def __getitem__(self, i):
+        i = self.__index(i)
+        return Spectrum.view(self.grids[self.__grid[i]], self.__y[i, :self.__length[i]], self.metadata[i])
+
+    def __setitem__(self, i, spectrum):
+        i = self.__index(i)
+        self.__store(i, spectrum)
+
+    def __delitem__(self, i):
+        self.delete([self.__index(i)])
+
+    def __index(self, i):
+        if i < 0:
+            i += self.__n
+        if not 0 <= i < self.__n:
+            raise IndexError('spectrum index out of range')
+        return i
+
+    def __grid_id(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        key = x.tobytes()
+        if key not in self.__grid_ids:
+            x = x.copy()
+            x.flags.writeable = False
+            self.__grid_ids[key] = len(self.grids)
+            self.grids.append(x)
+        return self.__grid_ids[key]
+
+    def __store(self, i, spectrum):
+        n_values = len(spectrum.y)
+        if n_values > self.__y.shape[1]:
+            # widen all rows
+            y = np.full((self.__y.shape[0], n_values), np.nan, dtype=self.dtype)
+            y[:, :self.__y.shape[1]] = self.__y
+            self.__y = y
+        self.__y[i, :n_values] = spectrum.y
+        self.__y[i, n_values:] = np.nan
+        self.__grid[i] = self.__grid_id(spectrum.x)
+        self.__length[i] = n_values
+        self.metadata[i] = spectrum.metadata
+
+    def append(self, spectrum):
+        if self.__n == self.__y.shape[0]:
+            # grow by doubling
+            capacity = max(16, 2 * self.__n)
+            y = np.full((capacity, self.__y.shape[1]), np.nan, dtype=self.dtype)
+            y[:self.__n] = self.__y[:self.__n]
+            self.__y = y
+            self.__grid = np.resize(self.__grid, capacity)
+            self.__length = np.resize(self.__length, capacity)
+        self.metadata.append(None)
+        self.__n += 1
+        self.__store(self.__n - 1, spectrum)
+
+    def delete(self, indices):
+        """
+        Remove several spectra at once; the following spectra move up
+        """
+        keep = np.ones(self.__n, dtype=bool)
+        keep[list(indices)] = False
+        n = int(keep.sum())
+        self.__y[:n] = self.__y[:self.__n][keep]
+        self.__grid[:n] = self.__grid[:self.__n][keep]
+        self.__length[:n] = self.__length[:self.__n][keep]
+        self.metadata = [m for m, k in zip(self.metadata, keep) if k]
+        self.__n = n
+
+    def y_matrix(self, indices=None):
+        """
+        :param indices: rows to return, default all
+        :return: n * max length matrix of y values, padded with nan
+        """
+        if indices is None:
+            return self.__y[:self.__n]
+        return self.__y[indices]
+
+    def grid_ids(self):
+        """
+        :return: index into grids of each spectrum
+        """
+        return self.__grid[:self.__n]
+
+    def lengths(self):
+        return self.__length[:self.__n]
+
+    def column(self, field):
+        """
+        :param field: name of a Metadata field
+        :return: np.array (dtype object) with the value of the field for each spectrum
+        """
+        column = np.empty(self.__n, dtype=object)
+        column[:] = [getattr(m, field) for m in self.metadata]
+        return column
+
+    def nbytes(self):
+        return self.__y.nbytes + self.__grid.nbytes + self.__length.nbytes + sum(g.nbytes for g in self.grids)
 
 
 class Database:
@@ -171,48 +433,233 @@ class Database:
         self.root = root
         #self.data = None
         #self.file_data = None
-        self.spectra = []
+        self.spectra = SpectrumStore()
+        self.files = []     # file of each spectrum
+        self.mtimes = []    # modification time of each file when it was loaded, see sync_from_disk
+        self.errors = []    # (file, error message) for each file that could not be loaded
+        self.__error_mtimes = {}
+        self.version = 0    # incremented whenever spectra are added, changed or removed
+        self.__results_cache = collections.OrderedDict()
+        self.__preprocessed = collections.OrderedDict()     # preprocessed spectra, see preprocessed_spectra
         self.refresh_from_disk()
 
-    def refresh_from_disk(self, new_root=''):
+    def refresh_from_disk(self, new_root='', n_jobs=0, progress=None):
+        """
+        (Re-)load all spectra files below the root directory
+        :param new_root: new root directory
+        :param n_jobs: number of worker threads; <1 means one per cpu
+        :param progress: see import_files
+        """
         if new_root:
             self.root = new_root
         if self.root:
-            self.spectra = []
-            for root, dirs, files in os.walk(self.root):
-                for f in files:
-                    base, ext = os.path.splitext(f)
-                    if ext in ['.dx', '.jdx', '.jcm']:
-                        try:
-                            spectrum = Spectrum.load_jcamp(os.path.join(root, f))
-                            self.spectra.append(spectrum)
-                        except:
-                            print(f'Error loading {os.path.join(root, f)}')
-                            pass
+            self.spectra = SpectrumStore()
+            self.files = []
+            self.mtimes = []
+            self.errors = []
+            self.__error_mtimes = {}
+            self.version += 1
+            self.import_files(Database.find_spectrum_files(self.root), n_jobs=n_jobs, progress=progress)
 
     @staticmethod
+    def find_spectrum_files(root):
+        """
+        :return: list of all files below root with an extension of a supported spectrum format
+        """
+        extensions = Spectrum.JCAMP_EXTENSIONS + Spectrum.DPT_EXTENSIONS
+        return [os.path.normpath(os.path.join(dirpath, f))
+                for dirpath, dirs, files in os.walk(root)
+                for f in files if os.path.splitext(f)[1].lower() in extensions]
+
+    @profiler.timed('Database.import_files')
+    def import_files(self, files, n_jobs=0, progress=None, batch_size=64):
+        """
+        Load spectra files and add them to the database. Files are parsed in batches, on multiple threads; only a few
+        batches are in flight at a time. Files that cannot be loaded are collected in self.errors.
+        :param files: list of files
+        :param n_jobs: number of worker threads; <1 means one per cpu
+        :param progress: optional callable(n_done, n_total), called after each batch; loading is cancelled
+                         if it returns False
+        :param batch_size: number of files per batch
+        :return: number of spectra added
+        """
+        if n_jobs < 1:
+            n_jobs = os.cpu_count() or 1
+        batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+
+        def load_batch(batch):
+            results = []
+            for file in batch:
+                mtime = None
+                try:
+                    mtime = os.stat(file).st_mtime_ns
+                    results.append((file, mtime, Spectrum.load(file), None))
+                except Exception as e:
+                    results.append((file, mtime, None, f'{type(e).__name__}: {e}'))
+            return results
+
+        n_added = 0
+        n_done = 0
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            pending = collections.deque()
+            next_batch = 0
+            while next_batch < len(batches) or pending:
+                while next_batch < len(batches) and len(pending) < 2 * n_jobs:
+                    pending.append(executor.submit(load_batch, batches[next_batch]))
+                    next_batch += 1
+                # results are added in order of the files
+                for file, mtime, spectrum, error in pending.popleft().result():
+                    if spectrum is None:
+                        self.errors.append((file, error))
+                        self.__error_mtimes[file] = mtime
+                    else:
+                        self.spectra.append(spectrum)
+                        self.files.append(file)
+                        self.mtimes.append(mtime)
+                        n_added += 1
+                    n_done += 1
+                if progress is not None and progress(n_done, len(files)) is False:
+                    for future in pending:
+                        future.cancel()
+                    break
+        if n_added:
+            self.version += 1
+        return n_added
+
+    def add_file(self, file):
+        """
+        Load a single (new or changed) file, e.g. after a spectrum was exported into the database directory
+        :return: index of the spectrum, or None if the file could not be loaded
+        """
+        file = os.path.normpath(file)
+        index = self.files.index(file) if file in self.files else None
+        self.errors = [(f, e) for f, e in self.errors if f != file]
+        mtime = None
+        try:
+            mtime = os.stat(file).st_mtime_ns
+            spectrum = Spectrum.load(file)
+        except Exception as e:
+            self.errors.append((file, f'{type(e).__name__}: {e}'))
+            self.__error_mtimes[file] = mtime
+            return None
+        if index is None:
+            self.spectra.append(spectrum)
+            self.files.append(file)
+            self.mtimes.append(mtime)
+            index = len(self.spectra) - 1
+        else:
+            self.spectra[index] = spectrum
+            self.mtimes[index] = mtime
+        self.version += 1
+        return index
+
+    def remove_indices(self, indices):
+        """
+        Remove spectra from the database (not from disk). Indices of the following spectra shift accordingly.
+        """
+        indices = set(indices)
+        if not indices:
+            return
+        self.spectra.delete(indices)
+        self.files = [f for i, f in enumerate(self.files) if i not in indices]
+        self.mtimes = [m for i, m in enumerate(self.mtimes) if i not in indices]
+        self.version += 1
+
+    @profiler.timed('Database.sync_from_disk')
+    def sync_from_disk(self, n_jobs=0):
+        """
+        Bring the database up to date with the files below the root directory: only new and modified files
+        (by modification time) are loaded, spectra of deleted files are removed. Files that could not be loaded
+        before are only tried again if they were modified.
+        :param n_jobs: number of worker threads for loading; <1 means one per cpu
+        :return: (added, updated, removed): indices of new spectra, indices of reloaded spectra (after the update),
+                 indices of removed spectra (before the update)
+        """
+        if not self.root:
+            return [], [], []
+        on_disk = {}
+        for f in Database.find_spectrum_files(self.root):
+            try:
+                on_disk[f] = os.stat(f).st_mtime_ns
+            except OSError:
+                pass  # deleted in the meantime
+
+        # reload modified files; if that fails, the spectrum is removed
+        removed = [i for i, f in enumerate(self.files) if f not in on_disk]
+        updated = []
+        for i, f in enumerate(self.files):
+            if f in on_disk and on_disk[f] != self.mtimes[i]:
+                if self.add_file(f) is None:
+                    removed.append(i)
+                else:
+                    updated.append(i)
+        removed.sort()
+        self.remove_indices(removed)
+        updated = [i - sum(r < i for r in removed) for i in updated]
+
+        known = set(self.files)
+        new_files = [f for f, mtime in on_disk.items()
+                     if f not in known and self.__error_mtimes.get(f) != mtime]
+        self.errors = [(f, e) for f, e in self.errors if f in on_disk and f not in new_files]
+        n_before = len(self.spectra)
+        self.import_files(new_files, n_jobs=n_jobs)
+        return list(range(n_before, len(self.spectra))), updated, removed
+
+    def error_report(self):
+        """
+        :return: text with one line per file that could not be loaded
+        """
+        return '\n'.join(f'{file}: {error}' for file, error in self.errors)
+
+    # available comparison metrics and their display names. all of them are distances (0 == identical)
+    METRICS = collections.OrderedDict([('error', 'mean err'),
+                                       ('sam', 'spectral angle'),
+                                       ('correlation', '1-correlation'),
+                                       ('euclidean', 'norm. euclidean')])
+
+    @staticmethod
+    @profiler.timed('Database.compare_spectra')
     def compare_spectra(x1, y1,
                         x2, y2,
                         custom_range=None,
                         use_gradient=False,
-                        squared_errs=True):
+                        squared_errs=True,
+                        metric='error',
+                        preprocessing=None,
+                        pixel_stats=None):
         """
         compares 2 spectra
         :param x1: np.array, wavelength array of spectrum 1
-        :param y1: np.array, intensity array of spectrum 1 - can be 1d (simple spectrum) or 3d (cube)
+        :param y1: np.array, intensity array of spectrum 1 - can be 1d (simple spectrum), 2d (n spectra) or 3d (cube)
         :param x2: np.array, wavelength array of spectrum 2
-        :param y2: np.array, intensity array of spectrum 2 - must be 1d, is re-sampled if required
+        :param y2: np.array, intensity array of spectrum 2 - must be 1d, is resampled to the compared wavelengths of
+                   spectrum 1 if required (see hyper.resampling_matrix)
         :param custom_range: (x_min, x_max), a custom range of wavelengths used for comparison
         :param use_gradient: compare gradients instead of absolute differences
-        :param squared_errs: use squared differences (or absolute differences)
-        :return: mean error/distance; scalar or 2d np.array, depending on shape of y1
+        :param squared_errs: use squared differences (or absolute differences); only used with metric 'error'
+        :param metric: one of Database.METRICS:
+                       'error' - mean squared/absolute error
+                       'sam' - spectral angle in radians
+                       'correlation' - 1 - pearson correlation coefficient
+                       'euclidean' - euclidean distance of the spectra normalized to unit length
+        :param preprocessing: hyper.Preprocessing applied to both spectra before comparing them; cubes are
+                              preprocessed once per parameter set (see Preprocessing.apply_cube)
+        :param pixel_stats: optional dict owned by the caller, in which the per-pixel sums of y1 needed by the scale
+                            invariant metrics are kept (per compared range and settings), such that repeated
+                            comparisons with the same y1 cost one matrix-vector product. It has to be cleared
+                            whenever y1 changes.
+        :return: mean error/distance; scalar, 1d or 2d np.array, depending on shape of y1
         """
-        x1 = np.array(x1)
-        x2 = np.array(x2)
-        y1 = np.array(y1)
-        y2 = np.array(y2)
+        x1 = np.asarray(x1)
+        x2 = np.asarray(x2)
+        y1 = np.asarray(y1)
+        y2 = np.asarray(y2)
+
+        if preprocessing is not None and not preprocessing.is_identity():
+            x1, y1 = preprocessing.apply_cube(x1, y1) if y1.ndim == 3 else preprocessing.apply(x1, y1)
+            x2, y2 = preprocessing.apply(x2, y2)
 
-        is_cube = len(y1.shape) == 3
+        is_multi = y1.ndim > 1
 
         lambda_min = max(x1[0], x2[0])
         lambda_max = min(x1[-1], x2[-1])
@@ -221,24 +668,29 @@ class Database:
             lambda_max = min(lambda_max, custom_range[1])
 
         mask1 = np.logical_and(x1 >= lambda_min, x1 <= lambda_max)
-        if is_cube:
-            y1_masked = y1[:, :, mask1]
-        else:
-            y1_masked = y1[mask1]
-
         mask2 = np.logical_and(x2 >= lambda_min, x2 <= lambda_max)
-        y2_masked = y2[mask2]
 
-        if y1_masked.size < 2 > y2_masked.size:
+        if mask1.sum() < 2 or mask2.sum() < 2:
             print('WARNING: compared spectra do not have sufficient overlap. Returning None')
             return None
 
-        if not np.array_equal(x1[mask1], x2[mask2]):
-            y2_masked = resample(y2_masked, mask1.sum())
+        # wavelengths are sorted, so the mask is a contiguous range. slicing gives a view instead of a copy of the cube
+        idx1 = np.flatnonzero(mask1)
+        y1_masked = y1[..., idx1[0]:idx1[-1] + 1]
+
+        if np.array_equal(x1[mask1], x2[mask2]):
+            y2_masked = y2[mask2]
+        else:
+            # at the actual wavelengths; the (cached) matrix depends on both grids and the compared range
+            y2_masked = resampling_matrix(x2, x1[mask1]) @ y2
+
+        if metric != 'error':
+            stats_key = (idx1[0], idx1[-1], use_gradient, preprocessing.key() if preprocessing is not None else None)
+            return Database.__normalized_distance(y1_masked, y2_masked, metric, use_gradient, pixel_stats, stats_key)
 
         if use_gradient:
-            if is_cube:
-                errs = np.gradient(y1_masked, axis=2) - np.gradient(y2_masked)
+            if is_multi:
+                errs = np.gradient(y1_masked, axis=-1) - np.gradient(y2_masked)
             else:
                 errs = np.gradient(y1_masked) - np.gradient(y2_masked)
         else:
@@ -249,31 +701,289 @@ class Database:
         else:
             errs = np.abs(errs)
 
-        if is_cube:
-            return np.mean(errs, axis=2)
+        if is_multi:
+            return np.mean(errs, axis=-1)
         else:
             return np.mean(errs)
 
+    @staticmethod
+    def __normalized_distance(y, q, metric, use_gradient, pixel_stats=None, stats_key=None):
+        """
+        scale invariant distances, computed from a single matrix-vector product and per-pixel norms
+        :param y: np.array, 1d spectrum, 2d spectra or 3d cube, already masked to the compared bands
+        :param q: np.array, 1d query spectrum on the same bands as y
+        :param metric: 'sam', 'correlation' or 'euclidean'
+        :param use_gradient: compare gradients instead of values
+        :param pixel_stats: dict of the caller, the per-pixel stats of y are kept there under stats_key
+        :return: scalar, 1d or 2d np.array, depending on shape of y
+        """
+        if metric not in Database.METRICS:
+            raise ValueError(f'unknown metric: {metric}')
+        n = y.shape[-1]
+        if pixel_stats is None:
+            sums, sumsq = Database.__pixel_stats(y, use_gradient)
+        else:
+            if stats_key not in pixel_stats:
+                pixel_stats[stats_key] = Database.__pixel_stats(y, use_gradient)
+            sums, sumsq = pixel_stats[stats_key]
+        if use_gradient:
+            q = np.gradient(q)
+        if metric == 'correlation':
+            # <y - mean(y), q - mean(q)> == <y, q - mean(q)>, so only the query has to be centered
+            q = q - np.mean(q)
+            norm_y = np.sqrt(np.maximum(sumsq - sums ** 2 / n, 0))
+        else:
+            norm_y = np.sqrt(sumsq)
+        norm_q = np.sqrt(np.dot(q, q))
+        if use_gradient:
+            # the gradient is linear: <D y, q> == <y, D^T q>, so the cube never has to be differentiated here
+            q = Database.__gradient_operator(n).T @ q
+        dot = np.matmul(y, q.astype(y.dtype))
+        cos = np.clip(dot / np.maximum(norm_y * norm_q, np.finfo(np.float32).tiny), -1, 1)
+        if metric == 'sam':
+            return np.arccos(cos)
+        elif metric == 'correlation':
+            return 1 - cos
+        else:
+            return np.sqrt(2 - 2 * cos)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def __gradient_operator(n):
+        """
+        :return: n*n sparse matrix D with D @ y == np.gradient(y) (central differences, one-sided at the ends); cached
+        """
+        operator = sparse.diags([np.full(n - 1, -0.5), np.full(n - 1, 0.5)], [-1, 1], shape=(n, n), format='lil')
+        operator[0, :2] = [-1, 1]
+        operator[n - 1, n - 2:] = [-1, 1]
+        return operator.tocsr()
+
+    @staticmethod
+    def __pixel_stats(y, use_gradient):
+        """
+        per-pixel sum and sum of squares of y (or its gradient)
+        :param y: np.array, 1d spectrum, 2d spectra or 3d cube
+        :param use_gradient: compute the stats of the gradient of y
+        :return: (sums, sums of squares), scalars or np.arrays
+        """
+        g = np.gradient(y, axis=-1) if use_gradient else y
+        return np.sum(g, axis=-1), np.einsum('...k,...k->...', g, g)
+
+    def filter(self, **fields):
+        """
+        Select spectra by metadata, e.g. db.filter(source_object='bull', intensity='dark')
+        :param fields: Metadata field names and values; a value may also be a list of accepted values
+        :return: np.array of indices of the matching spectra
+        """
+        selected = np.ones(len(self.spectra), dtype=bool)
+        for field, value in fields.items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            selected &= np.isin(self.spectra.column(field), list(values))
+        return np.flatnonzero(selected)
+
+    @profiler.timed('Database.compare_all')
+    def compare_all(self,
+                    x_query,
+                    y_query,
+                    indices=None,
+                    custom_range=None,
+                    use_gradient=False,
+                    squared_errs=True,
+                    metric='error',
+                    preprocessing=None):
+        """
+        Compare a query spectrum to many database spectra, see compare_spectra. Spectra on the same wavelength grid
+        as the query are compared all at once, as a matrix.
+        :param indices: indices of the database spectra, default all
+        :param preprocessing: hyper.Preprocessing; the database spectra are preprocessed once and kept (see
+                              preprocessed_spectra), only the query is preprocessed per call
+        :return: np.array of errors per spectrum; nan where the spectra do not overlap
+        """
+        spectra = self.preprocessed_spectra(preprocessing)
+        if spectra is not self.spectra:
+            x_query, y_query = preprocessing.apply(x_query, y_query)
+        x_query = np.asarray(x_query)
+        y_query = np.asarray(y_query)
+        indices = np.arange(len(spectra)) if indices is None else np.asarray(indices, dtype=int)
+        errors = np.full(indices.size, np.nan)
+        grid_ids = spectra.grid_ids()[indices]
+        for grid_id in np.unique(grid_ids):
+            members = np.flatnonzero(grid_ids == grid_id)
+            x = spectra.grids[grid_id]
+            if x.shape == x_query.shape and np.allclose(x, x_query, rtol=1e-6, atol=0):
+                # same grid (up to float32 precision of stored files): rows of the y matrix are compared like
+                # pixels of a cube
+                y = spectra.y_matrix(indices[members])[np.newaxis, :, :x.size]
+                error = Database.compare_spectra(x, y, x_query, y_query,
+                                                 custom_range=custom_range,
+                                                 use_gradient=use_gradient,
+                                                 squared_errs=squared_errs,
+                                                 metric=metric)
+                if error is not None:
+                    errors[members] = error[0]
+            else:
+                # other grid: all spectra are resampled to the compared wavelengths of the query at once (one sparse
+                # matrix product), then compared like spectra on the same grid. all distances are symmetric.
+                lambda_min = max(x[0], x_query[0])
+                lambda_max = min(x[-1], x_query[-1])
+                if custom_range is not None:
+                    lambda_min = max(lambda_min, custom_range[0])
+                    lambda_max = min(lambda_max, custom_range[1])
+                mask_query = (x_query >= lambda_min) & (x_query <= lambda_max)
+                if mask_query.sum() < 2 or np.count_nonzero((x >= lambda_min) & (x <= lambda_max)) < 2:
+                    continue
+                x_compared = x_query[mask_query]
+                y = resampling_matrix(x, x_compared) @ spectra.y_matrix(indices[members])[:, :x.size].T
+                error = Database.compare_spectra(x_compared, y.T[np.newaxis], x_compared, y_query[mask_query],
+                                                 use_gradient=use_gradient,
+                                                 squared_errs=squared_errs,
+                                                 metric=metric)
+                if error is not None:
+                    errors[members] = error[0]
+        return errors
+
+    # number of preprocessed copies of the database that are kept (one per preprocessing parameter set)
+    preprocessed_cache_size = 2
+
+    @profiler.timed('Database.preprocessed_spectra')
+    def preprocessed_spectra(self, preprocessing):
+        """
+        The database spectra after preprocessing. They are computed once per database version and parameter set,
+        all spectra on the same wavelength grid at once.
+        :param preprocessing: hyper.Preprocessing or None
+        :return: SpectrumStore (self.spectra if there is nothing to do)
+        """
+        if preprocessing is None or preprocessing.is_identity():
+            return self.spectra
+        key = (self.version, preprocessing.key())
+        cache = self.__preprocessed
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        processed = [None] * len(self.spectra)
+        grid_ids = self.spectra.grid_ids()
+        for grid_id in np.unique(grid_ids):
+            members = np.flatnonzero(grid_ids == grid_id)
+            x = self.spectra.grids[grid_id]
+            x_processed, y_processed = preprocessing.apply(x, self.spectra.y_matrix(members)[:, :x.size])
+            for m, y in zip(members, y_processed):
+                processed[m] = Spectrum(x_processed, y, self.spectra.metadata[m])
+        store = SpectrumStore(dtype=self.spectra.dtype)
+        for spectrum in processed:
+            store.append(spectrum)
+        cache[key] = store
+        for k in [k for k in cache if k[0] != self.version]:
+            del cache[k]
+        while len(cache) > Database.preprocessed_cache_size:
+            cache.popitem(last=False)
+        return store
+
+    # number of memoized search/comparison results
+    results_cache_size = 32
+
+    def __cached(self, key, compute):
+        """
+        Memoized results of searches and comparisons. Keys include the database version, so any change of the
+        spectra invalidates them.
+        """
+        key = (self.version,) + key
+        cache = self.__results_cache
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        result = compute()
+        cache[key] = result
+        while len(cache) > Database.results_cache_size:
+            cache.popitem(last=False)
+        return result
+
+    def clear_results_cache(self):
+        """
+        Forget all memoized search and comparison results (e.g. to measure the actual cost of a search)
+        """
+        self.__results_cache.clear()
+
+    @staticmethod
+    def __query_key(x_query, y_query, custom_range, use_gradient, squared_errs, metric, preprocessing):
+        digest = hashlib.blake2b(np.ascontiguousarray(x_query, dtype=np.float64).tobytes(), digest_size=16)
+        digest.update(np.ascontiguousarray(y_query, dtype=np.float64).tobytes())
+        return (digest.hexdigest(),
+                None if custom_range is None else tuple(custom_range),
+                use_gradient,
+                squared_errs if metric == 'error' else None,  # only the error metric depends on it
+                metric,
+                None if preprocessing is None or preprocessing.is_identity() else preprocessing.key())
+
+    def compare_to(self,
+                   index,
+                   x_query,
+                   y_query,
+                   custom_range=None,
+                   use_gradient=False,
+                   squared_errs=True,
+                   metric='error',
+                   preprocessing=None):
+        """
+        Memoized compare_spectra of a query and a database spectrum
+        :param index: index of the database spectrum
+        :param preprocessing: hyper.Preprocessing, see compare_all
+        :return: error, or None if the spectra do not overlap
+        """
+        def compare():
+            spectra = self.preprocessed_spectra(preprocessing)
+            x, y = (x_query, y_query) if spectra is self.spectra else preprocessing.apply(x_query, y_query)
+            reference = spectra[index]
+            return Database.compare_spectra(x, y, reference.x, reference.y,
+                                            custom_range=custom_range,
+                                            use_gradient=use_gradient,
+                                            squared_errs=squared_errs,
+                                            metric=metric)
+        key = ('compare', index) + Database.__query_key(x_query, y_query, custom_range, use_gradient,
+                                                         squared_errs, metric, preprocessing)
+        return self.__cached(key, compare)
+
+    @profiler.timed('Database.search_spectrum')
     def search_spectrum(self,
                         x_query,
                         y_query,
                         custom_range=None,
                         use_gradient=False,
-                        squared_errs=True):
-        results = []
-        for db_spectrum in self.spectra:
-            error = Database.compare_spectra(x_query,
-                                             y_query,
-                                             db_spectrum.x,
-                                             db_spectrum.y,
-                                             custom_range=custom_range,
-                                             use_gradient=use_gradient,
-                                             squared_errs=squared_errs)
-            if error is not None:
-                results.append({'error': error,
-                                'spectrum': db_spectrum})
-        results.sort(key=lambda v: v['error'])
-        return results
+                        squared_errs=True,
+                        metric='error',
+                        indices=None,
+                        k=0,
+                        preprocessing=None):
+        """
+        Find the database spectra most similar to a query. Results are memoized (see results_cache_size), so repeated
+        searches with equal query and parameters cost nothing; each call returns a new list.
+        :param indices: search only these spectra (e.g. from filter), default all
+        :param k: number of results; <1 means all
+        :param preprocessing: hyper.Preprocessing, see compare_all
+        :return: list of {'error', 'spectrum', 'index'}, sorted by error; the spectra are not preprocessed
+        """
+        def search():
+            search_indices = np.arange(len(self.spectra)) if indices is None else np.asarray(indices, dtype=int)
+            errors = self.compare_all(x_query, y_query, search_indices,
+                                      custom_range=custom_range,
+                                      use_gradient=use_gradient,
+                                      squared_errs=squared_errs,
+                                      metric=metric,
+                                      preprocessing=preprocessing)
+            valid = np.flatnonzero(~np.isnan(errors))
+            if 0 < k < valid.size:
+                # only the k best have to be sorted
+                valid = valid[np.argpartition(errors[valid], k - 1)[:k]]
+                valid.sort()  # equal errors stay in database order
+            order = valid[np.argsort(errors[valid], kind='stable')]
+            return [{'error': errors[i],
+                     'spectrum': self.spectra[search_indices[i]],
+                     'index': int(search_indices[i])}
+                    for i in order]
+
+        key = ('search', None if indices is None else np.asarray(indices).tobytes(), max(k, 0)) + \
+            Database.__query_key(x_query, y_query, custom_range, use_gradient, squared_errs, metric, preprocessing)
+        # copies, such that callers can sort, trim or annotate the results without changing the memoized ones
+        return [dict(result) for result in self.__cached(key, search)]
 
     @staticmethod
     def export_spectrum(file_spectrum,
@@ -296,4 +1006,41 @@ class Database:
                   '.dpt, .txt (plain comma-separated x,y values), .dx, .jdx, .jcm (JCAMP-DX)')
             return False
 
+    @staticmethod
+    @profiler.timed('Database.export_spectra')
+    def export_spectra(files, spectra, images=None, n_jobs=0):
+        """
+        Export many spectra at once (see export_spectrum). Directories are created once, up front; file contents are
+        rendered in memory and written with a single write per file, on multiple threads.
+        :param files: list of target files (.jdx/.dx/.jcm or .dpt/.txt/.csv)
+        :param spectra: list of Spectrum
+        :param images: optional list of images (np.array or None), saved as .png next to the spectra
+        :param n_jobs: number of worker threads; <1 means one per cpu
+        :return: list of the files that were written
+        """
+        if images is None:
+            images = [None] * len(files)
+        for directory in {os.path.dirname(f) for f in files}:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        def export(item):
+            file, spectrum, image = item
+            ext = os.path.splitext(file)[1]
+            if ext in ['.dx', '.jdx', '.jcm']:
+                text = spectrum.jcamp_text()
+            elif ext in ['.dpt', '.txt', '.csv']:
+                text = spectrum.dpt_text()
+            else:
+                print(f'WARNING: invalid file extension, spectrum not saved: {file}')
+                return None
+            with open(file, 'w') as f:
+                f.write(text)
+            if image is not None:
+                matplotlib.image.imsave(os.path.splitext(file)[0] + '.png', image)
+            return file
+
+        with ThreadPoolExecutor(max_workers=n_jobs if n_jobs > 0 else None) as executor:
+            return [f for f in executor.map(export, zip(files, spectra, images)) if f is not None]
+
 
@@ -0,0 +1,276 @@
+import os
+import mmap
+import numpy as np
+import spectral
+
+
+class EnviWriter:
+    """
+    Streaming writer for ENVI images. The data file is allocated on disk up front and filled chunk by chunk (blocks
+    of rows or single bands) through a memory map, so the full cube never has to be held in memory.
+    The data is flushed to the file (once; the OS writes pages back while writing anyway) and the .hdr file is written
+    when the writer is closed.
+
+    Which interleave to choose depends on how the file is read later:
+    'bsq' - bands are contiguous: fast for viewing single layers
+    'bip' - pixel spectra are contiguous: fast for spectra and per-pixel analyses
+    'bil' - lines of each band are contiguous (as written by SpecimIQ): a compromise
+    """
+
+    INTERLEAVES = ['bsq', 'bil', 'bip']
+
+    def __init__(self, file_header, nrows, ncols, nbands, dtype=np.float32, interleave='bsq', ext='.img',
+                 metadata=None):
+        """
+        :param file_header: target .hdr file; the data file is stored next to it, with extension ext
+        :param nrows: number of rows (lines)
+        :param ncols: number of columns (samples)
+        :param nbands: number of bands
+        :param dtype: data type of the stored values
+        :param interleave: 'bsq', 'bil' or 'bip'
+        :param ext: extension of the data file
+        :param metadata: dict of additional header entries (e.g. 'wavelength', 'band names', 'default bands')
+        """
+        interleave = interleave.lower()
+        if interleave not in EnviWriter.INTERLEAVES:
+            raise ValueError(f'unknown interleave: {interleave}')
+        self.file_header = file_header
+        self.file_data = os.path.splitext(file_header)[0] + ext
+        self.shape = (nrows, ncols, nbands)
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.interleave = interleave
+        self.metadata = dict(metadata) if metadata is not None else {}
+
+        # layout of the file, and a view on it in the usual rows*cols*bands order
+        if interleave == 'bsq':
+            file_shape, axes = (nbands, nrows, ncols), (1, 2, 0)
+        elif interleave == 'bil':
+            file_shape, axes = (nrows, nbands, ncols), (0, 2, 1)
+        else:
+            file_shape, axes = (nrows, ncols, nbands), (0, 1, 2)
+        self.__memmap = np.memmap(self.file_data, dtype=self.dtype, mode='w+', shape=file_shape)
+        self.data = self.__memmap.transpose(axes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_rows(self, row, data):
+        """
+        Write a block of rows
+        :param row: index of the first row of the block
+        :param data: n*c*b np.array
+        """
+        self.data[row:row + data.shape[0]] = data
+
+    def write_band(self, band, data):
+        """
+        Write a single band
+        :param band: index of the band
+        :param data: r*c np.array
+        """
+        self.data[:, :, band] = data
+
+    def close(self):
+        if self.__memmap is None:
+            return
+        self.__memmap.flush()
+        self.__memmap = None
+        self.data = None
+        header = {'description': 'written by Hyperlyse',
+                  'samples': self.shape[1],
+                  'lines': self.shape[0],
+                  'bands': self.shape[2],
+                  'header offset': 0,
+                  'file type': 'ENVI Standard',
+                  'data type': spectral.io.envi.dtype_to_envi[self.dtype.char],
+                  'interleave': self.interleave,
+                  'byte order': 0}
+        header.update(self.metadata)
+        spectral.io.envi.write_envi_header(self.file_header, header)
+
+
+class EnviReader:
+    """
+    Interleave-aware, memory-mapped access to the raw data of an ENVI image.
+    Pixel spectra, band images and region means are read in the order of the file layout, in blocks of contiguous
+    data, and the OS is told in advance which parts of the file are needed (readahead), such that e.g. a band image
+    of a BSQ file is a single sequential read, and a pixel spectrum of a BIL file is a single line read.
+    """
+
+    def __init__(self, file_header, file_data, chunk_size=2 ** 24):
+        """
+        :param file_header: .hdr file
+        :param file_data: data file
+        :param chunk_size: maximum number of bytes read at once when scanning the file (band images of BIP/BIL
+                           files, region means)
+        """
+        header = spectral.io.envi.read_envi_header(file_header)
+        self.file_data = file_data
+        self.interleave = header.get('interleave', 'bsq').lower()
+        if self.interleave not in EnviWriter.INTERLEAVES:
+            raise ValueError(f'unknown interleave: {self.interleave}')
+        self.nrows = int(header['lines'])
+        self.ncols = int(header['samples'])
+        self.nbands = int(header['bands'])
+        self.shape = (self.nrows, self.ncols, self.nbands)
+        self.dtype = np.dtype(spectral.io.envi.envi_to_dtype[header['data type']])
+        self.dtype = self.dtype.newbyteorder('>' if int(header.get('byte order', 0)) == 1 else '<')
+        self.offset = int(header.get('header offset', 0))
+        self.chunk_size = chunk_size
+
+        with open(file_data, 'rb') as f:
+            self.__mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.interleave == 'bsq':
+            file_shape = (self.nbands, self.nrows, self.ncols)
+        elif self.interleave == 'bil':
+            file_shape = (self.nrows, self.nbands, self.ncols)
+        else:
+            file_shape = (self.nrows, self.ncols, self.nbands)
+        # the file as it is laid out on disk
+        self.raw = np.frombuffer(self.__mmap, dtype=self.dtype, count=int(np.prod(file_shape)),
+                                 offset=self.offset).reshape(file_shape)
+
+    def close(self):
+        self.raw = None
+        self.__mmap.close()
+
+    def __advise(self, start, end, sequential=False):
+        """
+        Announce that the bytes start..end (relative to the data) will be read soon
+        """
+        if not hasattr(self.__mmap, 'madvise'):
+            return  # not available on windows
+        start += self.offset
+        end += self.offset
+        aligned_start = start - start % mmap.PAGESIZE
+        length = min(end, len(self.__mmap)) - aligned_start
+        if length > 0:
+            self.__mmap.madvise(mmap.MADV_SEQUENTIAL if sequential else mmap.MADV_WILLNEED, aligned_start, length)
+
+    def __row_bytes(self):
+        return self.ncols * self.nbands * self.dtype.itemsize
+
+    def __rows_per_chunk(self):
+        return max(1, self.chunk_size // self.__row_bytes())
+
+    def pixel(self, row, col):
+        """
+        :return: spectrum of a single pixel, np.array of nbands values
+        """
+        if self.interleave == 'bip':
+            # one contiguous run, usually within a page
+            return np.array(self.raw[row, col, :])
+        elif self.interleave == 'bil':
+            # one line (all bands of the row)
+            start = row * self.__row_bytes()
+            self.__advise(start, start + self.__row_bytes())
+            return np.array(self.raw[row, :, col])
+        else:
+            # one value per band, nothing to gain from readahead
+            return np.array(self.raw[:, row, col])
+
+    def pixels(self, rows, cols):
+        """
+        Spectra of many pixels, gathered in the order of the file layout (pass the pixels sorted by row and column,
+        e.g. from PixelSampler.sample_indices, to read the file front to back)
+        :param rows: np.array of row indices
+        :param cols: np.array of column indices (same length)
+        :return: n*nbands np.array
+        """
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        if self.interleave == 'bip':
+            return self.raw[rows, cols, :]
+        elif self.interleave == 'bil':
+            return self.raw[rows, :, cols]
+        else:
+            # band by band
+            return np.ascontiguousarray(self.raw[:, rows, cols].T)
+
+    def band(self, band):
+        """
+        :return: image of a single band, nrows*ncols np.array
+        """
+        item = self.dtype.itemsize
+        if self.interleave == 'bsq':
+            # one contiguous run
+            start = band * self.nrows * self.ncols * item
+            self.__advise(start, start + self.nrows * self.ncols * item, sequential=True)
+            return np.array(self.raw[band])
+        # bil: one short run per line; bip: the band is spread over the whole file. In both cases, the file is
+        # scanned once, front to back, in chunks of rows
+        result = np.empty((self.nrows, self.ncols), dtype=self.dtype)
+        self.__advise(0, self.nrows * self.__row_bytes(), sequential=True)
+        step = self.__rows_per_chunk()
+        for r in range(0, self.nrows, step):
+            if self.interleave == 'bil':
+                result[r:r + step] = self.raw[r:r + step, band, :]
+            else:
+                result[r:r + step] = self.raw[r:r + step, :, band]
+        return result
+
+    def rows(self, row_start, row_end):
+        """
+        :return: all pixels of a block of rows, (row_end-row_start)*ncols*nbands np.array
+        """
+        return self.roi((row_start, row_end), (0, self.ncols))
+
+    def roi(self, rows, cols):
+        """
+        :param rows: (start, end) rows
+        :param cols: (start, end) columns
+        :return: all pixels of a rectangle, r*c*nbands np.array
+        """
+        (r0, r1), (c0, c1) = rows, cols
+        result = np.empty((r1 - r0, c1 - c0, self.nbands), dtype=self.dtype)
+        if self.interleave == 'bsq':
+            # band by band, the rows of the rectangle
+            result[:] = self.raw[:, r0:r1, c0:c1].transpose(1, 2, 0)
+        else:
+            # the lines of the rectangle are a contiguous part of the file
+            self.__advise(r0 * self.__row_bytes(), r1 * self.__row_bytes(), sequential=True)
+            step = self.__rows_per_chunk()
+            for r in range(r0, r1, step):
+                re = min(r + step, r1)
+                if self.interleave == 'bil':
+                    result[r - r0:re - r0] = self.raw[r:re, :, c0:c1].transpose(0, 2, 1)
+                else:
+                    result[r - r0:re - r0] = self.raw[r:re, c0:c1, :]
+        return result
+
+    def roi_column_means(self, rows, cols):
+        """
+        Mean over the rows of a rectangle, per column; read block by block, the rectangle is never held in memory
+        :param rows: (start, end) rows
+        :param cols: (start, end) columns
+        :return: (c1-c0)*nbands np.array (float64)
+        """
+        (r0, r1), (c0, c1) = rows, cols
+        sums = np.zeros((c1 - c0, self.nbands))
+        if self.interleave == 'bsq':
+            sums[:] = self.raw[:, r0:r1, c0:c1].sum(axis=1, dtype=np.float64).T
+        else:
+            self.__advise(r0 * self.__row_bytes(), r1 * self.__row_bytes(), sequential=True)
+            step = self.__rows_per_chunk()
+            for r in range(r0, r1, step):
+                re = min(r + step, r1)
+                if self.interleave == 'bil':
+                    sums += self.raw[r:re, :, c0:c1].sum(axis=0, dtype=np.float64).T
+                else:
+                    sums += self.raw[r:re, c0:c1, :].sum(axis=0, dtype=np.float64)
+        return sums / max(r1 - r0, 1)
+
+
+def save_envi(file_header, layers, nrows, ncols, nbands, dtype=np.float32, interleave='bsq', metadata=None):
+    """
+    Save a stack of layers that are computed one at a time (e.g. principal components)
+    :param layers: iterable of nbands r*c np.arrays
+    :return: path of the data file
+    """
+    with EnviWriter(file_header, nrows, ncols, nbands, dtype, interleave, metadata=metadata) as writer:
+        for band, layer in enumerate(layers):
+            writer.write_band(band, layer)
+    return writer.file_data
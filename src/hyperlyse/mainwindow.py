@@ -1,12 +1,14 @@
 import os
+import re
+import threading
 import numpy as np
 import numbers
-from PyQt6.QtGui import QPixmap, QImage, QGuiApplication
-from PyQt6.QtCore import Qt, QUrl, QRect, QPoint, QSize
+from PyQt6.QtGui import QPixmap, QImage, QGuiApplication, QPainter, QColor, QPen, QPolygonF, QKeySequence
+from PyQt6.QtCore import Qt, QUrl, QRect, QRectF, QPoint, QPointF, QSize, QTimer, QFileSystemWatcher
 from PyQt6.QtWidgets import QMainWindow, QFileDialog, QMessageBox, QRubberBand, QDoubleSpinBox, QRadioButton
 from PyQt6.QtWidgets import QWidget, QLabel, QCheckBox, QSlider, QPushButton, QComboBox, QSpinBox, QFrame, QLineEdit
 from PyQt6.QtWidgets import QHBoxLayout, QVBoxLayout, QGridLayout, QTabWidget, QScrollArea, QSizePolicy, QDialog
-from matplotlib import pyplot as plt
+from PyQt6.QtWidgets import QProgressDialog
 import hyperlyse as hyper
 
 hyper_quotes = ['"Hyper, hyper. We need the bass drum." - H.P. Baxxter',
@@ -25,12 +27,34 @@ class MainWindow(QMainWindow):
         # data members
         self.cube = None
         self.rgb = None
-        self.pca = None
+        self.image_pixmap = None                # rendered (scaled) image, without selection marker
+        self.pca_models = {}                    # fitted PCA models, by band range and sample seed
+        self.pca_model = None
+        self.pca_models_changed = False         # models fitted since the cache file was written
         self.error_map = None
+        self.error_map_params = {}              # parameters the current error map was computed with
         self.error_map_recompute_flag = True    # do we have to recompute the error map?
+        self.cube_pixel_stats = {}              # per-pixel norms of the cube, see Database.compare_spectra
+        self.preprocessing = hyper.Preprocessing()  # applied to all compared spectra
         self.pca_recompute_flag = True          # same for pca
+        self.unmixing = None
+        self.unmixing_recompute_flag = True     # same for unmixing
+        self.endmembers = []                    # indices of database spectra used for unmixing
+        self.clusters = None
+        self.clusters_recompute_flag = True     # same for clustering
+        self.clusters_params = {}
+        self.unmixing_params = {}
+        self.products = None                    # imported analysis results (hyper.ProductFile)
+        self.bandmath = None                    # evaluates (and caches) index expressions on the cube
+        self.index_image = None                 # result of the current index expression
+        self.index_expression = ''
         self.point_selection = None
         self.rect_selection = None
+        self.region_selection = None            # mask of the region grown from point_selection ("select similar")
+        self.region_image = None                # the region as (transparent) QImage, for the marker
+        self.roi_path = []                      # (x, y) image coordinates of the polygon/freehand path being drawn
+        self.roi_labels = None                  # label map of the collected regions (for region statistics)
+        self.roi_names = {}                     # name of each label
         self.spectrum_y = None
         self.rawfile = rawfile
 
@@ -41,7 +65,19 @@ class MainWindow(QMainWindow):
         self.drag_start_vs_v = 0
 
         self.db = hyper.Database(config.default_db_path)
-
+        # keep the database up to date with its directory: file system events (debounced) and/or polling
+        self.db_sync_timer = QTimer(self)
+        self.db_sync_timer.setSingleShot(True)
+        self.db_sync_timer.setInterval(500)
+        self.db_sync_timer.timeout.connect(self.sync_db)
+        self.db_watcher = QFileSystemWatcher(self)
+        self.db_watcher.directoryChanged.connect(self.db_sync_timer.start)
+        self.db_watcher.fileChanged.connect(self.db_sync_timer.start)
+        self.db_poll_timer = QTimer(self)
+        self.db_poll_timer.timeout.connect(self.sync_db)
+        if config.db_poll_interval > 0:
+            self.db_poll_timer.start(int(config.db_poll_interval * 1000))
+        self.watch_db_dir()
 
         self.last_source_name = ''
         self.last_export_dir = ''
@@ -69,6 +105,8 @@ class MainWindow(QMainWindow):
         self.lbl_img.mousePressEvent = self.handle_click_on_image
         self.lbl_img.mouseMoveEvent = self.handle_move_on_image
         self.lbl_img.mouseReleaseEvent = self.handle_release_on_image
+        self.lbl_img.mouseDoubleClickEvent = self.handle_double_click_on_image
+        self.lbl_img.leaveEvent = self.handle_leave_image
         self.lbl_img.setAcceptDrops(True)
         self.lbl_img.dragEnterEvent = self.handle_drag_enter
         self.lbl_img.dropEvent = self.handle_drop
@@ -109,6 +147,35 @@ class MainWindow(QMainWindow):
         self.lbl_brightness = QLabel('100%')
         layout_img_ctrl.addWidget(self.lbl_brightness, 1, 2)
 
+        # spectrum under the cursor, also without clicking
+        self.cb_hover = QCheckBox(cw)
+        self.cb_hover.setText('show spectrum under cursor')
+        self.cb_hover.stateChanged.connect(self.handle_hover_mode_changed)
+        layout_img_ctrl.addWidget(self.cb_hover, 3, 1)
+        # selection tools
+        layout_img_ctrl.addWidget(QLabel('Selection'), 4, 0)
+        layout_select_similar = QHBoxLayout()
+        self.cmb_select_tool = QComboBox(cw)
+        self.cmb_select_tool.addItem('point / rectangle', 'rect')
+        self.cmb_select_tool.addItem('polygon (double-click closes)', 'polygon')
+        self.cmb_select_tool.addItem('freehand', 'freehand')
+        self.cmb_select_tool.currentIndexChanged.connect(self.handle_select_tool_changed)
+        layout_select_similar.addWidget(self.cmb_select_tool)
+        # region growing: clicking selects the connected pixels similar to the clicked one
+        self.cb_select_similar = QCheckBox(cw)
+        self.cb_select_similar.setText('select similar (similarity settings), max. distance:')
+        layout_select_similar.addWidget(self.cb_select_similar)
+        self.sb_select_similar = QDoubleSpinBox(cw)
+        self.sb_select_similar.setDecimals(4)
+        self.sb_select_similar.setRange(0, 10)
+        self.sb_select_similar.setSingleStep(0.005)
+        self.sb_select_similar.setValue(0.05)
+        layout_select_similar.addWidget(self.sb_select_similar)
+        layout_select_similar.addStretch()
+        layout_img_ctrl.addLayout(layout_select_similar, 4, 1)
+        # mouse moves can come in much faster than spectra can be plotted: only process the latest one
+        self.preview_throttle = hyper.Throttle(self.preview_spectrum, self.config.live_update_interval, self)
+
         # content controls
         lbl_img_display = QLabel(cw)
         lbl_img_display.setText('Mode')
@@ -196,6 +263,103 @@ class MainWindow(QMainWindow):
         self.lbl_component.setText("0")
         tab_pca.layout().addWidget(self.lbl_component)
 
+        # unmixing -> index 4
+        tab_unmixing = QWidget()
+        tab_unmixing.setLayout(QHBoxLayout())
+        self.tabs_img_ctrl.addTab(tab_unmixing, 'unmixing')
+
+        self.btn_endmembers = QPushButton('Endmembers...', tab_unmixing)
+        self.btn_endmembers.pressed.connect(self.handle_action_select_endmembers)
+        tab_unmixing.layout().addWidget(self.btn_endmembers)
+
+        self.cb_sum_to_one = QCheckBox(tab_unmixing)
+        self.cb_sum_to_one.setText('sum to one')
+        self.cb_sum_to_one.stateChanged.connect(self.set_recompute_unmixing_flag)
+        self.cb_sum_to_one.stateChanged.connect(self.update_image_label)
+        tab_unmixing.layout().addWidget(self.cb_sum_to_one)
+
+        self.sl_endmember = QSlider(tab_unmixing)
+        self.sl_endmember.setOrientation(Qt.Orientation.Horizontal)
+        self.sl_endmember.valueChanged.connect(self.update_image_label)
+        self.sl_endmember.setMinimumWidth(200)
+        self.sl_endmember.setMinimum(0)
+        self.sl_endmember.setMaximum(0)
+        self.sl_endmember.setValue(0)
+        tab_unmixing.layout().addWidget(self.sl_endmember)
+
+        self.lbl_endmember = QLabel(tab_unmixing)
+        self.lbl_endmember.setText("(no endmembers)")
+        tab_unmixing.layout().addWidget(self.lbl_endmember)
+
+        # clusters -> index 5
+        tab_clusters = QWidget()
+        tab_clusters.setLayout(QHBoxLayout())
+        self.tabs_img_ctrl.addTab(tab_clusters, 'clusters')
+
+        tab_clusters.layout().addWidget(QLabel('Number of clusters:'))
+        self.sb_nclusters = QSpinBox(tab_clusters)
+        self.sb_nclusters.setMinimum(2)
+        self.sb_nclusters.setMaximum(64)
+        self.sb_nclusters.setValue(8)
+        self.sb_nclusters.valueChanged.connect(self.set_recompute_clusters_flag)
+        self.sb_nclusters.valueChanged.connect(self.update_image_label)
+        tab_clusters.layout().addWidget(self.sb_nclusters)
+
+        self.cb_clusters_pca = QCheckBox(tab_clusters)
+        self.cb_clusters_pca.setText('cluster principal components')
+        self.cb_clusters_pca.stateChanged.connect(self.set_recompute_clusters_flag)
+        self.cb_clusters_pca.stateChanged.connect(self.update_image_label)
+        tab_clusters.layout().addWidget(self.cb_clusters_pca)
+
+        self.btn_export_clusters = QPushButton('Save cluster spectra...', tab_clusters)
+        self.btn_export_clusters.pressed.connect(self.handle_action_export_cluster_spectra)
+        tab_clusters.layout().addWidget(self.btn_export_clusters)
+
+        # imported results -> index 6
+        tab_results = QWidget()
+        tab_results.setLayout(QHBoxLayout())
+        self.tabs_img_ctrl.addTab(tab_results, 'results')
+
+        self.cmb_product = QComboBox(tab_results)
+        self.cmb_product.setSizeAdjustPolicy(QComboBox.SizeAdjustPolicy.AdjustToContents)
+        self.cmb_product.currentIndexChanged.connect(self.handle_product_changed)
+        tab_results.layout().addWidget(self.cmb_product)
+
+        self.sl_product_layer = QSlider(tab_results)
+        self.sl_product_layer.setOrientation(Qt.Orientation.Horizontal)
+        self.sl_product_layer.valueChanged.connect(self.update_image_label)
+        self.sl_product_layer.setMinimumWidth(200)
+        self.sl_product_layer.setMinimum(0)
+        self.sl_product_layer.setMaximum(0)
+        tab_results.layout().addWidget(self.sl_product_layer)
+
+        self.lbl_product_layer = QLabel(tab_results)
+        self.lbl_product_layer.setText('(use File -> Open analysis results...)')
+        tab_results.layout().addWidget(self.lbl_product_layer)
+
+        # band math -> index 7
+        tab_index = QWidget()
+        tab_index.setLayout(QHBoxLayout())
+        self.tabs_img_ctrl.addTab(tab_index, 'index')
+
+        tab_index.layout().addWidget(QLabel('Expression:'))
+        self.cmb_index = QComboBox(tab_index)
+        self.cmb_index.setEditable(True)
+        self.cmb_index.setMinimumWidth(300)
+        self.cmb_index.addItems(['R(700) / R(550)',
+                                 '(R(800) - R(670)) / (R(800) + R(670))',
+                                 'depth(650, 680, 720)'])
+        self.cmb_index.setCurrentIndex(-1)
+        self.cmb_index.setToolTip('R(nm): band closest to a wavelength, R(nm, nm): mean of a wavelength range,\n'
+                                  'depth(left, center, right): band depth; + - * / ** sqrt log exp abs min max')
+        self.cmb_index.lineEdit().returnPressed.connect(self.update_image_label)
+        self.cmb_index.activated.connect(self.update_image_label)
+        tab_index.layout().addWidget(self.cmb_index)
+
+        self.lbl_index = QLabel(tab_index)
+        tab_index.layout().addWidget(self.lbl_index)
+        tab_index.layout().addStretch()
+
         # save image
         self.btn_save_img = QPushButton('Save\nImage')
         self.btn_save_img.setSizePolicy(QSizePolicy(QSizePolicy.Policy.Minimum, QSizePolicy.Policy.Minimum))
@@ -280,9 +444,21 @@ class MainWindow(QMainWindow):
         self.rs_xrange.endValueChanged.connect(self.set_recompute_errmap_flag)
         self.rs_xrange.startValueChanged.connect(self.set_recompute_pca_flag)
         self.rs_xrange.endValueChanged.connect(self.set_recompute_pca_flag)
+        self.rs_xrange.startValueChanged.connect(self.set_recompute_unmixing_flag)
+        self.rs_xrange.endValueChanged.connect(self.set_recompute_unmixing_flag)
+        self.rs_xrange.startValueChanged.connect(self.set_recompute_clusters_flag)
+        self.rs_xrange.endValueChanged.connect(self.set_recompute_clusters_flag)
 
         layout_compare_ctrl.addWidget(self.rs_xrange)
 
+        self.cmb_metric = QComboBox(self)
+        for metric, metric_name in hyper.Database.METRICS.items():
+            self.cmb_metric.addItem(metric_name, metric)
+        self.cmb_metric.currentIndexChanged.connect(self.handle_metric_changed)
+        self.cmb_metric.currentIndexChanged.connect(self.update_spectrum_plot)
+        self.cmb_metric.currentIndexChanged.connect(self.set_recompute_errmap_flag)
+        layout_compare_ctrl.addWidget(self.cmb_metric)
+
         self.cb_squared = QCheckBox(self)
         self.cb_squared.setText('squared errors')
         self.cb_squared.setChecked(True)
@@ -297,6 +473,11 @@ class MainWindow(QMainWindow):
         self.cb_gradient.stateChanged.connect(self.set_recompute_errmap_flag)
         layout_compare_ctrl.addWidget(self.cb_gradient)
 
+        self.btn_preprocessing = QPushButton('preprocessing..')
+        self.btn_preprocessing.setToolTip('preprocessing: none')
+        self.btn_preprocessing.pressed.connect(self.handle_preprocessing)
+        layout_compare_ctrl.addWidget(self.btn_preprocessing)
+
         # comparison spectra source
         lbl_source = QLabel('Source')
         lbl_source.setAlignment(Qt.AlignmentFlag.AlignTop)
@@ -367,15 +548,58 @@ class MainWindow(QMainWindow):
         action_export_spectrum = menu_file.addAction('&Save selected spectrum...')
         action_export_spectrum.triggered.connect(self.handle_action_export_spectrum)
 
+        action_batch_extract = menu_file.addAction('&Batch extract spectra...')
+        action_batch_extract.triggered.connect(self.handle_action_batch_extract)
+
+        action_export_cube = menu_file.addAction('Export &cube (ENVI)...')
+        action_export_cube.triggered.connect(self.handle_action_export_cube)
+
+        action_save_container = menu_file.addAction('Save as Hyperlyse &container...')
+        action_save_container.triggered.connect(self.handle_action_save_container)
+
+        action_export_results = menu_file.addAction('&Export analysis results...')
+        action_export_results.triggered.connect(self.handle_action_export_results)
+
+        action_import_results = menu_file.addAction('&Open analysis results...')
+        action_import_results.triggered.connect(self.handle_action_import_results)
+
+        # regions menu: collect regions, compute statistics of all of them at once
+        menu_regions = menubar.addMenu('&Regions')
+
+        action_add_region = menu_regions.addAction('&Add selection as region')
+        action_add_region.setShortcut(QKeySequence('Ctrl+R'))
+        action_add_region.triggered.connect(self.handle_action_add_region)
+
+        action_import_labels = menu_regions.addAction('&Import label map...')
+        action_import_labels.triggered.connect(self.handle_action_import_label_map)
+
+        action_cluster_regions = menu_regions.addAction('Use &clusters as regions')
+        action_cluster_regions.triggered.connect(self.handle_action_cluster_regions)
+
+        action_clear_regions = menu_regions.addAction('C&lear regions')
+        action_clear_regions.triggered.connect(self.handle_action_clear_regions)
+
+        action_region_stats = menu_regions.addAction('&Export region statistics...')
+        action_region_stats.triggered.connect(self.handle_action_export_region_statistics)
+
         # info menu
         menu_info = menubar.addMenu('&?')
         action_info = menu_info.addAction('&Show info')
         action_info.triggered.connect(self.show_info)
+        if self.config.profiling:
+            action_save_profile = menu_info.addAction('Save &profiling data...')
+            action_save_profile.triggered.connect(self.handle_action_save_profiling_data)
 
         # very important
         quote = np.random.randint(0,len(hyper_quotes))
         self.statusBar().showMessage(hyper_quotes[quote])
 
+        # timing readout
+        self.lbl_profiling = QLabel(self)
+        self.statusBar().addPermanentWidget(self.lbl_profiling)
+        if self.config.profiling and self.config.profiling_status_bar:
+            hyper.profiler.add_listener(self.show_profiling_span)
+
         # additional windows (define here for better readability only)
         self.match_point_win = None
 
@@ -395,6 +619,17 @@ class MainWindow(QMainWindow):
             self.load_data(self.rawfile)
         self.show()
 
+    def show_profiling_span(self, record):
+        # only top level operations of the ui thread; everything else is in the log/trace
+        if record['depth'] == 0 and record['thread'] == threading.main_thread().ident:
+            self.lbl_profiling.setText(hyper.Profiler.format_span(record))
+
+    def handle_action_save_profiling_data(self):
+        fileName, _ = QFileDialog.getSaveFileName(None, "Save profiling data", "hyperlyse.trace.json",
+                                                  "Chrome trace (*.trace.json);;JSON (*.json)")
+        if fileName:
+            hyper.profiler.dump(fileName)
+
     def show_info(self):
         mb = QMessageBox(QMessageBox.Icon.Information,
                          "About this software",
@@ -402,16 +637,33 @@ class MainWindow(QMainWindow):
                          QMessageBox.StandardButton.Close)
         mb.exec()
 
+    def closeEvent(self, event):
+        if self.cube is not None:
+            self.save_pca_models()
+        super().closeEvent(event)
+
     ##############
     # UI updates
     ##############
     def reset_ui(self):
         self.point_selection = None
         self.rect_selection = None
+        self.set_region_selection(None)
+        self.roi_path = []
+        self.roi_labels = None
+        self.roi_names = {}
         self.spectrum_y = None
         self.error_map = None
         self.error_map_recompute_flag = True
+        self.cube_pixel_stats = {}
         self.pca_recompute_flag = True
+        self.unmixing = None
+        self.unmixing_recompute_flag = True
+        self.clusters = None
+        self.clusters_recompute_flag = True
+        self.bandmath = hyper.BandMath(self.cube) if self.cube is not None else None
+        self.index_image = None
+        self.index_expression = ''
         self.tabs_img_ctrl.setCurrentIndex(0)
         self.sl_lambda.setValue(0)
         self.lbl_lambda.setText(self.get_lambda_slider_text(0))
@@ -430,149 +682,246 @@ class MainWindow(QMainWindow):
     def set_recompute_pca_flag(self):
         self.pca_recompute_flag = True
 
-    def update_image_label(self):
-        img = None
-        # I. get base image, depending on selected tab
-        # 0 - RGB image
-        if self.tabs_img_ctrl.currentIndex() == 0:
-            if self.rgb is not None:
-                img = self.rgb
-        # 1 - single layer
-        elif self.tabs_img_ctrl.currentIndex() == 1:
-            layer = self.sl_lambda.value()
-            if self.cube is not None:
-                if 0 <= layer < self.cube.nbands:
-                    img = self.cube.data[:, :, layer]
-                    self.lbl_lambda.setText(self.get_lambda_slider_text(layer))
-        # 2 - similarity
-        elif self.tabs_img_ctrl.currentIndex() == 2:
-            ref_x = None
-            ref_y = None
-            if self.rb_sim_cube.isChecked():
-                if self.spectrum_y is not None:
-                    ref_x = self.cube.bands
-                    ref_y = self.spectrum_y
-            elif self.cmb_comparison_ref.currentData() >= 0:
-                ref_x = self.db.spectra[self.cmb_comparison_ref.currentData()].x
-                ref_y = self.db.spectra[self.cmb_comparison_ref.currentData()].y
-            if ref_y is not None and self.cube is not None:
-                if self.error_map_recompute_flag:
-                    self.error_map_recompute_flag = False
-                    self.error_map = self.db.compare_spectra(np.array(self.cube.bands),
-                                                             self.cube.data,
-                                                             np.array(ref_x),
-                                                             ref_y,
-                                                             custom_range=(self.rs_xrange.start(), self.rs_xrange.end()),
-                                                             use_gradient=self.cb_gradient.isChecked(),
-                                                             squared_errs=self.cb_squared.isChecked())
-                err_map_t = self.error_map.copy()
-                t = (100 - self.sl_sim_t.value()) / 100 * err_map_t.max()
-                err_map_t[err_map_t > t] = t
-                img = self.visualize_error_map(err_map_t)
-
-        # 3 - PCA
-        elif self.tabs_img_ctrl.currentIndex() == 3:
-            component = self.sl_component.value()
-            if self.cube is not None:
-                if self.pca is None or self.pca_recompute_flag:
-                    self.pca_recompute_flag = False
-                    band_min = self.cube.lambda2layer(self.rs_xrange.start())
-                    band_max = self.cube.lambda2layer(self.rs_xrange.end())
-                    self.pca = hyper.principal_component_analysis(self.cube.data[:,:,band_min:band_max],
-                                                                  p_keep=0.01,
-                                                                  n_components=10)
-                if 0 <= component < self.pca.shape[2]:
-                    img = self.pca[:, :, component]
-                    img = (img - img.min()) / (img.max() - img.min())
-                    self.lbl_component.setText(f'PC {component}')
-
-        # II. if we have an image, draw the selected pixel and render it.
-        if img is not None:
-            # adjust brightness
-            img = img * self.sl_brightness.value() / 100
-            self.lbl_brightness.setText(f'{self.sl_brightness.value()}%')
-            # clip
-            img = np.clip(img, 0, 1)
-            # float to normalized 8 bit
-            img = np.uint8(img * 255)
-
-            # draw cross
-            img = self.draw_marker(img)
-
-            width = img.shape[1]
-            height = img.shape[0]
-            if len(img.shape) == 3:
-                qImg = QImage(img.tobytes(), width, height, 3 * width, QImage.Format.Format_RGB888)
-            else:
-                qImg = QImage(img.tobytes(), width, height, width, QImage.Format.Format_Grayscale8)
-
-            if qImg is not None:
-                qPixmap = QPixmap.fromImage(qImg)
-                # handle scaling
-                self.lbl_zoom.setText(f'{self.sl_zoom.value()}%')
-                scale = self.sl_zoom.value() / 100
-                qPixmap = qPixmap.scaled(int(width * scale), int(height * scale),
-                                         transformMode=Qt.TransformationMode.FastTransformation)
-                # set image
-                self.lbl_img.setPixmap(qPixmap)
-                self.lbl_img.resize(int(width * scale), int(height * scale))
+    def set_recompute_unmixing_flag(self):
+        self.unmixing_recompute_flag = True
 
-    def update_spectrum_plot(self):
+    def set_recompute_clusters_flag(self):
+        self.clusters_recompute_flag = True
 
-        self.plot.set_ranges(self.rs_xrange.start(),
-                             self.rs_xrange.end(),
-                             self.sb_ymin.value(),
-                             self.sb_ymax.value())
+    def handle_preprocessing(self):
+        dialog = hyper.PreprocessingDialog(self, self.preprocessing)
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+        self.set_preprocessing(dialog.get_data())
 
-        if self.spectrum_y is not None:
-            # spectrum selected from cube (query)
-            self.plot.plot(self.cube.bands,
-                           self.spectrum_y,
-                           label='query',
-                           hold=False)
-
-            # database spectra
-            # 0 - select
-            if self.tabs_spectra_source.currentIndex() == 0:
-                if self.db is not None:
-                    if self.cmb_comparison_ref.currentData() >= 0:
-                        reference = self.db.spectra[self.cmb_comparison_ref.currentData()]
-                        error = hyper.Database.compare_spectra(self.cube.bands,
-                                                               self.spectrum_y,
-                                                               reference.x,
-                                                               reference.y,
-                                                               custom_range=(self.rs_xrange.start(), self.rs_xrange.end()),
-                                                               use_gradient=self.cb_gradient.isChecked(),
-                                                               squared_errs=self.cb_squared.isChecked())
-                        self.plot.plot(reference.x,
-                                       reference.y,
-                                       label=f"{reference.display_string()} (mean err={error:10.3E})",
-                                       linewidth=1,
-                                       hold=True)
-            # 1 - search
-            elif self.tabs_spectra_source.currentIndex() == 1:
-                if self.sb_nspectra.value() > 0:
-                    results = self.db.search_spectrum(self.cube.bands,
-                                                      self.spectrum_y,
-                                                      custom_range=(self.rs_xrange.start(), self.rs_xrange.end()),
-                                                      use_gradient=self.cb_gradient.isChecked(),
-                                                      squared_errs=self.cb_squared.isChecked())
-                    for result in results[:self.sb_nspectra.value()]:
-                        self.plot.plot(result['spectrum'].x,
-                                       result['spectrum'].y,
-                                       label=f"{result['spectrum'].display_string()} (mean err={result['error']:10.3E})",
-                                       linewidth=1,
-                                       hold=True)
+    def set_preprocessing(self, preprocessing):
+        self.preprocessing = preprocessing
+        self.btn_preprocessing.setText('preprocessing..' if preprocessing.is_identity() else 'preprocessing*')
+        self.btn_preprocessing.setToolTip(f'preprocessing: {preprocessing.describe()}')
+        self.set_recompute_errmap_flag()
+        self.update_spectrum_plot()
+        self.update_image_label()
+
+    def handle_metric_changed(self):
+        # squared/absolute only makes sense for plain errors
+        self.cb_squared.setEnabled(self.cmb_metric.currentData() == 'error')
+
+    def update_image_label(self):
+        with hyper.profiler.span('update_image_label', tab=self.tabs_img_ctrl.currentIndex()):
+            img = None
+            # I. get base image, depending on selected tab
+            # 0 - RGB image
+            if self.tabs_img_ctrl.currentIndex() == 0:
+                if self.rgb is not None:
+                    img = self.rgb
+            # 1 - single layer
+            elif self.tabs_img_ctrl.currentIndex() == 1:
+                layer = self.sl_lambda.value()
+                if self.cube is not None:
+                    if 0 <= layer < self.cube.nbands:
+                        img = self.cube.band_image(layer)
+                        self.lbl_lambda.setText(self.get_lambda_slider_text(layer))
+            # 2 - similarity
+            elif self.tabs_img_ctrl.currentIndex() == 2:
+                ref_x = None
+                ref_y = None
+                if self.rb_sim_cube.isChecked():
+                    if self.spectrum_y is not None:
+                        ref_x = self.cube.bands
+                        ref_y = self.spectrum_y
+                elif self.cmb_comparison_ref.currentData() >= 0:
+                    ref_x = self.db.spectra[self.cmb_comparison_ref.currentData()].x
+                    ref_y = self.db.spectra[self.cmb_comparison_ref.currentData()].y
+                if ref_y is not None and self.cube is not None:
+                    if self.error_map_recompute_flag:
+                        self.error_map_recompute_flag = False
+                        self.error_map = self.db.compare_spectra(np.array(self.cube.bands),
+                                                                 self.cube.data,
+                                                                 np.array(ref_x),
+                                                                 ref_y,
+                                                                 custom_range=(self.rs_xrange.start(), self.rs_xrange.end()),
+                                                                 use_gradient=self.cb_gradient.isChecked(),
+                                                                 squared_errs=self.cb_squared.isChecked(),
+                                                                 metric=self.cmb_metric.currentData(),
+                                                                 preprocessing=self.preprocessing,
+                                                                 pixel_stats=self.cube_pixel_stats)
+                        if self.rb_sim_cube.isChecked():
+                            reference = f'{self.dataset_name()}_{self.selection_str()}'
+                        else:
+                            reference = self.cmb_comparison_ref.currentText()
+                        self.error_map_params = {'reference': reference,
+                                                 'custom_range': [self.rs_xrange.start(), self.rs_xrange.end()],
+                                                 'metric': self.cmb_metric.currentData(),
+                                                 'use_gradient': self.cb_gradient.isChecked(),
+                                                 'squared_errs': self.cb_squared.isChecked(),
+                                                 'preprocessing': self.preprocessing.to_dict()}
+                    err_map_t, _ = hyper.rendering.threshold_error_map(self.error_map, self.sl_sim_t.value())
+                    img = self.visualize_error_map(err_map_t)
+
+            # 3 - PCA
+            elif self.tabs_img_ctrl.currentIndex() == 3:
+                component = self.sl_component.value()
+                if self.cube is not None:
+                    if self.pca_model is None or self.pca_recompute_flag:
+                        self.pca_recompute_flag = False
+                        band_min = self.cube.lambda2layer(self.rs_xrange.start())
+                        band_max = self.cube.lambda2layer(self.rs_xrange.end())
+                        self.pca_model = self.get_pca_model(band_min, band_max)
+                    if 0 <= component < self.pca_model.n_components:
+                        img = hyper.rendering.normalize(self.pca_model.project(self.cube.data, component))
+                        self.lbl_component.setText(f'PC {component}')
+
+            # 4 - unmixing
+            elif self.tabs_img_ctrl.currentIndex() == 4:
+                if self.cube is not None and self.endmembers:
+                    if self.unmixing is None or self.unmixing_recompute_flag:
+                        self.unmixing_recompute_flag = False
+                        band_min = self.cube.lambda2layer(self.rs_xrange.start())
+                        band_max = self.cube.lambda2layer(self.rs_xrange.end())
+                        bands = np.array(self.cube.bands[band_min:band_max])
+                        endmembers = [hyper.resample(self.db.spectra[i].x, self.db.spectra[i].y, bands)
+                                      for i in self.endmembers]
+                        self.unmixing = hyper.linear_unmixing(self.cube.data[:, :, band_min:band_max],
+                                                              endmembers,
+                                                              sum_to_one=self.cb_sum_to_one.isChecked())
+                        self.unmixing_params = {'endmembers': [self.db.spectra[i].display_string(with_description=True)
+                                                               for i in self.endmembers],
+                                                'wavelength_range': [bands[0], bands[-1]],
+                                                'sum_to_one': self.cb_sum_to_one.isChecked()}
+                    abundances, residuals = self.unmixing
+                    endmember = self.sl_endmember.value()
+                    if 0 <= endmember < abundances.shape[2]:
+                        img = abundances[:, :, endmember]
+                        self.lbl_endmember.setText(self.db.spectra[self.endmembers[endmember]].display_string())
+                    else:
+                        # the last slider position shows how well the endmembers explain each pixel
+                        img = residuals / max(residuals.max(), np.finfo(np.float32).tiny)
+                        self.lbl_endmember.setText('residual')
+
+            # 5 - clusters
+            elif self.tabs_img_ctrl.currentIndex() == 5:
+                if self.cube is not None:
+                    labels, _ = self.get_clusters()
+                    img = hyper.rendering.visualize_labels(labels)
+
+            # 6 - imported results
+            elif self.tabs_img_ctrl.currentIndex() == 6:
+                if self.products is not None and self.cmb_product.currentData() is not None:
+                    product = self.products[self.cmb_product.currentData()]
+                    layer = self.sl_product_layer.value()
+                    img = product.read(layer)
+                    if product.kind == 'labels':
+                        img = hyper.rendering.visualize_labels(img)
+                    else:
+                        img = hyper.rendering.normalize(img)
+                    self.lbl_product_layer.setText(product.layer_name(layer))
+
+            # 7 - band math
+            elif self.tabs_img_ctrl.currentIndex() == 7:
+                expression = self.cmb_index.currentText().strip()
+                if self.bandmath is not None and expression:
+                    try:
+                        self.index_image = self.bandmath.evaluate(expression)
+                        self.index_expression = expression
+                    except ValueError as e:
+                        self.lbl_index.setText(str(e))
+                    else:
+                        if np.isnan(self.index_image).all():
+                            self.lbl_index.setText('undefined for all pixels')
+                            img = np.zeros_like(self.index_image)
+                        else:
+                            vmin, vmax = np.nanmin(self.index_image), np.nanmax(self.index_image)
+                            self.lbl_index.setText(f'{vmin:.4g} .. {vmax:.4g}')
+                            img = hyper.rendering.normalize(self.index_image, vmin, vmax)
+
+            # II. if we have an image, draw the selected pixel and render it.
+            if img is not None:
+                # adjust brightness, clip, float to normalized 8 bit
+                img = hyper.rendering.to_uint8(img, self.sl_brightness.value() / 100)
+                self.lbl_brightness.setText(f'{self.sl_brightness.value()}%')
+
+                width = img.shape[1]
+                height = img.shape[0]
+                if len(img.shape) == 3:
+                    qImg = QImage(img.tobytes(), width, height, 3 * width, QImage.Format.Format_RGB888)
+                else:
+                    qImg = QImage(img.tobytes(), width, height, width, QImage.Format.Format_Grayscale8)
+
+                if qImg is not None:
+                    qPixmap = QPixmap.fromImage(qImg)
+                    # handle scaling
+                    self.lbl_zoom.setText(f'{self.sl_zoom.value()}%')
+                    scale = self.sl_zoom.value() / 100
+                    qPixmap = qPixmap.scaled(int(width * scale), int(height * scale),
+                                             transformMode=Qt.TransformationMode.FastTransformation)
+                    # set image (with marker)
+                    self.image_pixmap = qPixmap
+                    self.update_marker()
+                    self.lbl_img.resize(int(width * scale), int(height * scale))
+
+    def update_spectrum_plot(self):
+        with hyper.profiler.span('update_spectrum_plot', source=self.tabs_spectra_source.currentIndex()):
+            self.plot.set_ranges(self.rs_xrange.start(),
+                                 self.rs_xrange.end(),
+                                 self.sb_ymin.value(),
+                                 self.sb_ymax.value())
+
+            if self.spectrum_y is not None:
+                # spectrum selected from cube (query)
+                spectra = [{'x': self.cube.bands,
+                            'y': self.spectrum_y,
+                            'label': 'query'}]
+
+                # database spectra
+                # 0 - select
+                if self.tabs_spectra_source.currentIndex() == 0:
+                    if self.db is not None:
+                        if self.cmb_comparison_ref.currentData() >= 0:
+                            reference = self.db.spectra[self.cmb_comparison_ref.currentData()]
+                            error = self.db.compare_to(self.cmb_comparison_ref.currentData(),
+                                                       self.cube.bands,
+                                                       self.spectrum_y,
+                                                       custom_range=(self.rs_xrange.start(), self.rs_xrange.end()),
+                                                       use_gradient=self.cb_gradient.isChecked(),
+                                                       squared_errs=self.cb_squared.isChecked(),
+                                                       metric=self.cmb_metric.currentData(),
+                                                       preprocessing=self.preprocessing)
+                            spectra.append({'x': reference.x,
+                                            'y': reference.y,
+                                            'label': f"{reference.display_string()} ({self.metric_name()}={error:10.3E})",
+                                            'linewidth': 1})
+                # 1 - search
+                elif self.tabs_spectra_source.currentIndex() == 1:
+                    if self.sb_nspectra.value() > 0:
+                        results = self.db.search_spectrum(self.cube.bands,
+                                                          self.spectrum_y,
+                                                          custom_range=(self.rs_xrange.start(), self.rs_xrange.end()),
+                                                          use_gradient=self.cb_gradient.isChecked(),
+                                                          squared_errs=self.cb_squared.isChecked(),
+                                                          metric=self.cmb_metric.currentData(),
+                                                          k=self.sb_nspectra.value(),
+                                                          preprocessing=self.preprocessing)
+                        for result in results:
+                            spectra.append({'x': result['spectrum'].x,
+                                            'y': result['spectrum'].y,
+                                            'label': f"{result['spectrum'].display_string()} ({self.metric_name()}={result['error']:10.3E})",
+                                            'linewidth': 1})
+
+                # all lines at once, one redraw
+                self.plot.plot_spectra(spectra)
 
 
     ##################
     # loading HS data
     ##################
+
     def load_data(self, filename):
         try:
+            if self.cube is not None:
+                self.save_pca_models()
             self.cube = hyper.Cube(filename)
             self.rgb = self.cube.to_rgb()
-            self.pca = None
+            self.load_pca_models()
             self.reset_ui()
             self.update_image_label()
             self.rawfile = filename
@@ -580,13 +929,15 @@ class MainWindow(QMainWindow):
                                          f'{self.cube.ncols} x {self.cube.nrows} px | '
                                          f'{self.cube.nbands} bands.')
             self.sl_zoom.setValue(int(self.width() * self.config.initial_image_width_ratio / self.cube.ncols * 100))
+            if isinstance(self.cube.reader, hyper.ContainerFile) and self.cube.reader.has_products():
+                self.load_products(filename, self.cube.reader.products(), show=False)
 
         except Exception as e:
             print("Error loading file: ")
             print(e)
 
     def handle_action_load_data(self):
-        filename, _ = QFileDialog.getOpenFileName(None, "Select ENVI data file", "")
+        filename, _ = QFileDialog.getOpenFileName(None, "Select ENVI data file or Hyperlyse container", "")
         if filename:
             self.load_data(filename)
 
@@ -610,45 +961,141 @@ class MainWindow(QMainWindow):
     # image & spectra operations
     #############################
     def handle_click_on_image(self, event):
-        if event.buttons() == Qt.MouseButton.LeftButton and self.cube is not None:
+        if event.buttons() == Qt.MouseButton.LeftButton and self.cube is not None and \
+                self.cmb_select_tool.currentData() != 'rect':
+            if self.cmb_select_tool.currentData() == 'freehand':
+                self.roi_path = []
+            self.roi_path.append(self.m2f(event.pos()))
+            self.update_marker()
+        elif event.buttons() == Qt.MouseButton.LeftButton and self.cube is not None:
             self.rubberband_origin = event.pos()
             self.rubberband_selector.setGeometry(QRect(self.rubberband_origin, QSize()))
             self.rubberband_selector.show()
+            # live preview of the spectrum under the mouse while dragging
+            pos_img = self.m2i(event.pos())
+            if 0 <= pos_img.x() < self.cube.ncols and 0 <= pos_img.y() < self.cube.nrows:
+                if not self.plot.lines:
+                    self.plot.plot_spectra([{'x': self.cube.bands,
+                                             'y': self.cube.pixel_spectrum(pos_img.y(), pos_img.x()),
+                                             'label': 'query'}])
+                self.plot.start_live(0)
         else:
             event.ignore()
     def handle_move_on_image(self, event):
-        if event.buttons() == Qt.MouseButton.LeftButton and self.cube is not None:
+        if event.buttons() == Qt.MouseButton.LeftButton and self.cube is not None and \
+                self.cmb_select_tool.currentData() != 'rect':
+            if self.cmb_select_tool.currentData() == 'freehand':
+                self.roi_path.append(self.m2f(event.pos()))
+                self.update_marker()
+        elif event.buttons() == Qt.MouseButton.LeftButton and self.cube is not None:
             x = np.clip(event.pos().x(), 0, self.lbl_img.width()-1)
             y = np.clip(event.pos().y(), 0, self.lbl_img.height()-1)
             self.rubberband_selector.setGeometry(QRect(self.rubberband_origin, QPoint(x, y)).normalized())
+            self.preview_throttle(self.m2i(QPoint(x, y)))
+        elif event.buttons() == Qt.MouseButton.NoButton and self.cb_hover.isChecked() and self.cube is not None:
+            self.preview_throttle(self.m2i(event.pos()))
         else:
             event.ignore()
+    def handle_leave_image(self, event):
+        self.preview_throttle.cancel()
+        self.plot.clear_overlay()
+    def handle_hover_mode_changed(self):
+        self.lbl_img.setMouseTracking(self.cb_hover.isChecked())
+        if not self.cb_hover.isChecked():
+            self.preview_throttle.cancel()
+            self.plot.clear_overlay()
     def handle_release_on_image(self, event):
-        if event.button() == Qt.MouseButton.LeftButton:
+        if event.button() == Qt.MouseButton.LeftButton and self.cmb_select_tool.currentData() != 'rect':
+            if self.cmb_select_tool.currentData() == 'freehand':
+                self.finish_roi_path()
+        elif event.button() == Qt.MouseButton.LeftButton:
             if self.cube is not None:
                 rect = self.m2i(self.rubberband_selector.geometry())
                 if rect.width() > 1 and rect.height() > 1:
-                    cube_slice = self.cube.data[rect.y():rect.y()+rect.height(),
-                                                rect.x():rect.x()+rect.width(),
-                                                :]
-                    self.spectrum_y = np.mean(cube_slice, axis=(0, 1))
+                    self.spectrum_y = self.cube.roi_mean((rect.y(), rect.y() + rect.height()),
+                                                         (rect.x(), rect.x() + rect.width()))
                     self.rect_selection = rect
                     self.point_selection = None
+                    self.set_region_selection(None)
                 else:
                     pos_img = self.m2i(event.pos())
                     if 0 <= pos_img.x() < self.cube.ncols and 0 <= pos_img.y() < self.cube.nrows:
                         print(f"Selected point: ({pos_img.x()}, {pos_img.y()})")
-                        self.spectrum_y = self.cube.data[pos_img.y(), pos_img.x(), :]
+                        if self.cb_select_similar.isChecked():
+                            self.select_similar(pos_img)
+                        else:
+                            self.spectrum_y = self.cube.pixel_spectrum(pos_img.y(), pos_img.x())
+                            self.set_region_selection(None)
                         self.point_selection = pos_img
                         self.rect_selection = None
-                # update ui
-                self.set_recompute_errmap_flag()
-                self.update_image_label()
-                self.update_spectrum_plot()
+                self.preview_throttle.cancel()
+                self.plot.stop_live()
                 self.rubberband_selector.hide()
+                self.handle_selection_changed()
         else:
             event.ignore()
 
+    def handle_double_click_on_image(self, event):
+        if event.button() == Qt.MouseButton.LeftButton and self.cmb_select_tool.currentData() == 'polygon':
+            self.finish_roi_path()
+        else:
+            event.ignore()
+
+    def handle_select_tool_changed(self):
+        self.roi_path = []
+        self.update_marker()
+
+    def handle_selection_changed(self):
+        self.set_recompute_errmap_flag()
+        if self.tabs_img_ctrl.currentIndex() == 2 and self.rb_sim_cube.isChecked():
+            # the similarity map depends on the selection
+            self.update_image_label()
+        else:
+            self.update_marker()
+        self.update_spectrum_plot()
+
+    def finish_roi_path(self):
+        """
+        Close the polygon/freehand path that is being drawn and select the pixels inside
+        """
+        path, self.roi_path = self.roi_path, []
+        mask = hyper.polygon_mask((self.cube.nrows, self.cube.ncols), path) if self.cube is not None else None
+        if mask is None or not mask.any():
+            self.update_marker()
+            return
+        rows, cols = np.nonzero(mask)
+        self.spectrum_y = self.cube.pixels(rows, cols).mean(axis=0)
+        self.point_selection = None
+        self.rect_selection = None
+        self.set_region_selection(mask)
+        self.statusBar().showMessage(f'Selected {rows.size} pixels')
+        self.handle_selection_changed()
+
+    def select_similar(self, pos_img):
+        """
+        Grow a region from a pixel, with the comparison settings of the similarity tab, and select its mean spectrum
+        """
+        with hyper.profiler.span('select_similar'):
+            mask, mean = hyper.grow_region(self.cube, (pos_img.y(), pos_img.x()), self.sb_select_similar.value(),
+                                           custom_range=(self.rs_xrange.start(), self.rs_xrange.end()),
+                                           use_gradient=self.cb_gradient.isChecked(),
+                                           squared_errs=self.cb_squared.isChecked(),
+                                           metric=self.cmb_metric.currentData(),
+                                           preprocessing=self.preprocessing)
+        self.spectrum_y = mean
+        self.set_region_selection(mask)
+        self.statusBar().showMessage(f'Selected {mask.sum()} similar pixels')
+
+    def set_region_selection(self, mask):
+        self.region_selection = mask
+        self.region_image = None
+        if mask is not None:
+            color = self.config.marker_colors[2]
+            rgba = np.zeros(mask.shape + (4,), dtype=np.uint8)
+            rgba[mask] = (*color, 255)
+            self.region_image = QImage(rgba.tobytes(), mask.shape[1], mask.shape[0], 4 * mask.shape[1],
+                                       QImage.Format.Format_RGBA8888).copy()
+
     def handle_click_on_image_scroll(self, event):
         self.drag_start_x = event.pos().x()
         self.drag_start_y = event.pos().y()
@@ -702,6 +1149,14 @@ class MainWindow(QMainWindow):
                 suffix = f'sim({self.cmb_comparison_ref.currentText()})'
         elif self.tabs_img_ctrl.currentIndex() == 3:
             suffix = f'pc{self.sl_component.value()}'
+        elif self.tabs_img_ctrl.currentIndex() == 4:
+            suffix = f'unmixing({self.lbl_endmember.text()})'
+        elif self.tabs_img_ctrl.currentIndex() == 5:
+            suffix = f'clusters{self.sb_nclusters.value()}'
+        elif self.tabs_img_ctrl.currentIndex() == 6:
+            suffix = self.lbl_product_layer.text()
+        elif self.tabs_img_ctrl.currentIndex() == 7:
+            suffix = 'index({})'.format(re.sub(r'[^\w.,()+-]+', '_', self.index_expression))
         else:
             print("Your argument is invalid!")
             return
@@ -738,23 +1193,360 @@ class MainWindow(QMainWindow):
                 if file_spectrum:
                     img = np.uint8(self.rgb * (255 / self.rgb.max()))
                     img = self.draw_marker(img)
-                    hyper.Database.export_spectrum(file_spectrum,
-                                                   spectrum,
-                                                   image=img)
+                    if hyper.Database.export_spectrum(file_spectrum,
+                                                      spectrum,
+                                                      image=img):
+                        self.add_db_file(file_spectrum)
+
+
+    def handle_action_batch_extract(self):
+        if self.cube is None:
+            return
+        source_object = self.last_source_name if self.last_source_name else self.dataset_name()
+        dialog = hyper.BatchExtractDialog(self, source_object, has_rect=self.rect_selection is not None)
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+        options = dialog.get_data()
+        if options['source'] == 'csv':
+            try:
+                regions, names = hyper.batch.read_regions_csv(options['csv'])
+            except (OSError, ValueError) as e:
+                QMessageBox.warning(self, 'Batch extract spectra', f'Could not read positions: {e}')
+                return
+            regions = hyper.batch.clip_regions(regions, self.cube.nrows, self.cube.ncols)
+        else:
+            rect = None
+            if options['rect_only'] and self.rect_selection is not None:
+                r = self.rect_selection
+                rect = (r.left(), r.top(), r.width(), r.height())
+            regions = hyper.batch.grid_regions(self.cube.nrows, self.cube.ncols, options['step'], options['size'],
+                                               rect)
+            names = [''] * len(regions)
+        valid = (regions[:, 2] > 0) & (regions[:, 3] > 0)
+        if not valid.any():
+            QMessageBox.warning(self, 'Batch extract spectra', 'No positions within the image.')
+            return
+        regions = regions[valid]
+        names = [n for n, v in zip(names, valid) if v]
+
+        if self.last_export_dir:
+            dir_default = self.last_export_dir
+        elif self.db is not None:
+            dir_default = self.db.root
+        else:
+            dir_default = '.'
+        export_dir = QFileDialog.getExistingDirectory(self, "Select directory for the spectra", dir_default)
+        if not export_dir:
+            return
+        self.last_export_dir = export_dir
+        self.last_source_name = options['object']
+
+        QGuiApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+        try:
+            with hyper.profiler.span('batch extract', regions=len(regions)):
+                means = hyper.batch.region_means(self.cube, regions)
+                rgb = np.uint8(self.rgb * (255 / self.rgb.max())) if options['thumbnails'] else None
+                files, spectra, images = [], [], []
+                for i, (region, name) in enumerate(zip(regions, names)):
+                    x, y, w, h = [int(v) for v in region]
+                    coordinates = f'({x},{y})' if w == h == 1 else f'({x},{y},{w},{h})'
+                    sample_id = name if name else f"{options['prefix']}{i}"
+                    metadata = hyper.Metadata(id=sample_id,
+                                              description=options['description'],
+                                              source_object=options['object'],
+                                              source_file=self.dataset_name(),
+                                              source_coordinates=coordinates,
+                                              device_info=f"{self.cube.device} / Hyperlyse {self.config.version}",
+                                              intensity=options['intensity'])
+                    spectra.append(hyper.Spectrum(self.cube.bands, means[i], metadata))
+                    files.append(os.path.join(export_dir,
+                                              f"{self.dataset_name()}_{coordinates}_{sample_id}{options['format']}"))
+                    images.append(hyper.batch.thumbnail(rgb, region) if rgb is not None else None)
+                written = hyper.Database.export_spectra(files, spectra, images)
+        finally:
+            QGuiApplication.restoreOverrideCursor()
+        if self.db is not None and self.db.root and \
+                (os.path.abspath(export_dir) + os.sep).startswith(os.path.abspath(self.db.root) + os.sep):
+            self.sync_db()
+        self.statusBar().showMessage(f'Saved {len(written)} spectra to {export_dir}')
+
+    def handle_action_export_cube(self):
+        if self.cube is None:
+            return
+        dialog = hyper.ExportCubeDialog(self, has_pca=self.pca_model is not None,
+                                        has_rect=self.rect_selection is not None)
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+        options = dialog.get_data()
+        rows = cols = None
+        if options['rect_only'] and self.rect_selection is not None:
+            r = self.rect_selection
+            rows = (r.top(), r.top() + r.height())
+            cols = (r.left(), r.left() + r.width())
+        bands = None
+        if options['range_only']:
+            bands = (self.cube.lambda2layer(self.rs_xrange.start()), self.cube.lambda2layer(self.rs_xrange.end()) + 1)
+
+        suffix = 'pca' if options['content'] == 'pca' else 'cube'
+        expfile = os.path.join(os.path.dirname(self.rawfile),
+                               f"{self.dataset_name()}_{suffix}_{options['interleave']}.hdr")
+        fileName, _ = QFileDialog.getSaveFileName(None, "Export cube", expfile, "ENVI header (*.hdr)")
+        if not fileName:
+            return
+        QGuiApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+        try:
+            if options['content'] == 'pca':
+                # written component by component; subsets and binning do not apply
+                n = self.pca_model.n_components
+                hyper.save_envi(fileName,
+                                (self.pca_model.project(self.cube.data, c) for c in range(n)),
+                                self.cube.nrows, self.cube.ncols, n,
+                                interleave=options['interleave'],
+                                metadata={'band names': [f'PC {c}' for c in range(n)]})
+            else:
+                self.cube.save_envi(fileName, options['interleave'], rows=rows, cols=cols, bands=bands,
+                                    binning=options['binning'])
+        finally:
+            QGuiApplication.restoreOverrideCursor()
+        self.statusBar().showMessage(f'Saved {fileName}')
+
+    def collect_products(self):
+        """
+        :return: list of (name, data, kind, params, layer names) of all computed analysis results, see ProductWriter
+        """
+        products = []
+        if self.error_map is not None:
+            products.append(('similarity', self.error_map, 'map', self.error_map_params, None))
+        if self.pca_model is not None:
+            # components are projected one at a time, while writing
+            products.append(('pca',
+                             (self.pca_model.project(self.cube.data, c) for c in range(self.pca_model.n_components)),
+                             'map',
+                             {'wavelength_range': [self.cube.bands[self.pca_model.band_min],
+                                                   self.cube.bands[self.pca_model.band_max - 1]],
+                              'seed': self.pca_model.seed,
+                              'explained_variance': self.pca_model.explained_variance.tolist()},
+                             [f'PC {c}' for c in range(self.pca_model.n_components)]))
+        if self.unmixing is not None:
+            abundances, residuals = self.unmixing
+            products.append(('abundances', abundances, 'map', self.unmixing_params, self.unmixing_params['endmembers']))
+            products.append(('unmixing_residual', residuals, 'map', self.unmixing_params, None))
+        if self.clusters is not None:
+            products.append(('clusters', self.clusters[0], 'labels', self.clusters_params, None))
+        if self.index_image is not None:
+            products.append(('index', self.index_image, 'map', {'expression': self.index_expression}, None))
+        return products
+
+    def write_products(self, file, products):
+        metadata = {'source_file': self.rawfile,
+                    'source_signature': self.cube.signature(),
+                    'hyperlyse_version': self.config.version}
+        with hyper.ProductWriter(file, metadata=metadata) as writer:
+            for name, data, kind, params, layer_names in products:
+                writer.add(name, data, kind=kind, params=params, layer_names=layer_names)
+
+    def handle_action_export_results(self):
+        if self.cube is None:
+            return
+        products = self.collect_products()
+        if not products:
+            QMessageBox.information(self, 'Export analysis results', 'No analysis results computed yet.')
+            return
+
+        expfile = os.path.join(os.path.dirname(self.rawfile), f"{self.dataset_name()}_results.npz")
+        fileName, _ = QFileDialog.getSaveFileName(None, "Export analysis results", expfile,
+                                                  "Hyperlyse results (*.npz)")
+        if fileName:
+            self.write_products(fileName, products)
+            self.statusBar().showMessage(f'Saved {", ".join(p[0] for p in products)} to {fileName}')
 
+    def handle_action_save_container(self):
+        if self.cube is None:
+            return
+        expfile = os.path.join(os.path.dirname(self.rawfile), f"{self.dataset_name()}.hlc")
+        fileName, _ = QFileDialog.getSaveFileName(None, "Save as Hyperlyse container", expfile,
+                                                  "Hyperlyse container (*.hlc)")
+        if not fileName:
+            return
+        QGuiApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+        try:
+            # computed analysis results are embedded
+            products = self.collect_products()
+            products_file = None
+            if products:
+                products_file = fileName + '.products.tmp'
+                self.write_products(products_file, products)
+            self.cube.save_container(fileName, products_file=products_file)
+            if products_file:
+                os.remove(products_file)
+        finally:
+            QGuiApplication.restoreOverrideCursor()
+        self.statusBar().showMessage(f'Saved {fileName}')
+
+    def handle_action_import_results(self):
+        fileName, _ = QFileDialog.getOpenFileName(None, "Open analysis results",
+                                                  os.path.dirname(self.rawfile) if self.rawfile else '',
+                                                  "Hyperlyse results (*.npz)")
+        if fileName:
+            self.load_products(fileName)
+
+    def handle_product_changed(self):
+        if self.products is not None and self.cmb_product.currentData() is not None:
+            self.sl_product_layer.setValue(0)
+            self.sl_product_layer.setMaximum(self.products[self.cmb_product.currentData()].n_layers - 1)
+        self.update_image_label()
+
+    def handle_action_select_endmembers(self):
+        endmember_dialog = hyper.SelectSpectraDialog(self, self.db.spectra, self.endmembers)
+        if endmember_dialog.exec() == QDialog.DialogCode.Accepted:
+            self.set_endmembers(endmember_dialog.get_data())
+            self.update_image_label()
+
+    def handle_action_export_cluster_spectra(self):
+        if self.cube is None:
+            return
+        if self.last_export_dir:
+            dir_default = self.last_export_dir
+        elif self.db is not None:
+            dir_default = self.db.root
+        else:
+            dir_default = '.'
+        export_dir = QFileDialog.getExistingDirectory(self, "Select directory for cluster spectra", dir_default)
+        if export_dir:
+            self.last_export_dir = export_dir
+            labels, means = self.get_clusters()
+            source_object = self.last_source_name if self.last_source_name else self.dataset_name()
+            rgb = np.uint8(self.rgb * (255 / self.rgb.max()))
+            for i, mean in enumerate(means):
+                metadata = hyper.Metadata(id=f'cluster{i}',
+                                          description=f'mean spectrum of cluster {i} of {len(means)}',
+                                          source_object=source_object,
+                                          source_file=self.dataset_name(),
+                                          source_coordinates=f'cluster({i}/{len(means)})',
+                                          device_info=f"{self.cube.device} / Hyperlyse {self.config.version}")
+                spectrum = hyper.Spectrum(self.cube.bands, mean, metadata)
+                # image: the cluster on top of a darkened rgb image
+                img = rgb.copy()
+                img[labels != i] //= 4
+                file_spectrum = os.path.join(export_dir, f"{self.dataset_name()}_clusters{len(means)}_{i}.jdx")
+                if hyper.Database.export_spectrum(file_spectrum, spectrum, image=img):
+                    self.add_db_file(file_spectrum)
+
+    def selection_mask(self):
+        """
+        :return: r*c boolean np.array of the selected pixels, or None
+        """
+        if self.cube is None:
+            return None
+        if self.region_selection is not None:
+            return self.region_selection
+        mask = np.zeros((self.cube.nrows, self.cube.ncols), dtype=bool)
+        if self.rect_selection is not None:
+            r = self.rect_selection
+            mask[r.y():r.y() + r.height(), r.x():r.x() + r.width()] = True
+        elif self.point_selection is not None:
+            mask[self.point_selection.y(), self.point_selection.x()] = True
+        else:
+            return None
+        return mask
+
+    def handle_action_add_region(self):
+        mask = self.selection_mask()
+        if mask is None:
+            return
+        if self.roi_labels is None:
+            self.roi_labels = np.zeros(mask.shape, dtype=np.int32)
+        label = max(self.roi_names.keys(), default=0) + 1
+        # later regions take precedence where regions overlap
+        self.roi_labels[mask] = label
+        self.roi_names[label] = f'{self.dataset_name()}_{self.selection_str()}'
+        self.statusBar().showMessage(f'Added region {label} ({mask.sum()} pixels); {len(self.roi_names)} regions')
+
+    def handle_action_import_label_map(self):
+        if self.cube is None:
+            return
+        file, _ = QFileDialog.getOpenFileName(self, 'Import label map', os.path.dirname(self.rawfile),
+                                              'Label maps (*.npy *.png *.tif *.tiff *.bmp)')
+        if not file:
+            return
+        try:
+            labels = hyper.load_label_map(file)
+            if labels.shape != (self.cube.nrows, self.cube.ncols):
+                raise ValueError(f'the label map has {labels.shape[0]}x{labels.shape[1]} pixels, '
+                                 f'the image {self.cube.nrows}x{self.cube.ncols}')
+        except Exception as e:
+            QMessageBox.warning(self, 'Import label map', f'Could not import {file}:\n{e}')
+            return
+        self.set_roi_labels(labels, os.path.splitext(os.path.basename(file))[0])
+
+    def handle_action_cluster_regions(self):
+        if self.cube is None:
+            return
+        labels, _ = self.get_clusters()
+        # label 0 is background
+        self.set_roi_labels(labels + 1, f'{self.dataset_name()}_clusters{self.sb_nclusters.value()}', offset=1)
+
+    def set_roi_labels(self, labels, name, offset=0):
+        self.roi_labels = labels.astype(np.int32)
+        self.roi_names = {int(l): f'{name}_{l - offset}' for l in np.unique(labels) if l > 0}
+        self.statusBar().showMessage(f'{len(self.roi_names)} regions')
+
+    def handle_action_clear_regions(self):
+        self.roi_labels = None
+        self.roi_names = {}
+        self.statusBar().showMessage('Cleared regions')
+
+    def handle_action_export_region_statistics(self):
+        if self.cube is None:
+            return
+        if self.roi_labels is None or not self.roi_names:
+            QMessageBox.information(self, 'Export region statistics',
+                                    'No regions yet: add selections (Regions -> Add selection as region), '
+                                    'import a label map or use the clusters.')
+            return
+        expfile = os.path.join(os.path.dirname(self.rawfile), f'{self.dataset_name()}_regions.csv')
+        file, _ = QFileDialog.getSaveFileName(self, 'Export region statistics', expfile, 'CSV (*.csv)')
+        if file:
+            with hyper.profiler.span('region_statistics', regions=len(self.roi_names)):
+                stats = hyper.region_statistics(self.cube, self.roi_labels, percentiles=(5, 25, 50, 75, 95))
+            hyper.save_region_statistics(file, stats, self.cube.bands, self.roi_names)
+            self.statusBar().showMessage(f'Saved statistics of {len(stats["labels"])} regions to {file}')
 
     def handle_action_set_db_dir(self):
-        db_dir = QFileDialog.getExistingDirectory(self, "Select directory containing reference spectra in jcamp-dx format",
+        db_dir = QFileDialog.getExistingDirectory(self, "Select directory containing reference spectra (jcamp-dx, dpt, csv)",
                                                   self.db.root)
         if db_dir:
-            self.db.refresh_from_disk(db_dir)
+            progress_dialog = QProgressDialog('Loading spectra...', 'Cancel', 0, 0, self)
+            progress_dialog.setWindowModality(Qt.WindowModality.WindowModal)
+            progress_dialog.setMinimumDuration(500)
+
+            def progress(n_done, n_total):
+                progress_dialog.setMaximum(n_total)
+                progress_dialog.setValue(n_done)
+                return not progress_dialog.wasCanceled()
+
+            self.db.refresh_from_disk(db_dir, progress=progress)
+            progress_dialog.close()
+            self.statusBar().showMessage(f'Loaded {len(self.db.spectra)} spectra')
+            if self.db.errors:
+                msg = QMessageBox(QMessageBox.Icon.Warning, 'Set database',
+                                  f'{len(self.db.errors)} files could not be loaded (see details).',
+                                  QMessageBox.StandardButton.Ok, self)
+                msg.setDetailedText(self.db.error_report())
+                msg.exec()
             self.fill_db_spectra_combobox()
+            self.set_endmembers([])
             self.le_db_path.setText(self.db.root)
+            self.watch_db_dir()
 
 
     ###########
     # helpers
     ##########
+    def m2f(self, pos):
+        # mouse position to (sub-pixel) image coordinates (x, y)
+        return pos.x() / self.sl_zoom.value() * 100, pos.y() / self.sl_zoom.value() * 100
+
     def m2i(self, object):
         # convert mouse coordinates on scaled image label to image coordinates
         if isinstance(object, numbers.Number):
@@ -768,17 +1560,12 @@ class MainWindow(QMainWindow):
         else:
             raise ValueError()
 
-    def draw_marker(self, img):
+    def marker_rects(self):
         """
-        Draws a cross (if a point is selected) or a rectangle (if an area is selected) onto an image
-        :param img: numpy array, r*c or r*c*3
-        :param fatten: make the marker fatter for small scales, such that it remais visible
-        :return:
+        The selection marker as filled rectangles: a cross (if a point is selected) or a rectangle (if an area is
+        selected). The marker is made fatter for small scales, such that it remains visible.
+        :return: list of (x_min, y_min, x_max, y_max, color) in image coordinates, max exclusive
         """
-        if len(img.shape) == 2:
-            img = np.dstack([img, img, img])
-        img_marker = img.copy()
-
         scale = self.sl_zoom.value() / 100
         if scale < 1:
             padding = int(np.ceil(1 / scale - 1))
@@ -786,41 +1573,97 @@ class MainWindow(QMainWindow):
         else:
             padding = 0
             cross_size = self.config.cross_size
+        colors = self.config.marker_colors
 
         if self.rect_selection is not None:
             # RECT
             r = self.rect_selection
-            # top line
-            img_marker[max(r.top() - padding, 0):min(r.top() + padding + 1, self.cube.nrows - 1),
-                       max(r.left(), 0):min(r.right(), self.cube.ncols - 1)] = self.config.marker_colors[0]
-            # bottom line
-            img_marker[max(r.bottom() - padding, 0):min(r.bottom() + padding + 1, self.cube.nrows - 1),
-                       max(r.left(), 0):min(r.right(), self.cube.ncols - 1)] = self.config.marker_colors[1]
-            # left line
-            img_marker[max(r.top(), 0):min(r.bottom()+1, self.cube.nrows - 1),
-                       max(r.left() - padding, 0):min(r.left() + padding + 1, self.cube.ncols - 1)] = self.config.marker_colors[0]
-            # left line
-            img_marker[max(r.top(), 0):min(r.bottom()+1, self.cube.nrows - 1),
-            max(r.right() - padding, 0):min(r.right() + padding + 1, self.cube.ncols - 1)] = self.config.marker_colors[1]
+            rects = [(r.left(), r.top() - padding, r.right(), r.top() + padding + 1, colors[0]),              # top
+                     (r.left(), r.bottom() - padding, r.right(), r.bottom() + padding + 1, colors[1]),        # bottom
+                     (r.left() - padding, r.top(), r.left() + padding + 1, r.bottom() + 1, colors[0]),        # left
+                     (r.right() - padding, r.top(), r.right() + padding + 1, r.bottom() + 1, colors[1])]      # right
         elif self.point_selection is not None:
             # CROSS
             p = self.point_selection
-            # horizontal line
-            img_marker[max(p.y() - padding, 0):min(p.y() + padding + 1, self.cube.nrows - 1),
-                      max(p.x() - cross_size, 0):min(p.x() + cross_size + 1, self.cube.ncols - 1)] = self.config.marker_colors[0]
-            # vertical line
-            img_marker[max(p.y() - cross_size, 0):min(p.y() + cross_size + 1, self.cube.nrows - 1),
-                      max(p.x() - padding, 0):min(p.x() + padding + 1, self.cube.ncols - 1)] = self.config.marker_colors[1]
-            # central dot
-            img_marker[max(p.y() - padding, 0):min(p.y() + padding + 1, self.cube.nrows - 1),
-                      max(p.x() - padding, 0):min(p.x() + padding + 1, self.cube.ncols - 1)] = self.config.marker_colors[2]
-
+            rects = [(p.x() - cross_size, p.y() - padding, p.x() + cross_size + 1, p.y() + padding + 1, colors[0]),
+                     (p.x() - padding, p.y() - cross_size, p.x() + padding + 1, p.y() + cross_size + 1, colors[1]),
+                     (p.x() - padding, p.y() - padding, p.x() + padding + 1, p.y() + padding + 1, colors[2])]
         else:
             #nothing
+            return []
+
+        return [(max(x0, 0), max(y0, 0), min(x1, self.cube.ncols), min(y1, self.cube.nrows), color)
+                for x0, y0, x1, y1, color in rects]
+
+    def draw_marker(self, img):
+        """
+        Draws a cross (if a point is selected) or a rectangle (if an area is selected) onto an image
+        :param img: numpy array, r*c or r*c*3
+        :return:
+        """
+        if len(img.shape) == 2:
+            img = np.dstack([img, img, img])
+
+        rects = self.marker_rects()
+        if not rects and self.region_selection is None:
             return img
 
-        img = img * (1 - self.config.marker_alpha) + img_marker * self.config.marker_alpha
-        return img.astype(np.uint8)
+        img = img.astype(np.uint8)
+        if self.region_selection is not None:
+            color = np.array(self.config.marker_colors[2])
+            img[self.region_selection] = img[self.region_selection] * (1 - self.config.marker_alpha) + \
+                                         color * self.config.marker_alpha
+        if not rects:
+            return img
+        # only the bounding box of the marker is blended
+        bx0 = min(r[0] for r in rects)
+        by0 = min(r[1] for r in rects)
+        bx1 = max(r[2] for r in rects)
+        by1 = max(r[3] for r in rects)
+        box = img[by0:by1, bx0:bx1]
+        box_marker = box.copy()
+        for x0, y0, x1, y1, color in rects:
+            box_marker[y0 - by0:y1 - by0, x0 - bx0:x1 - bx0] = color
+        img[by0:by1, bx0:bx1] = box * (1 - self.config.marker_alpha) + box_marker * self.config.marker_alpha
+        return img
+
+    def update_marker(self):
+        """
+        Show the current image with the selection marker on top. Only the marker is painted; the image is not
+        rendered again.
+        """
+        if self.image_pixmap is None:
+            return
+        pixmap = self.image_pixmap
+        rects = self.marker_rects() if self.cube is not None else []
+        if rects or self.region_image is not None or self.roi_path:
+            scale = self.sl_zoom.value() / 100
+            # paint the marker opaque on its own layer, then blend the layer, such that overlaps are blended once
+            layer = QPixmap(pixmap.size())
+            layer.fill(Qt.GlobalColor.transparent)
+            painter = QPainter(layer)
+            if self.region_image is not None:
+                painter.drawImage(QRectF(0, 0, self.region_image.width() * scale, self.region_image.height() * scale),
+                                  self.region_image)
+            for x0, y0, x1, y1, color in rects:
+                painter.fillRect(QRectF(x0 * scale, y0 * scale, (x1 - x0) * scale, (y1 - y0) * scale), QColor(*color))
+            if self.roi_path:
+                painter.setPen(QPen(QColor(*self.config.marker_colors[0]), 2))
+                painter.drawPolyline(QPolygonF([QPointF(x * scale, y * scale) for x, y in self.roi_path]))
+            painter.end()
+            pixmap = pixmap.copy()
+            painter = QPainter(pixmap)
+            painter.setOpacity(self.config.marker_alpha)
+            painter.drawPixmap(0, 0, layer)
+            painter.end()
+        self.lbl_img.setPixmap(pixmap)
+
+    def preview_spectrum(self, pos_img):
+        # spectrum under the mouse: replaces the query line while dragging, dashed overlay while hovering
+        if self.cube is not None and 0 <= pos_img.x() < self.cube.ncols and 0 <= pos_img.y() < self.cube.nrows:
+            spectrum = self.cube.pixel_spectrum(pos_img.y(), pos_img.x())
+            if not self.plot.update_live(self.cube.bands, spectrum):
+                self.plot.set_overlay(self.cube.bands, spectrum)
 
     def selection_coords(self):
         if self.rect_selection is not None:
@@ -828,7 +1671,14 @@ class MainWindow(QMainWindow):
             return [r.left(), r.top(), r.width(), r.height()]
         elif self.point_selection is not None:
             p = self.point_selection
+            if self.region_selection is not None:
+                return [p.x(), p.y(), f'{self.region_selection.sum()}px']
             return [p.x(), p.y()]
+        elif self.region_selection is not None:
+            # polygon/freehand: bounding box and size
+            rows, cols = np.nonzero(self.region_selection)
+            return [cols.min(), rows.min(), cols.max() - cols.min() + 1, rows.max() - rows.min() + 1,
+                    f'{rows.size}px']
         else:
             return []  # can that happen?
 
@@ -838,20 +1688,189 @@ class MainWindow(QMainWindow):
     def get_lambda_slider_text(self, layer_idx):
         return '%.1fnm' % self.cube.bands[layer_idx]
 
+    def get_clusters(self):
+        if self.clusters is None or self.clusters_recompute_flag:
+            self.clusters_recompute_flag = False
+            band_min = self.cube.lambda2layer(self.rs_xrange.start())
+            band_max = self.cube.lambda2layer(self.rs_xrange.end())
+            use_pca = self.cb_clusters_pca.isChecked()
+            # principal components: the same (cached) model as in the PCA view
+            pca_model = self.get_pca_model(band_min, band_max) if use_pca else None
+            self.clusters = hyper.kmeans_clustering(self.cube.data,
+                                                    n_clusters=self.sb_nclusters.value(),
+                                                    feature_bands=slice(band_min, band_max),
+                                                    n_components=10 if use_pca else 0,
+                                                    pca_model=pca_model)
+            self.clusters_params = {'n_clusters': self.sb_nclusters.value(),
+                                    'wavelength_range': [self.cube.bands[band_min], self.cube.bands[band_max - 1]],
+                                    'principal_components': 10 if self.cb_clusters_pca.isChecked() else 0,
+                                    'cluster_means': self.clusters[1].tolist()}
+        return self.clusters
+
+    def load_products(self, filename, products=None, show=True):
+        """
+        :param filename: file written by ProductWriter
+        :param products: already opened hyper.ProductFile (e.g. embedded in a container), instead of filename
+        :param show: switch to the results tab
+        """
+        try:
+            if products is None:
+                products = hyper.ProductFile(filename)
+        except Exception as e:
+            print("Error loading analysis results: ")
+            print(e)
+            return
+        if self.products is not None:
+            self.products.close()
+        self.products = products
+        self.cmb_product.blockSignals(True)
+        self.cmb_product.clear()
+        for product in products:
+            self.cmb_product.addItem(product.name, product.name)
+        self.cmb_product.blockSignals(False)
+        source = os.path.basename(products.metadata.get('source_file', ''))
+        if show:
+            self.statusBar().showMessage(f'Opened analysis results: {os.path.basename(filename)} (source: {source})')
+            self.tabs_img_ctrl.setCurrentIndex(6)
+        self.handle_product_changed()
+
+    def get_pca_model(self, band_min, band_max):
+        """
+        :return: the PCA model of a band range; fitted once per band range and seed, and cached with the cube
+                 (written when another cube is loaded or the window is closed)
+        """
+        key = hyper.PCAModel.make_key(band_min, band_max, self.config.pca_seed)
+        if key not in self.pca_models:
+            self.pca_models[key] = hyper.PCAModel.fit(self.cube.data,
+                                                      band_min=band_min,
+                                                      band_max=band_max,
+                                                      p_keep=0.01,
+                                                      n_components=10,
+                                                      seed=self.config.pca_seed)
+            self.pca_models_changed = True
+        # only the projections of the current model are kept, the others are just small matrices
+        for other_key, model in self.pca_models.items():
+            if other_key != key:
+                model.clear_projections()
+        return self.pca_models[key]
+
+    def load_pca_models(self):
+        self.pca_model = None
+        self.pca_models_changed = False
+        try:
+            self.pca_models = hyper.PCAModel.load_models(self.cube.cache_file('pca.npz'), self.cube.signature())
+        except Exception as e:
+            print(f'WARNING: could not load cached PCA models: {e}')
+            self.pca_models = {}
+
+    def save_pca_models(self):
+        if not self.pca_models_changed:
+            return
+        self.pca_models_changed = False
+        try:
+            hyper.PCAModel.save_models(self.cube.cache_file('pca.npz'), self.pca_models.values(), self.cube.signature())
+        except Exception as e:
+            print(f'WARNING: could not cache PCA models: {e}')
+
+    def set_endmembers(self, endmembers):
+        self.endmembers = endmembers
+        self.unmixing = None
+        self.set_recompute_unmixing_flag()
+        # one slider position per endmember, plus one for the residual map
+        self.sl_endmember.setMaximum(len(endmembers))
+        if not endmembers:
+            self.lbl_endmember.setText("(no endmembers)")
+
     def fill_db_spectra_combobox(self):
+        # no signals while the items are half there; the selection is reset to '(none)' once, at the end
+        self.cmb_comparison_ref.blockSignals(True)
         self.cmb_comparison_ref.clear()
         self.cmb_comparison_ref.addItem('(none)', -1)
         if self.db is not None:
             for i, s in enumerate(self.db.spectra):
                 self.cmb_comparison_ref.addItem(s.display_string(with_description=True), i)
+        self.cmb_comparison_ref.blockSignals(False)
+        self.cmb_comparison_ref.currentIndexChanged.emit(0)
         self.cmb_comparison_ref.adjustSize()
 
+    def update_db_spectra_combobox(self, added=(), updated=(), removed=()):
+        """
+        Apply changes of the database to the combo box and the endmembers in place (see Database.sync_from_disk)
+        :param added: indices of new spectra
+        :param updated: indices of reloaded spectra (after removal)
+        :param removed: indices of removed spectra (before removal)
+        """
+        if not (added or updated or removed):
+            return
+        def new_index(i):
+            return i - sum(r < i for r in removed)
+
+        current = self.cmb_comparison_ref.currentData()
+        current_changed = current in removed or new_index(current) in updated
+        self.cmb_comparison_ref.blockSignals(True)
+        for i in sorted(removed, reverse=True):
+            self.cmb_comparison_ref.removeItem(i + 1)
+        if removed:
+            # item data are indices into db.spectra
+            for row in range(1, self.cmb_comparison_ref.count()):
+                self.cmb_comparison_ref.setItemData(row, row - 1)
+        for i in updated:
+            self.cmb_comparison_ref.setItemText(i + 1, self.db.spectra[i].display_string(with_description=True))
+        for i in added:
+            self.cmb_comparison_ref.addItem(self.db.spectra[i].display_string(with_description=True), i)
+        if current in removed:
+            self.cmb_comparison_ref.setCurrentIndex(0)
+        self.cmb_comparison_ref.blockSignals(False)
+        if current_changed:
+            self.cmb_comparison_ref.currentIndexChanged.emit(self.cmb_comparison_ref.currentIndex())
+
+        endmembers = [new_index(i) for i in self.endmembers if i not in removed]
+        if len(endmembers) < len(self.endmembers) or any(i in updated for i in endmembers):
+            # the unmixing has to be recomputed
+            self.set_endmembers(endmembers)
+        else:
+            self.endmembers = endmembers
+        self.update_spectrum_plot()
+
+    def add_db_file(self, file):
+        """
+        A spectrum file was written: add it to the database, if it is in the database directory
+        """
+        if self.db.root and os.path.abspath(file).startswith(os.path.abspath(self.db.root) + os.sep):
+            n_before = len(self.db.spectra)
+            index = self.db.add_file(file)
+            if index is not None:
+                if index >= n_before:
+                    self.update_db_spectra_combobox(added=[index])
+                else:
+                    self.update_db_spectra_combobox(updated=[index])
+
+    def sync_db(self):
+        added, updated, removed = self.db.sync_from_disk()
+        self.update_db_spectra_combobox(added, updated, removed)
+        # new subdirectories
+        self.watch_db_dir()
+
+    def watch_db_dir(self):
+        """
+        Watch the database directory and its subdirectories for changes (if enabled in the config)
+        """
+        if not self.config.db_watch or not self.db.root or not os.path.isdir(self.db.root):
+            return
+        dirs = [dirpath for dirpath, _, _ in os.walk(self.db.root)]
+        watched = self.db_watcher.directories()
+        obsolete = [d for d in watched if d not in dirs]
+        if obsolete:
+            self.db_watcher.removePaths(obsolete)
+        new_dirs = [d for d in dirs if d not in watched]
+        if new_dirs:
+            self.db_watcher.addPaths(new_dirs)
+
+    def metric_name(self):
+        return hyper.Database.METRICS[self.cmb_metric.currentData()]
+
     def visualize_error_map(self, error_map):
-        # invert and map to [0, 1]:
-        similarity_map = 1 - (error_map / error_map.max())
-        # apply color map
-        cm = plt.get_cmap('viridis')
-        return cm(similarity_map)[:, :, :3]
+        return hyper.rendering.visualize_error_map(error_map)
 
     def dataset_name(self):
         if self.rawfile is not None:
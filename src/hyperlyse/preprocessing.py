@@ -0,0 +1,252 @@
+import re
+import weakref
+import threading
+import collections
+import numpy as np
+from scipy.signal import savgol_filter
+from concurrent.futures import ThreadPoolExecutor
+from hyperlyse.profiling import profiler
+
+
+class Preprocessing:
+    """
+    Configurable spectral preprocessing, applied identically to query, database and cube spectra before they are
+    compared. Steps, in this order: band masking, Savitzky-Golay smoothing, continuum removal, derivative,
+    normalization. Every step is optional; Preprocessing() leaves spectra unchanged.
+    """
+
+    # available normalizations and their display names
+    NORMALIZATIONS = collections.OrderedDict([('none', 'none'),
+                                              ('vector', 'vector (unit length)'),
+                                              ('area', 'area (unit area)')])
+
+    # preprocessed cubes of recent parameter sets, see apply_cube. each one is a full-size copy of the cube (at least
+    # float32), so only the last one is kept, and only if it is smaller than cube_cache_max_bytes
+    cube_cache_size = 1
+    cube_cache_max_bytes = 2 ** 30
+    __cube_cache = collections.OrderedDict()
+    __cube_cache_lock = threading.Lock()
+
+    def __init__(self, smoothing=0, polyorder=2, derivative=0, continuum_removal=False, normalization='none',
+                 band_mask=()):
+        """
+        :param smoothing: window length (bands) of the Savitzky-Golay filter; <3 means no smoothing
+        :param polyorder: polynomial order of the Savitzky-Golay filter
+        :param derivative: 0, 1 or 2; derivative with respect to the wavelength
+        :param continuum_removal: divide by the upper convex hull of the spectrum
+        :param normalization: one of NORMALIZATIONS: 'vector' - unit euclidean length, 'area' - unit area under |y|
+        :param band_mask: list of (x_min, x_max) wavelength ranges that are removed (e.g. noisy absorption bands)
+        """
+        if normalization not in Preprocessing.NORMALIZATIONS:
+            raise ValueError(f'unknown normalization: {normalization}')
+        if derivative not in (0, 1, 2):
+            raise ValueError(f'derivative must be 0, 1 or 2, not {derivative}')
+        self.smoothing = int(smoothing) if smoothing >= 3 else 0
+        self.polyorder = int(polyorder)
+        self.derivative = int(derivative)
+        self.continuum_removal = bool(continuum_removal)
+        self.normalization = normalization
+        self.band_mask = tuple((float(lo), float(hi)) for lo, hi in band_mask)
+
+    def key(self):
+        return (self.smoothing, self.polyorder if self.smoothing else None, self.derivative, self.continuum_removal,
+                self.normalization, self.band_mask)
+
+    def __eq__(self, other):
+        return isinstance(other, Preprocessing) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def is_identity(self):
+        return self == Preprocessing()
+
+    def to_dict(self):
+        return {'smoothing': self.smoothing,
+                'polyorder': self.polyorder,
+                'derivative': self.derivative,
+                'continuum_removal': self.continuum_removal,
+                'normalization': self.normalization,
+                'band_mask': [list(r) for r in self.band_mask]}
+
+    @staticmethod
+    def from_dict(d):
+        return Preprocessing(**d)
+
+    def describe(self):
+        """
+        :return: short text, e.g. 'smooth 7, derivative 1, vector norm.'
+        """
+        steps = []
+        if self.band_mask:
+            steps.append('mask ' + ', '.join(f'{lo:g}-{hi:g}' for lo, hi in self.band_mask))
+        if self.smoothing:
+            steps.append(f'smooth {self.smoothing}')
+        if self.continuum_removal:
+            steps.append('continuum removed')
+        if self.derivative:
+            steps.append(f'derivative {self.derivative}')
+        if self.normalization != 'none':
+            steps.append(f'{self.normalization} norm.')
+        return ', '.join(steps) if steps else 'none'
+
+    @staticmethod
+    def parse_ranges(text):
+        """
+        :param text: wavelength ranges, e.g. '1340-1460, 1790-1960'
+        :return: list of (x_min, x_max)
+        """
+        ranges = []
+        for part in re.split(r'[,;]', text):
+            if not part.strip():
+                continue
+            match = re.fullmatch(r'\s*(\d+(?:\.\d*)?)\s*-\s*(\d+(?:\.\d*)?)\s*', part)
+            if match is None:
+                raise ValueError(f'invalid wavelength range: {part.strip()}')
+            lo, hi = float(match.group(1)), float(match.group(2))
+            ranges.append((min(lo, hi), max(lo, hi)))
+        return ranges
+
+    def band_selection(self, x):
+        """
+        :param x: wavelengths
+        :return: boolean np.array, the bands that are kept
+        """
+        x = np.asarray(x)
+        keep = np.ones(x.size, dtype=bool)
+        for lo, hi in self.band_mask:
+            keep &= (x < lo) | (x > hi)
+        return keep
+
+    def apply(self, x, y):
+        """
+        :param x: b wavelengths
+        :param y: np.array, 1d spectrum, 2d spectra or 3d cube; bands in the last axis
+        :return: (x, y) after preprocessing; the number of bands is reduced by band masking
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y)
+        dtype = np.result_type(y.dtype, np.float32)
+        if self.band_mask:
+            keep = self.band_selection(x)
+            x = x[keep]
+            y = y[..., keep]
+        if self.is_identity() or x.size < 2:
+            return x, y.astype(dtype, copy=False)
+        shape = y.shape
+        y = y.reshape(-1, shape[-1]).astype(np.float64)
+        if self.smoothing:
+            # the window has to be odd and fit into the spectrum
+            window = min(self.smoothing | 1, x.size if x.size % 2 else x.size - 1)
+            if window > self.polyorder:
+                y = savgol_filter(y, window, self.polyorder, axis=-1)
+        if self.continuum_removal:
+            hull = Preprocessing.upper_hull(x, y)
+            y = np.divide(y, hull, out=np.zeros_like(y), where=hull > np.finfo(np.float32).tiny)
+        for _ in range(self.derivative):
+            y = np.gradient(y, x, axis=-1)
+        if self.normalization == 'vector':
+            y /= np.maximum(np.linalg.norm(y, axis=-1, keepdims=True), np.finfo(np.float32).tiny)
+        elif self.normalization == 'area':
+            # trapezoidal integration of |y| as one matrix-vector product
+            weights = np.zeros(x.size)
+            weights[:-1] += np.diff(x) / 2
+            weights[1:] += np.diff(x) / 2
+            y /= np.maximum(np.abs(y) @ weights, np.finfo(np.float32).tiny)[:, np.newaxis]
+        return x, y.reshape(shape[:-1] + (x.size,)).astype(dtype, copy=False)
+
+    @staticmethod
+    def upper_hull(x, y, block_size=4096):
+        """
+        Upper convex hulls of many spectra at once: a monotone chain over the bands, run on a block of spectra in
+        parallel (per spectrum, a stack of hull vertices)
+        :param x: b sorted wavelengths
+        :param y: n*b spectra
+        :param block_size: number of spectra processed at once (the stacks of a block should fit into the cache)
+        :return: n*b np.array, the hulls interpolated at x
+        """
+        if y.shape[0] > block_size:
+            return np.concatenate([Preprocessing.upper_hull(x, y[i:i + block_size], block_size)
+                                   for i in range(0, y.shape[0], block_size)])
+        n, b = y.shape
+        rows = np.arange(n)
+        # stacks of the hull vertices (band index and y), flat: spectrum i uses the elements i*b..(i+1)*b-1
+        stack = np.zeros(n * b, dtype=np.int64)
+        stack_y = np.zeros(n * b)
+        base = rows * b
+        top = np.zeros(n, dtype=np.int64)     # stack size per spectrum
+        y_bands = np.ascontiguousarray(y.T)
+        for j in range(b):
+            y_j = y_bands[j]
+            candidates = rows if j >= 2 else rows[:0]
+            while candidates.size:
+                last = base[candidates] + top[candidates] - 1
+                x1, y1 = x[stack[last - 1]], stack_y[last - 1]
+                # the last vertex is not on the hull if it is below the line from the one before to the new point
+                cross = (x[stack[last]] - x1) * (y_j[candidates] - y1) - (stack_y[last] - y1) * (x[j] - x1)
+                pop = candidates[cross >= 0]
+                top[pop] -= 1
+                # only spectra that lost a vertex have to be checked again
+                candidates = pop[top[pop] >= 2]
+            position = base + top
+            stack[position] = j
+            stack_y[position] = y_j
+            top += 1
+        stack = stack.reshape(n, b)
+        # linear interpolation between the hull vertices before and after each band
+        is_vertex = np.zeros((n, b), dtype=bool)
+        is_vertex[np.repeat(rows, top), stack[np.arange(b) < top[:, np.newaxis]]] = True
+        bands = np.arange(b)
+        prev = np.maximum.accumulate(np.where(is_vertex, bands, 0), axis=1)
+        following = np.minimum.accumulate(np.where(is_vertex, bands, b - 1)[:, ::-1], axis=1)[:, ::-1]
+        y_prev = np.take_along_axis(y, prev, axis=1)
+        y_next = np.take_along_axis(y, following, axis=1)
+        dx = x[following] - x[prev]
+        t = np.divide(x[bands] - x[prev], dx, out=np.zeros_like(dx), where=dx > 0)
+        return y_prev + t * (y_next - y_prev)
+
+    @profiler.timed('Preprocessing.apply_cube')
+    def apply_cube(self, x, cube_data, chunk_rows=64, n_jobs=0):
+        """
+        Preprocess all pixels of a cube, in chunks of rows on multiple threads. The result is cached per cube and
+        parameter set, such that repeated comparisons with the same settings preprocess the cube only once.
+        Memory: the result is a new array of the size of the cube (float32 or float64), and the cache keeps up to
+        cube_cache_size of them alive (default: the last one, if it has at most cube_cache_max_bytes). Set
+        cube_cache_size to 0 to never keep preprocessed cubes.
+        :param x: b wavelengths of the cube
+        :param cube_data: r*c*b np.array
+        :param chunk_rows: number of rows processed at once
+        :param n_jobs: number of worker threads; <1 means one per cpu
+        :return: (x, r*c*b' np.array), see apply
+        """
+        x = np.asarray(x, dtype=np.float64)
+        if self.is_identity():
+            return x, cube_data
+        key = (cube_data.__array_interface__['data'][0], cube_data.shape, cube_data.strides, cube_data.dtype.str,
+               x.tobytes(), self.key())
+        cache = Preprocessing.__cube_cache
+        with Preprocessing.__cube_cache_lock:
+            if key in cache:
+                owner, result = cache[key]
+                if owner() is not None:
+                    cache.move_to_end(key)
+                    return result
+
+        x_out = x[self.band_selection(x)]
+        data = np.empty(cube_data.shape[:2] + (x_out.size,), dtype=np.result_type(cube_data.dtype, np.float32))
+
+        def process_rows(row_start):
+            data[row_start:row_start + chunk_rows] = self.apply(x, cube_data[row_start:row_start + chunk_rows])[1]
+
+        with ThreadPoolExecutor(max_workers=n_jobs if n_jobs > 0 else None) as executor:
+            list(executor.map(process_rows, range(0, cube_data.shape[0], chunk_rows)))
+
+        with Preprocessing.__cube_cache_lock:
+            if Preprocessing.cube_cache_size > 0 and data.nbytes <= Preprocessing.cube_cache_max_bytes:
+                # only keep a weak reference, such that the cache never keeps a closed cube alive
+                cache[key] = (weakref.ref(cube_data if cube_data.base is None else cube_data.base), (x_out, data))
+            for k in [k for k, (owner, _) in cache.items() if owner() is None]:
+                del cache[k]
+            while len(cache) > Preprocessing.cube_cache_size:
+                cache.popitem(last=False)
+        return x_out, data
@@ -0,0 +1,176 @@
+import io
+import json
+import time
+import zipfile
+import numpy as np
+
+
+class ProductWriter:
+    """
+    Writes derived products (error maps, principal components, label maps, ...) into a single compressed archive.
+    Each layer of a product is stored in square tiles, one compressed .npy member per tile, such that products can
+    be written layer by layer and read back lazily, tile by tile (see ProductFile).
+    The index (products.json) is written on close; if the with block raised, it is left out, so an incomplete
+    archive cannot be opened.
+    """
+    def __init__(self, file, tile_size=256, metadata=None):
+        """
+        :param file: target file (.npz)
+        :param tile_size: edge length of the tiles in pixels
+        :param metadata: dict, stored with the archive (e.g. source file, version)
+        """
+        self.file = file
+        self.tile_size = tile_size
+        self.index = {'format': 'hyperlyse-products',
+                      'version': 1,
+                      'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                      'metadata': metadata if metadata is not None else {},
+                      'products': {}}
+        self.zip = zipfile.ZipFile(file, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
+
+    def add(self, name, data, kind='map', params=None, layer_names=None):
+        """
+        Add a product
+        :param name: unique name of the product
+        :param data: 2d np.array, r*c*n np.array, or an iterable of 2d np.arrays (layers, e.g. computed lazily)
+        :param kind: 'map' (continuous values) or 'labels' (integer classes); used for visualization
+        :param params: dict of the parameters that produced the data
+        :param layer_names: optional list with a name per layer
+        """
+        if name in self.index['products']:
+            raise ValueError(f'duplicate product name: {name}')
+        if isinstance(data, np.ndarray):
+            layers = [data] if data.ndim == 2 else (data[:, :, i] for i in range(data.shape[2]))
+        else:
+            layers = data
+
+        shape = None
+        dtype = None
+        n_layers = 0
+        for layer_idx, layer in enumerate(layers):
+            layer = np.asarray(layer)
+            if layer.ndim != 2:
+                raise ValueError(f'layer {layer_idx} of {name} is not 2d, but has shape {layer.shape}')
+            if shape is None:
+                shape = layer.shape
+                dtype = layer.dtype
+            elif layer.shape != shape:
+                raise ValueError(f'layer {layer_idx} of {name} has shape {layer.shape}, expected {shape}')
+            for r in range(0, shape[0], self.tile_size):
+                for c in range(0, shape[1], self.tile_size):
+                    tile = np.ascontiguousarray(layer[r:r + self.tile_size, c:c + self.tile_size], dtype=dtype)
+                    with self.zip.open(ProductWriter.member_name(name, layer_idx, r, c), 'w',
+                                       force_zip64=True) as f:
+                        np.lib.format.write_array(f, tile, allow_pickle=False)
+            n_layers += 1
+        if n_layers == 0:
+            raise ValueError(f'product {name} has no layers')
+
+        self.index['products'][name] = {'kind': kind,
+                                        'rows': shape[0],
+                                        'cols': shape[1],
+                                        'layers': n_layers,
+                                        'dtype': dtype.str,
+                                        'tile_size': self.tile_size,
+                                        'layer_names': list(layer_names) if layer_names else [],
+                                        'params': params if params is not None else {}}
+
+    def close(self, complete=True):
+        """
+        :param complete: write the index; False leaves an archive that ProductFile refuses to open
+        """
+        if self.zip is not None:
+            if complete:
+                self.zip.writestr('products.json', json.dumps(self.index, indent=1, default=str))
+            self.zip.close()
+            self.zip = None
+
+    @staticmethod
+    def member_name(name, layer, row, col):
+        return f'{name}/{layer}/{row}_{col}.npy'
+
+
+class Product:
+    """
+    A product in a ProductFile. Data is only read (and decompressed) for the tiles that are accessed.
+    """
+    def __init__(self, product_file, name, info):
+        self.product_file = product_file
+        self.name = name
+        self.kind = info['kind']
+        self.shape = (info['rows'], info['cols'], info['layers'])
+        self.dtype = np.dtype(info['dtype'])
+        self.tile_size = info['tile_size']
+        self.layer_names = info['layer_names']
+        self.params = info['params']
+
+    @property
+    def n_layers(self):
+        return self.shape[2]
+
+    def layer_name(self, layer):
+        if layer < len(self.layer_names):
+            return self.layer_names[layer]
+        return f'{self.name} {layer}'
+
+    def read(self, layer=0, rows=None, cols=None):
+        """
+        Read a (part of a) layer
+        :param layer: index of the layer
+        :param rows: (start, end) rows to read, default all
+        :param cols: (start, end) columns to read, default all
+        :return: 2d np.array
+        """
+        r0, r1 = rows if rows is not None else (0, self.shape[0])
+        c0, c1 = cols if cols is not None else (0, self.shape[1])
+        result = np.zeros((r1 - r0, c1 - c0), dtype=self.dtype)
+        t = self.tile_size
+        for r in range(r0 // t * t, r1, t):
+            for c in range(c0 // t * t, c1, t):
+                tile = self.product_file.read_member(ProductWriter.member_name(self.name, layer, r, c))
+                # intersection of tile and requested window
+                ir0, ir1 = max(r, r0), min(r + tile.shape[0], r1)
+                ic0, ic1 = max(c, c0), min(c + tile.shape[1], c1)
+                result[ir0 - r0:ir1 - r0, ic0 - c0:ic1 - c0] = tile[ir0 - r:ir1 - r, ic0 - c:ic1 - c]
+        return result
+
+
+class ProductFile:
+    """
+    Lazy reader for archives written by ProductWriter
+    """
+    def __init__(self, file):
+        self.file = file
+        self.zip = zipfile.ZipFile(file, 'r')
+        if 'products.json' not in self.zip.namelist():
+            self.zip.close()
+            raise ValueError(f'{file} is not a hyperlyse product file, or writing it failed')
+        index = json.loads(self.zip.read('products.json'))
+        if index.get('format') != 'hyperlyse-products':
+            self.zip.close()
+            raise ValueError(f'{file} is not a hyperlyse product file')
+        self.created = index['created']
+        self.metadata = index['metadata']
+        self.products = {name: Product(self, name, info) for name, info in index['products'].items()}
+
+    def __getitem__(self, name):
+        return self.products[name]
+
+    def __iter__(self):
+        return iter(self.products.values())
+
+    def __len__(self):
+        return len(self.products)
+
+    def read_member(self, member):
+        with self.zip.open(member) as f:
+            return np.lib.format.read_array(io.BytesIO(f.read()), allow_pickle=False)
+
+    def close(self):
+        self.zip.close()
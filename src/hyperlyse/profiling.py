@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import pstats
+import logging
+import cProfile
+import functools
+import threading
+import tracemalloc
+import collections
+from contextlib import contextmanager
+
+logger = logging.getLogger('hyperlyse.profiling')
+
+
+class Profiler:
+    """
+    Lightweight timing instrumentation. Code paths are wrapped in named spans; finished spans are kept in a bounded
+    history, logged, reported to listeners (e.g. the status bar) and can be dumped as json or chrome trace
+    (open in chrome://tracing or https://ui.perfetto.dev).
+    """
+    def __init__(self, max_spans=10000):
+        self.enabled = False
+        self.spans = collections.deque(maxlen=max_spans)
+        self.listeners = []
+        self.__t0 = time.perf_counter()
+        self.__local = threading.local()
+        self.__cprofile = None
+        self.__handler = None                   # log handler added by configure
+        self.__open_spans = 0                   # spans currently open, in all threads
+        self.__open_spans_lock = threading.Lock()
+
+    def configure(self, enabled=True, log_file='', track_memory=False, cprofile=False):
+        """
+        :param enabled: record spans at all
+        :param log_file: if given, every finished span is written to this file (debug log)
+        :param track_memory: record peak memory with tracemalloc (slows things down). The peak is process-wide, so it
+                             is only recorded for spans that start while no other span is open (in any thread); it
+                             then includes the memory of all spans nested in (or running concurrently with) them
+        :param cprofile: run the cProfile profiler until stop_capture is called
+        """
+        self.enabled = enabled
+        if log_file:
+            # replaces the handler of an earlier call, such that spans are not logged twice
+            if self.__handler is not None:
+                logger.removeHandler(self.__handler)
+                self.__handler.close()
+            self.__handler = logging.FileHandler(log_file)
+            self.__handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            logger.addHandler(self.__handler)
+            logger.setLevel(logging.DEBUG)
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if cprofile and self.__cprofile is None:
+            self.__cprofile = cProfile.Profile()
+            self.__cprofile.enable()
+
+    def add_listener(self, listener):
+        """
+        :param listener: callable, called with the span record (dict) whenever a span finishes
+        """
+        self.listeners.append(listener)
+
+    @contextmanager
+    def span(self, name, **args):
+        """
+        Time the enclosed block
+        :param name: name of the span
+        :param args: additional information stored with the span
+        """
+        if not self.enabled:
+            yield
+            return
+
+        stack = getattr(self.__local, 'stack', None)
+        if stack is None:
+            stack = self.__local.stack = []
+        with self.__open_spans_lock:
+            # the peak of tracemalloc is global: only the outermost span may reset it
+            track_memory = tracemalloc.is_tracing() and self.__open_spans == 0
+            if track_memory:
+                tracemalloc.reset_peak()
+            self.__open_spans += 1
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            peak = tracemalloc.get_traced_memory()[1] if track_memory else None
+            with self.__open_spans_lock:
+                self.__open_spans -= 1
+            record = {'name': name,
+                      'start': start - self.__t0,
+                      'duration': duration,
+                      'peak_memory': peak,
+                      'thread': threading.get_ident(),
+                      'depth': len(stack),
+                      'args': args}
+            self.spans.append(record)
+            logger.debug(Profiler.format_span(record))
+            for listener in self.listeners:
+                listener(record)
+
+    def timed(self, name=None):
+        """
+        Decorator, time every call of the function
+        :param name: name of the span; default: qualified name of the function
+        """
+        def decorator(func):
+            span_name = name if name else func.__qualname__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def format_span(record):
+        text = f"{record['name']}: {record['duration'] * 1000:.1f} ms"
+        if record['peak_memory'] is not None:
+            text += f", peak {record['peak_memory'] / 2 ** 20:.1f} MB"
+        return text
+
+    def summary(self):
+        """
+        :return: dict, span name -> {'count', 'total', 'mean', 'max'} (durations in seconds)
+        """
+        summary = {}
+        for record in self.spans:
+            s = summary.setdefault(record['name'], {'count': 0, 'total': 0.0, 'max': 0.0})
+            s['count'] += 1
+            s['total'] += record['duration']
+            s['max'] = max(s['max'], record['duration'])
+        for s in summary.values():
+            s['mean'] = s['total'] / s['count']
+        return summary
+
+    def dump(self, file):
+        """
+        Write all recorded spans to file; chrome trace format if file ends with .trace.json, plain json otherwise
+        """
+        if file.endswith('.trace.json'):
+            events = [{'name': r['name'],
+                       'ph': 'X',
+                       'ts': r['start'] * 1e6,
+                       'dur': r['duration'] * 1e6,
+                       'pid': os.getpid(),
+                       'tid': r['thread'],
+                       'args': dict(r['args'], **({'peak_memory': r['peak_memory']}
+                                                  if r['peak_memory'] is not None else {}))}
+                      for r in self.spans]
+            content = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        else:
+            content = {'spans': list(self.spans), 'summary': self.summary()}
+        with open(file, 'w') as f:
+            json.dump(content, f, indent=1, default=str)
+
+    def stop_capture(self, file_stats=''):
+        """
+        Stop the cProfile capture (if running) and write its statistics
+        :param file_stats: target for the raw statistics (readable with pstats/snakeviz); a text report
+                           is written next to it
+        """
+        if self.__cprofile is not None:
+            self.__cprofile.disable()
+            if file_stats:
+                self.__cprofile.dump_stats(file_stats)
+                with open(os.path.splitext(file_stats)[0] + '.txt', 'w') as f:
+                    pstats.Stats(self.__cprofile, stream=f).sort_stats('cumulative').print_stats(100)
+            self.__cprofile = None
+
+
+# global instance used throughout hyperlyse
+profiler = Profiler()
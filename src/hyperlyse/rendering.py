@@ -0,0 +1,74 @@
+import io
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.image
+
+
+def normalize(img, vmin=None, vmax=None):
+    """
+    Map values linearly to [0, 1]
+    :param img: np.array
+    :param vmin: value mapped to 0, default the minimum of img
+    :param vmax: value mapped to 1, default the maximum of img
+    :return: float32 np.array (not clipped)
+    """
+    img = np.nan_to_num(np.asarray(img, dtype=np.float32))
+    vmin = img.min() if vmin is None else vmin
+    vmax = img.max() if vmax is None else vmax
+    return (img - vmin) / max(vmax - vmin, np.finfo(np.float32).tiny)
+
+
+def threshold_error_map(error_map, threshold, max_error=None):
+    """
+    Cut off errors above a share of the maximum error (similarity slider)
+    :param error_map: r*c np.array of errors/distances
+    :param threshold: 0..100; errors above (100 - threshold)% of max_error are set to that value
+    :param max_error: default the maximum of error_map
+    :return: thresholded copy of error_map, and the cut-off value
+    """
+    max_error = error_map.max() if max_error is None else max_error
+    t = (100 - threshold) / 100 * max_error
+    return np.minimum(error_map, t), t
+
+
+def visualize_error_map(error_map, max_error=None):
+    """
+    :param error_map: r*c np.array of errors/distances
+    :param max_error: error that is shown as least similar, default the maximum of error_map
+    :return: r*c*3 RGB image (viridis, bright = similar)
+    """
+    max_error = error_map.max() if max_error is None else max_error
+    # invert and map to [0, 1]:
+    similarity_map = 1 - (error_map / max(max_error, np.finfo(np.float32).tiny))
+    # apply color map
+    cm = plt.get_cmap('viridis')
+    return cm(similarity_map)[:, :, :3]
+
+
+def visualize_labels(labels):
+    """
+    :param labels: r*c np.array of integer classes (clusters)
+    :return: r*c*3 RGB image, one color per class
+    """
+    cm = plt.get_cmap('tab20')
+    return cm(labels % cm.N)[:, :, :3]
+
+
+def to_uint8(img, brightness=1.0):
+    """
+    Adjust brightness, clip and convert an image with values in [0, 1] to 8 bit
+    """
+    return np.uint8(np.clip(img * brightness, 0, 1) * 255)
+
+
+def encode_png(img):
+    """
+    :param img: r*c (grayscale) or r*c*3 (RGB) uint8 np.array
+    :return: PNG file content (bytes)
+    """
+    buffer = io.BytesIO()
+    if img.ndim == 2:
+        matplotlib.image.imsave(buffer, img, format='png', cmap='gray', vmin=0, vmax=255)
+    else:
+        matplotlib.image.imsave(buffer, img, format='png')
+    return buffer.getvalue()
@@ -0,0 +1,140 @@
+import hashlib
+import threading
+import collections
+import numpy as np
+from scipy import sparse
+from concurrent.futures import ThreadPoolExecutor
+from hyperlyse.profiling import profiler
+from hyperlyse.cube import Cube
+
+METHODS = ['auto', 'linear', 'integrate']
+
+# resampling matrices of recently used pairs of wavelength grids
+_matrix_cache = collections.OrderedDict()
+_matrix_cache_size = 64
+_matrix_cache_lock = threading.Lock()
+
+
+def resampling_matrix(x_source, x_target, method='auto'):
+    """
+    Sparse matrix W that maps spectra sampled at x_source to x_target: y_target = W @ y_source. Matrices are cached
+    per pair of grids and method, so resampling with the same grids (and comparison range) is one sparse product.
+    :param x_source: s sorted wavelengths
+    :param x_target: t sorted wavelengths
+    :param method: 'linear' - linear interpolation between the two closest source bands (constant beyond the ends)
+                   'integrate' - mean of the source spectrum over the width of each target band (for resampling to a
+                                 coarser grid); band edges are halfway between band centers
+                   'auto' - 'integrate' if the source grid is finer than the target grid, 'linear' otherwise
+    :return: t*s scipy.sparse.csr_matrix
+    """
+    if method not in METHODS:
+        raise ValueError(f'unknown resampling method: {method}')
+    x_source = np.ascontiguousarray(x_source, dtype=np.float64)
+    x_target = np.ascontiguousarray(x_target, dtype=np.float64)
+    key = (hashlib.blake2b(x_source.tobytes(), digest_size=16).hexdigest(),
+           hashlib.blake2b(x_target.tobytes(), digest_size=16).hexdigest(),
+           method)
+    with _matrix_cache_lock:
+        if key in _matrix_cache:
+            _matrix_cache.move_to_end(key)
+            return _matrix_cache[key]
+
+    if method == 'auto':
+        finer = x_source.size > 1 and x_target.size > 1 and \
+            np.median(np.diff(x_source)) < np.median(np.diff(x_target))
+        method = 'integrate' if finer else 'linear'
+    if method == 'integrate':
+        matrix = _integration_matrix(x_source, x_target)
+    else:
+        matrix = _interpolation_matrix(x_source, x_target)
+
+    with _matrix_cache_lock:
+        _matrix_cache[key] = matrix
+        while len(_matrix_cache) > _matrix_cache_size:
+            _matrix_cache.popitem(last=False)
+    return matrix
+
+
+def _interpolation_matrix(x_source, x_target):
+    n_source, n_target = x_source.size, x_target.size
+    if n_source == 1:
+        return sparse.csr_matrix(np.ones((n_target, 1)))
+    left = np.clip(np.searchsorted(x_source, x_target, side='right') - 1, 0, n_source - 2)
+    t = np.clip((x_target - x_source[left]) / (x_source[left + 1] - x_source[left]), 0, 1)
+    rows = np.repeat(np.arange(n_target), 2)
+    cols = np.column_stack([left, left + 1]).ravel()
+    weights = np.column_stack([1 - t, t]).ravel()
+    return sparse.csr_matrix((weights, (rows, cols)), shape=(n_target, n_source))
+
+
+def _band_edges(x):
+    if x.size == 1:
+        return np.array([x[0] - 0.5, x[0] + 0.5])
+    middle = (x[1:] + x[:-1]) / 2
+    return np.concatenate([[x[0] - (middle[0] - x[0])], middle, [x[-1] + (x[-1] - middle[-1])]])
+
+
+def _integration_matrix(x_source, x_target):
+    edges_source = _band_edges(x_source)
+    edges_target = _band_edges(x_target)
+    lo, hi = edges_target[:-1], edges_target[1:]
+    # source bands overlapping each target band
+    first = np.clip(np.searchsorted(edges_source, lo, side='right') - 1, 0, x_source.size - 1)
+    last = np.clip(np.searchsorted(edges_source, hi, side='left') - 1, 0, x_source.size - 1)
+    counts = last - first + 1
+    rows = np.repeat(np.arange(x_target.size), counts)
+    cols = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    overlap = np.maximum(np.minimum(hi[rows], edges_source[cols + 1]) - np.maximum(lo[rows], edges_source[cols]), 0)
+    covered = np.bincount(rows, weights=overlap, minlength=x_target.size)
+    matrix = sparse.csr_matrix((overlap / np.maximum(covered[rows], np.finfo(np.float64).tiny), (rows, cols)),
+                               shape=(x_target.size, x_source.size))
+    uncovered = np.flatnonzero(covered <= 0)
+    if uncovered.size:
+        # target bands beyond the source grid: as with linear interpolation (constant)
+        interpolation = _interpolation_matrix(x_source, x_target)
+        keep = sparse.diags((covered > 0).astype(np.float64))
+        fallback = sparse.diags((covered <= 0).astype(np.float64))
+        matrix = (keep @ matrix + fallback @ interpolation).tocsr()
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def resample(x_source, y, x_target, method='auto'):
+    """
+    Resample spectra to other wavelengths, see resampling_matrix
+    :param x_source: s wavelengths of y
+    :param y: np.array, 1d spectrum, 2d spectra or 3d cube; bands in the last axis
+    :param x_target: t wavelengths
+    :param method: see resampling_matrix
+    :return: np.array with t bands in the last axis
+    """
+    y = np.asarray(y)
+    matrix = resampling_matrix(x_source, x_target, method)
+    shape = y.shape
+    result = matrix @ y.reshape(-1, shape[-1]).T
+    return np.asarray(result.T, dtype=np.result_type(y.dtype, np.float32)).reshape(shape[:-1] + (len(x_target),))
+
+
+@profiler.timed('project_cube')
+def project_cube(cube, x_target, method='auto', chunk_rows=64, n_jobs=0):
+    """
+    Project a cube onto another wavelength grid (e.g. of another device), in chunks of rows on multiple threads
+    :param cube: hyper.Cube, loaded or opened lazily
+    :param x_target: wavelengths of the projected cube
+    :param method: see resampling_matrix
+    :param chunk_rows: number of rows processed at once
+    :param n_jobs: number of worker threads; <1 means one per cpu
+    :return: hyper.Cube (in memory) with bands x_target
+    """
+    x_target = np.asarray(x_target, dtype=np.float64)
+    matrix_t = resampling_matrix(cube.bands, x_target, method).T.tocsr()
+    data = np.empty((cube.nrows, cube.ncols, x_target.size), dtype=np.float32)
+
+    def process_rows(row_start):
+        row_end = min(row_start + chunk_rows, cube.nrows)
+        pixels = cube.roi((row_start, row_end), (0, cube.ncols)).reshape(-1, cube.nbands)
+        data[row_start:row_end] = (pixels @ matrix_t).reshape(row_end - row_start, cube.ncols, x_target.size)
+
+    with ThreadPoolExecutor(max_workers=n_jobs if n_jobs > 0 else None) as executor:
+        list(executor.map(process_rows, range(0, cube.nrows, chunk_rows)))
+    return Cube.from_array(data, x_target.tolist(), device=cube.device, file_data=cube.file_data)
@@ -0,0 +1,190 @@
+import os
+import csv
+import numpy as np
+import matplotlib.image
+from matplotlib.path import Path
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse
+from hyperlyse.profiling import profiler
+
+
+def polygon_mask(shape, vertices):
+    """
+    Rasterize a polygon (or a freehand path, which is closed by a straight line); a pixel belongs to the region if
+    its center is inside
+    :param shape: (rows, cols) of the image
+    :param vertices: list of (x, y) image coordinates; pixel (row, col) covers x in [col, col+1), y in [row, row+1)
+    :return: rows*cols boolean np.array
+    """
+    mask = np.zeros(shape, dtype=bool)
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+    if len(vertices) < 3:
+        return mask
+    # only pixels in the bounding box are tested
+    c0, r0 = np.maximum(np.floor(vertices.min(axis=0)).astype(int), 0)
+    c1, r1 = np.minimum(np.ceil(vertices.max(axis=0)).astype(int) + 1, (shape[1], shape[0]))
+    if r1 <= r0 or c1 <= c0:
+        return mask
+    rows, cols = np.mgrid[r0:r1, c0:c1]
+    inside = Path(vertices).contains_points(np.column_stack([cols.ravel(), rows.ravel()]) + 0.5)
+    mask[r0:r1, c0:c1] = inside.reshape(rows.shape)
+    return mask
+
+
+def load_label_map(file):
+    """
+    Load a label map: an integer image with one label per region, 0 for background.
+    :param file: .npy (integer array) or image (e.g. .png; each color except black is a region)
+    :return: r*c int32 np.array
+    """
+    if os.path.splitext(file)[1].lower() == '.npy':
+        labels = np.load(file, allow_pickle=False)
+        if labels.ndim != 2 or not np.issubdtype(labels.dtype, np.integer):
+            raise ValueError(f'{file} does not contain a 2d integer array')
+        return labels.astype(np.int32)
+    img = matplotlib.image.imread(file)
+    if img.dtype != np.uint8:
+        img = np.uint8(np.round(img * 255))
+    if img.ndim == 2:
+        img = img[:, :, np.newaxis]
+    colors, labels = np.unique(img[:, :, :3].reshape(-1, min(img.shape[2], 3)), axis=0, return_inverse=True)
+    labels = labels.reshape(img.shape[:2]).astype(np.int32)
+    black = np.flatnonzero(~colors.any(axis=1))
+    if black.size:
+        # black is the background; the labels of all other colors start at 1
+        labels = np.where(labels == black[0], 0, labels + (labels < black[0]))
+    else:
+        labels += 1
+    return labels
+
+
+@profiler.timed('region_statistics')
+def region_statistics(cube, labels, percentiles=(25, 50, 75), chunk_rows=64, n_jobs=0):
+    """
+    Statistics of the spectra of many regions at once, in a single pass over the cube: per chunk of rows, the pixels
+    are accumulated per label (means and squared deviations as sparse matrix products for all bands, merged over the
+    chunks); the labelled pixels are gathered for the percentiles, which are then computed for all regions and bands
+    by one sort. As np.mean/np.std/np.percentile, statistics of a band are nan if a pixel of the region is.
+    :param cube: hyper.Cube, loaded or opened lazily
+    :param labels: r*c integer np.array, one label per region; labels < 1 are ignored (background)
+    :param percentiles: percentiles to compute, 0..100, plus the median; empty for mean and std only
+    :param chunk_rows: number of cube rows processed at once
+    :param n_jobs: number of worker threads; <1 means one per cpu
+    :return: dict: 'labels' - the n labels found (ascending), 'count' - n pixel counts,
+                   'mean', 'std' - n*b spectra, 'percentiles' - {percentile: n*b spectra},
+                   'median' - n*b spectra (if percentiles were computed)
+    """
+    labels = np.asarray(labels)
+    if labels.shape != (cube.nrows, cube.ncols):
+        raise ValueError(f'label map has shape {labels.shape}, expected {(cube.nrows, cube.ncols)}')
+    ids = np.unique(labels[labels > 0])
+    n_regions = ids.size
+    nbands = cube.nbands
+    # labels -> 0..n-1, background -> -1
+    index = np.searchsorted(ids, labels)
+    index[labels < 1] = -1
+    with_percentiles = len(percentiles) > 0
+    percentiles = sorted(set(percentiles) | {50}) if with_percentiles else []
+
+    def process_rows(row_start):
+        row_end = min(row_start + chunk_rows, cube.nrows)
+        chunk_index = index[row_start:row_end].ravel()
+        labelled = np.flatnonzero(chunk_index >= 0)
+        if labelled.size == 0:
+            return None     # nothing to read
+        pixels = cube.roi((row_start, row_end), (0, cube.ncols)).reshape(-1, nbands)[labelled]
+        chunk_index = chunk_index[labelled]
+        membership = sparse.csr_matrix((np.ones(labelled.size), (chunk_index, np.arange(labelled.size))),
+                                       shape=(n_regions, labelled.size))
+        pixels64 = pixels.astype(np.float64)
+        chunk_counts = np.bincount(chunk_index, minlength=n_regions)
+        chunk_mean = (membership @ pixels64) / np.maximum(chunk_counts, 1)[:, np.newaxis]
+        # squared deviations from the mean of the chunk, not sums of squares, which cancel out for large means
+        with np.errstate(invalid='ignore'):
+            squared_deviations = membership @ (pixels64 - chunk_mean[chunk_index]) ** 2
+        return (chunk_counts, chunk_mean, squared_deviations,
+                (chunk_index, pixels) if with_percentiles else None)
+
+    mean = np.zeros((n_regions, nbands))
+    squared_deviations = np.zeros((n_regions, nbands))
+    counts = np.zeros(n_regions, dtype=np.int64)
+    gathered = []
+    with ThreadPoolExecutor(max_workers=n_jobs if n_jobs > 0 else None) as executor:
+        for result in executor.map(process_rows, range(0, cube.nrows, chunk_rows)):
+            if result is not None:
+                # merge with the chunks before (Chan et al.)
+                chunk_counts, chunk_mean, chunk_deviations = result[:3]
+                total = np.maximum(counts + chunk_counts, 1)[:, np.newaxis]
+                with np.errstate(invalid='ignore'):
+                    delta = chunk_mean - mean
+                    mean += delta * (chunk_counts[:, np.newaxis] / total)
+                    squared_deviations += chunk_deviations + delta ** 2 * (counts * chunk_counts)[:, np.newaxis] / total
+                counts += chunk_counts
+                if result[3] is not None:
+                    gathered.append(result[3])
+
+    stats = {'labels': ids,
+             'count': counts,
+             'mean': mean.astype(np.float32),
+             'std': np.sqrt(squared_deviations / np.maximum(counts, 1)[:, np.newaxis]).astype(np.float32),
+             'percentiles': {}}
+    if with_percentiles and n_regions:
+        stats['percentiles'] = _grouped_percentiles(np.concatenate([g[0] for g in gathered]),
+                                                    np.concatenate([g[1] for g in gathered]),
+                                                    counts, percentiles)
+        stats['median'] = stats['percentiles'][50]
+    return stats
+
+
+def _grouped_percentiles(group, values, counts, percentiles, block_bands=16):
+    """
+    Percentiles of the values of each group, for all groups and bands at once (linear interpolation, as np.percentile;
+    nan for bands in which a value of the group is nan)
+    :param group: n group indices, 0..g-1
+    :param values: n*b values
+    :param counts: g number of values per group
+    :return: {percentile: g*b np.array}
+    """
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    ends = starts + np.maximum(counts - 1, 0)
+    result = {p: np.zeros((counts.size, values.shape[1]), dtype=np.float32) for p in percentiles}
+    for b in range(0, values.shape[1], block_bands):
+        block = values[:, b:b + block_bands].astype(np.float64)
+        # sort by value (nan last), then stably by group: all groups are sorted at once, exactly for any values
+        order = np.argsort(block, axis=0)
+        order = np.take_along_axis(order, np.argsort(group[order], axis=0, kind='stable'), axis=0)
+        block = np.take_along_axis(block, order, axis=0)
+        has_nan = np.add.reduceat(np.isnan(block), starts, axis=0) > 0
+        for p in percentiles:
+            pos = starts + p / 100 * np.maximum(counts - 1, 0)
+            lower = np.floor(pos).astype(np.int64)
+            upper = np.minimum(lower + 1, ends)
+            w = (pos - lower)[:, np.newaxis]
+            a, c = block[lower], block[upper]
+            with np.errstate(invalid='ignore'):
+                # exact values (also infinite ones) where no interpolation is needed
+                values_p = np.where((w == 0) | (a == c), a, a * (1 - w) + c * w)
+            values_p[has_nan] = np.nan
+            result[p][:, b:b + block_bands] = values_p
+    return result
+
+
+def save_region_statistics(file, stats, bands, names=None):
+    """
+    Save the result of region_statistics as CSV: one line per region and statistic, one column per band
+    :param file: target file
+    :param stats: dict returned by region_statistics
+    :param bands: band centers (wavelengths)
+    :param names: optional dict label -> name of the region
+    """
+    names = names if names is not None else {}
+    rows = [('mean', stats['mean']), ('std', stats['std'])]
+    rows += [(f'p{p:g}', values) for p, values in sorted(stats['percentiles'].items())]
+    with open(file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['region', 'label', 'pixels', 'statistic'] + [f'{b:g}' for b in bands])
+        for i, label in enumerate(stats['labels']):
+            name = names.get(int(label), f'region {label}')
+            for statistic, values in rows:
+                writer.writerow([name, int(label), int(stats['count'][i]), statistic] +
+                                [f'{v:.6g}' for v in values[i]])
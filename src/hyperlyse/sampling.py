@@ -0,0 +1,92 @@
+import numpy as np
+
+
+class PixelSampler:
+    """
+    Reproducible random samples of pixels of a cube, used for fitting analyses (PCA, clustering, ...).
+    Only the sampled pixels are read, so cubes can be memory-mapped or opened lazily and never have to be reshaped
+    or copied.
+    """
+
+    STRATEGIES = ['choice', 'strided', 'tiles']
+
+    def __init__(self, strategy='choice', seed=0, tile_size=64, chunk_size=65536):
+        """
+        :param strategy: how pixels are picked:
+                         'choice' - uniformly at random, without replacement
+                         'strided' - regular grid with a random offset
+                         'tiles' - stratified: the same share of random pixels from each tile of the image
+        :param seed: seed of the random generator; equal seeds give equal samples
+        :param tile_size: size (in pixels) of the square tiles of the 'tiles' strategy
+        :param chunk_size: maximum number of pixels gathered from the cube at once
+        """
+        if strategy not in PixelSampler.STRATEGIES:
+            raise ValueError(f'unknown sampling strategy: {strategy}')
+        self.strategy = strategy
+        self.seed = seed
+        self.tile_size = tile_size
+        self.chunk_size = chunk_size
+
+    def sample_indices(self, nrows, ncols, n_samples):
+        """
+        Pick pixel coordinates
+        :param nrows: number of rows of the image
+        :param ncols: number of columns of the image
+        :param n_samples: (approximate, for 'strided' and 'tiles') number of pixels
+        :return: (rows, cols), np.arrays of pixel coordinates, sorted in memory order
+        """
+        rng = np.random.default_rng(self.seed)
+        n_pixels = nrows * ncols
+        n_samples = int(min(max(n_samples, 1), n_pixels))
+
+        if self.strategy == 'choice':
+            idx = rng.choice(n_pixels, n_samples, replace=False)
+        elif self.strategy == 'strided':
+            step = max(int(np.sqrt(n_pixels / n_samples)), 1)
+            offset_row, offset_col = rng.integers(0, step, 2)
+            rows = np.arange(offset_row % nrows, nrows, step)
+            cols = np.arange(offset_col % ncols, ncols, step)
+            idx = (rows[:, np.newaxis] * ncols + cols[np.newaxis, :]).ravel()
+        else:
+            # the same share of pixels from each tile; positions drawn independently, duplicates removed below
+            tile_rows = np.arange(0, nrows, self.tile_size)
+            tile_cols = np.arange(0, ncols, self.tile_size)
+            tile_r0, tile_c0 = [t.ravel() for t in np.meshgrid(tile_rows, tile_cols, indexing='ij')]
+            tile_h = np.minimum(tile_r0 + self.tile_size, nrows) - tile_r0
+            tile_w = np.minimum(tile_c0 + self.tile_size, ncols) - tile_c0
+            per_tile = np.maximum(np.round(tile_h * tile_w * n_samples / n_pixels).astype(int), 1)
+            tile = np.repeat(np.arange(per_tile.size), per_tile)
+            rows = tile_r0[tile] + (rng.random(tile.size) * tile_h[tile]).astype(int)
+            cols = tile_c0[tile] + (rng.random(tile.size) * tile_w[tile]).astype(int)
+            idx = rows * ncols + cols
+
+        # sorting keeps reads from memory-mapped files (mostly) sequential
+        idx = np.unique(idx)
+        return np.divmod(idx, ncols)
+
+    def sample(self, cube_data, n_samples=0, p_keep=1.0, bands=slice(None)):
+        """
+        Gather a sample of pixel spectra from a cube
+        :param cube_data: r*c*b cube (may be a memory-mapped array), or anything that reads pixels on demand with
+                          pixels(rows, cols): hyper.Cube (calibrated, also when opened lazily), hyper.EnviReader or
+                          hyper.ContainerFile (raw)
+        :param n_samples: number of pixels; if < 1, p_keep is used instead
+        :param p_keep: share of pixels
+        :param bands: slice of bands to read
+        :return: n*b np.array
+        """
+        if isinstance(cube_data, np.ndarray):
+            nrows, ncols = cube_data.shape[:2]
+
+            def gather(rows, cols):
+                return cube_data[rows, cols, bands]
+        else:
+            nrows, ncols = cube_data.nrows, cube_data.ncols
+
+            def gather(rows, cols):
+                return cube_data.pixels(rows, cols)[:, bands]
+        if n_samples < 1:
+            n_samples = int(nrows * ncols * p_keep)
+        rows, cols = self.sample_indices(nrows, ncols, n_samples)
+        return np.concatenate([gather(rows[i:i + self.chunk_size], cols[i:i + self.chunk_size])
+                               for i in range(0, rows.size, self.chunk_size)])
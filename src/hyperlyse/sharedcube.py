@@ -0,0 +1,201 @@
+import os
+import sys
+import weakref
+import tempfile
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from hyperlyse.cube import Cube
+
+
+class CubeDescriptor:
+    """
+    Small, picklable reference to a cube published with SharedCube. Workers get the descriptor instead of the data
+    and attach to the published data without copying it (see attach).
+    """
+    def __init__(self, backend, name, shape, dtype, bands, rgb_layers, device, file_data):
+        """
+        :param backend: 'shm' (shared memory) or 'file' (memory-mapped temporary file)
+        :param name: name of the shared memory block, or path of the file
+        :param shape: (rows, cols, bands) of the data
+        :param dtype: data type (string, np.dtype.str)
+        """
+        self.backend = backend
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.bands = list(bands)
+        self.rgb_layers = tuple(rgb_layers)
+        self.device = device
+        self.file_data = file_data
+
+    def attach(self):
+        """
+        :return: read-only Cube on the published data; attached once per process, see attach_cube
+        """
+        return attach_cube(self)
+
+
+# cubes attached by this process: name -> (Cube, shared memory block or None)
+_attached = {}
+# shared memory blocks published by this process (inherited by forked workers)
+_published = set()
+
+# python < 3.13 registers attached blocks with the resource tracker as if they were created by the attaching process
+_UNTRACK_ATTACHED = sys.version_info < (3, 13) and os.name == 'posix'
+
+
+def _open_shared_memory(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    if _UNTRACK_ATTACHED and name not in _published:
+        # otherwise the block is unlinked (or reported as leaked) when the tracker of a worker exits. the publishing
+        # SharedCube is responsible for unlinking.
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def attach_cube(descriptor):
+    """
+    Attach to a published cube (zero-copy). Repeated calls in the same process return the same Cube.
+    :param descriptor: CubeDescriptor
+    :return: Cube with read-only data
+    """
+    if descriptor.name in _attached:
+        return _attached[descriptor.name][0]
+    shm = None
+    if descriptor.backend == 'shm':
+        shm = _open_shared_memory(descriptor.name)
+        data = np.ndarray(descriptor.shape, dtype=descriptor.dtype, buffer=shm.buf)
+        data.flags.writeable = False
+    else:
+        data = np.memmap(descriptor.name, dtype=descriptor.dtype, mode='r', shape=descriptor.shape)
+    cube = Cube.from_array(data, descriptor.bands, descriptor.rgb_layers, descriptor.device, descriptor.file_data)
+    _attached[descriptor.name] = (cube, shm)
+    return cube
+
+
+def detach_cube(descriptor):
+    """
+    Release this process's attachment to a published cube. The data of Cubes returned by attach_cube must not be
+    used afterwards.
+    """
+    if descriptor.name not in _attached:
+        return
+    cube, shm = _attached.pop(descriptor.name)
+    cube.data = None
+    if shm is not None:
+        try:
+            shm.close()
+        except BufferError:
+            pass  # views of the data are still alive; the block is closed when they are gone
+
+
+def _process_rows(descriptor, func, row_start, row_end, args):
+    return func(attach_cube(descriptor), row_start, row_end, *args)
+
+
+class SharedCube:
+    """
+    Publishes the calibrated data of a cube once, in shared memory or a memory-mapped temporary file, for process
+    pools: workers attach to it via a CubeDescriptor instead of receiving a pickled copy of the data.
+    The publishing SharedCube owns the data: it is released on close(), when leaving a with block, when the object
+    is garbage collected, or at the latest when the interpreter exits.
+    """
+
+    BACKENDS = ['shm', 'file']
+
+    def __init__(self, cube, backend='shm', directory=None, dtype=np.float32, chunk_rows=256):
+        """
+        :param cube: Cube to publish; may be opened lazily (the data is then read block by block)
+        :param backend: 'shm' - multiprocessing.shared_memory (RAM)
+                        'file' - temporary file, memory-mapped by all processes (for cubes larger than the RAM)
+        :param directory: directory of the temporary file (backend 'file'); default: system temp directory
+        :param dtype: data type of the published values
+        :param chunk_rows: number of rows copied at once
+        """
+        if backend not in SharedCube.BACKENDS:
+            raise ValueError(f'unknown backend: {backend}')
+        shape = (cube.nrows, cube.ncols, cube.nbands)
+        dtype = np.dtype(dtype)
+        self.__shm = None
+        path = None
+        if backend == 'shm':
+            self.__shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+            name = self.__shm.name
+            _published.add(name)
+            self.data = np.ndarray(shape, dtype=dtype, buffer=self.__shm.buf)
+        else:
+            fd, path = tempfile.mkstemp(suffix='.cube', prefix='hyperlyse_', dir=directory)
+            os.close(fd)
+            name = path
+            self.data = np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+        self.__finalizer = weakref.finalize(self, SharedCube.__release, self.__shm, path)
+
+        for row in range(0, cube.nrows, chunk_rows):
+            self.data[row:row + chunk_rows] = cube.roi((row, min(row + chunk_rows, cube.nrows)), (0, cube.ncols))
+        if backend == 'file':
+            self.data.flush()
+
+        self.descriptor = CubeDescriptor(backend, name, shape, dtype.str, cube.bands, cube.rgb_layers, cube.device,
+                                         cube.file_data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def closed(self):
+        return not self.__finalizer.alive
+
+    def close(self):
+        """
+        Release the published data. Workers must not use it anymore.
+        """
+        self.data = None
+        self.__finalizer()
+
+    @staticmethod
+    def __release(shm, path):
+        if shm is not None:
+            _published.discard(shm.name)
+            try:
+                shm.close()
+            except BufferError:
+                pass  # views of the data are still alive in this process; unlinking frees the block with them
+            shm.unlink()
+        if path is not None:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f'WARNING: could not remove shared cube file {path}: {e}')
+
+    def map_rows(self, func, *args, chunk_rows=64, n_jobs=0):
+        """
+        Run func on blocks of rows of the cube in a process pool
+        :param func: picklable (module level) function func(cube, row_start, row_end, *args); cube is the attached,
+                     read-only Cube (all rows), of which func should only process rows row_start..row_end
+        :param args: additional (picklable) arguments of func
+        :param chunk_rows: number of rows per block
+        :param n_jobs: number of worker processes; <1 means one per cpu
+        :return: list of the results of func, in the order of the blocks
+        """
+        if self.closed:
+            raise ValueError('shared cube is closed')
+        nrows = self.descriptor.shape[0]
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs if n_jobs > 0 else None) as executor:
+                futures = [executor.submit(_process_rows, self.descriptor, func, row, min(row + chunk_rows, nrows),
+                                           args)
+                           for row in range(0, nrows, chunk_rows)]
+                return [f.result() for f in futures]
+        finally:
+            if _UNTRACK_ATTACHED and self.__shm is not None:
+                # workers started with spawn/forkserver share the resource tracker of this process, so their
+                # unregistering (see _open_shared_memory) also dropped the registration of the block published here
+                from multiprocessing import resource_tracker
+                resource_tracker.register(self.__shm._name, 'shared_memory')
@@ -0,0 +1,509 @@
+import json
+import threading
+import collections
+import urllib.parse
+import http.server
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from hyperlyse.profiling import profiler
+from hyperlyse.analysis import PCAModel
+from hyperlyse.database import Database
+from hyperlyse.container import ContainerFile
+from hyperlyse import rendering
+
+
+class TileRenderer:
+    """
+    Renders views of a cube (RGB, single bands, similarity, principal components) as PNG tiles of a zoom pyramid:
+    level 0 is the full resolution, each further level has half the size of the previous one (every 2nd row and
+    column), up to the level at which the whole image fits into a single tile.
+    Only the pixels of the requested tile are read and rendered; rendered tiles are kept in an LRU cache.
+    Safe to use from several threads.
+    """
+
+    VIEWS = ['rgb', 'band', 'similarity', 'pca']
+
+    def __init__(self, cube, db=None, tile_size=256, cache_size=1024, pca_seed=0):
+        """
+        :param cube: hyper.Cube, loaded or opened lazily
+        :param db: hyper.Database, for similarity maps with database spectra as reference
+        :param tile_size: edge length of the tiles in pixels
+        :param cache_size: number of rendered tiles kept in memory
+        :param pca_seed: seed of the pixel sample PCA models are fitted on (as PCA_SEED in config.json)
+        """
+        self.cube = cube
+        self.db = db
+        self.tile_size = tile_size
+        self.pca_seed = pca_seed
+        self.n_levels = 1
+        while max(self.level_shape(self.n_levels - 1)) > tile_size:
+            self.n_levels += 1
+
+        self.__tiles = collections.OrderedDict()
+        self.__cache_size = cache_size
+        self.__lock = threading.Lock()
+        # band images of lazily opened cubes, value ranges of similarity/PCA views and PCA models are computed once,
+        # when the first tile needs them
+        self.__bands = collections.OrderedDict()
+        self.__ranges = {}
+        self.__pca_models = {}
+        self.__model_lock = threading.Lock()
+        # containers come with a ready-made RGB pyramid
+        self.__pyramid = {}
+        if isinstance(cube.reader, ContainerFile):
+            self.__pyramid = {level: None for level, shape in enumerate(cube.reader.pyramid_levels())
+                              if shape == self.level_shape(level)}
+        try:
+            self.__pca_models = PCAModel.load_models(cube.cache_file('pca.npz'), cube.signature())
+        except Exception:
+            pass  # no models cached by the GUI
+
+    def level_shape(self, level):
+        """
+        :return: (rows, cols) of the image at a zoom level
+        """
+        return max(self.cube.nrows >> level, 1), max(self.cube.ncols >> level, 1)
+
+    def n_tiles(self, level):
+        """
+        :return: (rows, cols) of tiles at a zoom level
+        """
+        rows, cols = self.level_shape(level)
+        return -(-rows // self.tile_size), -(-cols // self.tile_size)
+
+    def info(self):
+        """
+        :return: dict describing the cube and the tile pyramid
+        """
+        return {'file': self.cube.file_data,
+                'device': self.cube.device,
+                'rows': self.cube.nrows,
+                'cols': self.cube.ncols,
+                'bands': [float(b) for b in self.cube.bands],
+                'rgb_layers': [int(l) for l in self.cube.rgb_layers],
+                'tile_size': self.tile_size,
+                'levels': [{'level': level, 'shape': self.level_shape(level), 'tiles': self.n_tiles(level)}
+                           for level in range(self.n_levels)],
+                'views': TileRenderer.VIEWS,
+                'metrics': list(Database.METRICS.keys()),
+                'db_spectra': [self.db.spectra[i].display_string(with_description=True)
+                               for i in range(len(self.db.spectra))] if self.db is not None else []}
+
+    def spectrum(self, row, col):
+        """
+        :return: dict with wavelengths and calibrated values of a pixel
+        """
+        if not (0 <= row < self.cube.nrows and 0 <= col < self.cube.ncols):
+            raise IndexError(f'pixel ({row}, {col}) is outside of the image')
+        return {'row': row,
+                'col': col,
+                'x': [float(b) for b in self.cube.bands],
+                'y': [float(v) for v in self.cube.pixel_spectrum(row, col)]}
+
+    def tile(self, view, level, tile_row, tile_col, params=None):
+        """
+        Get a rendered tile (from the cache, if it was rendered before)
+        :param view: one of TileRenderer.VIEWS
+        :param level: zoom level, 0 is full resolution
+        :param tile_row: row of the tile
+        :param tile_col: column of the tile
+        :param params: dict of view parameters (strings, as in a query string):
+                       all views - brightness (percent, default 100)
+                       'band' - band (index) or wavelength (nm)
+                       'similarity' - ref ('db:<index>' or 'pixel:<row>,<col>'), metric, gradient, squared,
+                                      xmin, xmax (wavelength range), threshold (0..100, as the similarity slider)
+                       'pca' - component, xmin, xmax (wavelength range)
+        :return: PNG file content (bytes)
+        """
+        if view not in TileRenderer.VIEWS:
+            raise ValueError(f'unknown view: {view}')
+        if not 0 <= level < self.n_levels:
+            raise IndexError(f'no zoom level {level}')
+        n_rows, n_cols = self.n_tiles(level)
+        if not (0 <= tile_row < n_rows and 0 <= tile_col < n_cols):
+            raise IndexError(f'no tile ({tile_row}, {tile_col}) at level {level}')
+        params = self.__parse_params(view, params if params is not None else {})
+
+        key = (view, level, tile_row, tile_col, tuple(sorted(params.items())))
+        with self.__lock:
+            if key in self.__tiles:
+                self.__tiles.move_to_end(key)
+                return self.__tiles[key]
+
+        with profiler.span('TileRenderer.render', view=view, level=level):
+            png = rendering.encode_png(self.render(view, level, tile_row, tile_col, params))
+
+        with self.__lock:
+            self.__tiles[key] = png
+            while len(self.__tiles) > self.__cache_size:
+                self.__tiles.popitem(last=False)
+        return png
+
+    def render(self, view, level, tile_row, tile_col, params):
+        """
+        Render a tile, see tile
+        :param params: parsed parameters (see __parse_params)
+        :return: uint8 np.array, r*c (grayscale) or r*c*3 (RGB)
+        """
+        rows, cols = self.__window(level, tile_row, tile_col)
+        if view == 'rgb':
+            if level in self.__pyramid:
+                img = self.__pyramid_level(level)[rows[0]:rows[1], cols[0]:cols[1]] / 255
+            else:
+                img = np.clip(np.dstack([self.__band(level, rows, cols, layer) for layer in self.cube.rgb_layers]),
+                              None, 1)
+        elif view == 'band':
+            img = self.__band(level, rows, cols, params['band'])
+        elif view == 'similarity':
+            error_map = self.__similarity(self.__pixels(level, rows, cols), params)
+            max_error = self.__value_range(view, params)[1]
+            error_map, t = rendering.threshold_error_map(error_map, params['threshold'], max_error)
+            img = rendering.visualize_error_map(error_map, t)
+        else:
+            model = self.__pca_model(params)
+            vmin, vmax = self.__value_range(view, params)
+            img = rendering.normalize(model.project_pixels(self.__pixels(level, rows, cols), params['component']),
+                                      vmin, vmax)
+        return rendering.to_uint8(img, params['brightness'] / 100)
+
+    def __parse_params(self, view, query):
+        """
+        Pick and convert the parameters of a view; unknown parameters are ignored, such that equal tiles share
+        their cache entry
+        """
+        params = {'brightness': float(query.get('brightness', 100))}
+        if view == 'band':
+            if 'wavelength' in query:
+                params['band'] = self.cube.lambda2layer(float(query['wavelength']))
+            else:
+                params['band'] = int(query.get('band', 0))
+            if not 0 <= params['band'] < self.cube.nbands:
+                raise ValueError(f'no band {params["band"]}')
+        elif view in ['similarity', 'pca']:
+            params['xmin'] = float(query.get('xmin', self.cube.bands[0]))
+            params['xmax'] = float(query.get('xmax', self.cube.bands[-1]))
+            if view == 'similarity':
+                params['ref'] = query.get('ref', '')
+                params['metric'] = query.get('metric', 'error')
+                if params['metric'] not in Database.METRICS:
+                    raise ValueError(f'unknown metric: {params["metric"]}')
+                params['gradient'] = query.get('gradient', '0').lower() in ['1', 'true']
+                params['squared'] = query.get('squared', '1').lower() in ['1', 'true']
+                params['threshold'] = float(query.get('threshold', 0))
+                self.__reference(params['ref'])     # fail early on invalid references
+            else:
+                params['component'] = int(query.get('component', 0))
+        return params
+
+    def __window(self, level, tile_row, tile_col):
+        """
+        :return: (start, end) rows and columns of a tile, in pixels of its zoom level
+        """
+        rows, cols = self.level_shape(level)
+        r0, c0 = tile_row * self.tile_size, tile_col * self.tile_size
+        return (r0, min(r0 + self.tile_size, rows)), (c0, min(c0 + self.tile_size, cols))
+
+    def __pixels(self, level, rows, cols):
+        """
+        Calibrated spectra of a window of a zoom level (every 2**level-th row and column of the cube)
+        :return: r*c*nbands np.array
+        """
+        step = 1 << level
+        (r0, r1), (c0, c1) = rows, cols
+        if self.cube.data is not None:
+            return self.cube.data[r0 * step:r1 * step:step, c0 * step:c1 * step:step, :]
+        if step == 1:
+            return self.cube.roi(rows, cols)
+        # only the rows that are shown are read
+        return np.stack([self.cube.roi((r * step, r * step + 1), (c0 * step, c1 * step))[0, ::step]
+                         for r in range(r0, r1)])
+
+    def __band(self, level, rows, cols, band):
+        """
+        Calibrated values of a band in a window of a zoom level
+        :return: r*c np.array
+        """
+        step = 1 << level
+        (r0, r1), (c0, c1) = rows, cols
+        if self.cube.data is not None:
+            img = self.cube.data[:, :, band]
+        else:
+            # lazily opened cubes: whole band images are read once (one sequential scan at most) and kept for the
+            # following tiles
+            with self.__model_lock:
+                if band not in self.__bands:
+                    self.__bands[band] = self.cube.band_image(band)
+                    while len(self.__bands) > 8:
+                        self.__bands.popitem(last=False)
+                img = self.__bands[band]
+        return img[r0 * step:r1 * step:step, c0 * step:c1 * step:step]
+
+    def __pyramid_level(self, level):
+        with self.__model_lock:
+            if self.__pyramid[level] is None:
+                self.__pyramid[level] = self.cube.reader.pyramid(level)
+            return self.__pyramid[level]
+
+    def __reference(self, ref):
+        """
+        :param ref: 'db:<index>' (database spectrum) or 'pixel:<row>,<col>' (spectrum of the cube)
+        :return: (x, y) of the reference spectrum
+        """
+        kind, _, value = ref.partition(':')
+        try:
+            if kind == 'db' and self.db is not None:
+                spectrum = self.db.spectra[int(value)]
+                return np.asarray(spectrum.x), np.asarray(spectrum.y)
+            elif kind == 'pixel':
+                row, col = (int(v) for v in value.split(','))
+                return np.asarray(self.cube.bands), self.cube.pixel_spectrum(row, col)
+        except (IndexError, ValueError):
+            pass
+        raise ValueError(f'invalid reference: {ref}')
+
+    def __similarity(self, pixels, params):
+        ref_x, ref_y = self.__reference(params['ref'])
+        error_map = Database.compare_spectra(np.asarray(self.cube.bands), pixels, ref_x, ref_y,
+                                             custom_range=(params['xmin'], params['xmax']),
+                                             use_gradient=params['gradient'],
+                                             squared_errs=params['squared'],
+                                             metric=params['metric'])
+        if error_map is None:
+            raise ValueError('the reference does not overlap with the wavelengths of the cube')
+        return error_map
+
+    def __pca_model(self, params):
+        band_min = self.cube.lambda2layer(params['xmin'])
+        band_max = self.cube.lambda2layer(params['xmax'])
+        key = PCAModel.make_key(band_min, band_max, self.pca_seed)
+        with self.__model_lock:
+            if key not in self.__pca_models:
+                # same settings as the GUI; lazily opened cubes are fitted on a coarse zoom level instead of a
+                # random sample
+                if self.cube.data is not None:
+                    data, p_keep = self.cube.data, 0.01
+                else:
+                    level = self.__sample_level(max(self.cube.nrows * self.cube.ncols // 100, self.tile_size ** 2))
+                    rows, cols = self.level_shape(level)
+                    data, p_keep = self.__pixels(level, (0, rows), (0, cols)), 1.0
+                self.__pca_models[key] = PCAModel.fit(data, band_min=band_min, band_max=band_max, p_keep=p_keep,
+                                                      n_components=10, seed=self.pca_seed)
+            model = self.__pca_models[key]
+        if not 0 <= params['component'] < model.n_components:
+            raise ValueError(f'no principal component {params["component"]}')
+        return model
+
+    def __sample_level(self, n_pixels):
+        """
+        :return: the finest zoom level with at most n_pixels pixels
+        """
+        for level in range(self.n_levels):
+            rows, cols = self.level_shape(level)
+            if rows * cols <= n_pixels:
+                return level
+        return self.n_levels - 1
+
+    def __value_range(self, view, params):
+        """
+        The value range of a whole view, such that all tiles are colored alike. Estimated on the coarsest level.
+        :return: (min, max)
+        """
+        key = (view, tuple(sorted((k, v) for k, v in params.items() if k not in ['brightness', 'threshold'])))
+        with self.__model_lock:
+            if key in self.__ranges:
+                return self.__ranges[key]
+        level = self.n_levels - 1
+        rows, cols = self.level_shape(level)
+        pixels = self.__pixels(level, (0, rows), (0, cols))
+        if view == 'similarity':
+            values = self.__similarity(pixels, params)
+        else:
+            values = self.__pca_model(params).project_pixels(pixels, params['component'])
+        value_range = (float(np.nanmin(values)), float(np.nanmax(values)))
+        with self.__model_lock:
+            self.__ranges[key] = value_range
+        return value_range
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET /                                   simple viewer
+    GET /info                               json, see TileRenderer.info
+    GET /spectrum?row=<row>&col=<col>       json, see TileRenderer.spectrum
+    GET /tiles/<view>/<level>/<row>/<col>.png?<params>   PNG, see TileRenderer.tile
+    """
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        parts = [p for p in url.path.split('/') if p]
+        renderer = self.server.renderer
+        try:
+            if not parts:
+                self.__send(200, 'text/html; charset=utf-8', _VIEWER_HTML.encode('utf-8'))
+            elif parts == ['info']:
+                self.__send_json(renderer.info())
+            elif parts == ['spectrum']:
+                self.__send_json(renderer.spectrum(int(query['row']), int(query['col'])))
+            elif len(parts) == 5 and parts[0] == 'tiles' and parts[4].endswith('.png'):
+                png = renderer.tile(parts[1], int(parts[2]), int(parts[3]), int(parts[4][:-4]), query)
+                self.__send(200, 'image/png', png, cache=True)
+            else:
+                self.__send_error(404, f'not found: {url.path}')
+        except IndexError as e:
+            self.__send_error(404, str(e))
+        except (KeyError, ValueError) as e:
+            self.__send_error(400, f'invalid request: {e}')
+        except Exception as e:
+            self.__send_error(500, str(e))
+            raise
+
+    def __send(self, status, content_type, body, cache=False):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if cache:
+            # tiles of a given url never change while the server is running
+            self.send_header('Cache-Control', 'max-age=3600')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __send_json(self, data):
+        self.__send(200, 'application/json', json.dumps(data).encode('utf-8'))
+
+    def __send_error(self, status, message):
+        self.__send(status, 'application/json', json.dumps({'error': message}).encode('utf-8'))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class TileServer(http.server.HTTPServer):
+    """
+    Headless HTTP server for the views of a cube (see TileRenderer), e.g. for browsers on the lab network.
+    Requests are handled concurrently by a pool of worker threads.
+    """
+
+    def __init__(self, renderer, host='127.0.0.1', port=8000, n_jobs=0, verbose=False):
+        """
+        :param renderer: TileRenderer
+        :param host: address to listen on; '0.0.0.0' for all interfaces
+        :param port: port to listen on; 0 picks a free one
+        :param n_jobs: number of worker threads; <1 means a default depending on the number of cpus
+        :param verbose: log every request
+        """
+        self.renderer = renderer
+        self.verbose = verbose
+        self.executor = ThreadPoolExecutor(max_workers=n_jobs if n_jobs > 0 else None)
+        super().__init__((host, port), _RequestHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.__process_request, request, client_address)
+
+    def __process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def start(self):
+        """
+        Serve in a background thread
+        :return: the thread
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+_VIEWER_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Hyperlyse</title>
+<style>
+  body { font-family: sans-serif; margin: 0; }
+  #controls { padding: 6px; background: #eee; }
+  #view { position: relative; overflow: auto; height: calc(100vh - 160px); }
+  #tiles { position: relative; cursor: crosshair; }
+  #tiles img { position: absolute; image-rendering: pixelated; }
+  #spectrum { height: 110px; width: 100%; }
+</style>
+</head>
+<body>
+<div id="controls">
+  <select id="mode"><option>rgb</option><option>band</option><option>similarity</option><option>pca</option></select>
+  band <input id="band" type="number" value="0" min="0" style="width: 5em">
+  component <input id="component" type="number" value="0" min="0" max="9" style="width: 4em">
+  metric <select id="metric"></select>
+  reference <input id="ref" value="" placeholder="db:0 or pixel:row,col" style="width: 10em">
+  brightness <input id="brightness" type="number" value="100" style="width: 5em">%
+  <button id="zoomout">-</button> <span id="level"></span> <button id="zoomin">+</button>
+  <span id="status"></span>
+</div>
+<div id="view"><div id="tiles"></div></div>
+<svg id="spectrum"><polyline id="line" fill="none" stroke="black"/></svg>
+<script>
+let info = null, level = 0;
+const $ = id => document.getElementById(id);
+function params() {
+  const p = new URLSearchParams({brightness: $('brightness').value});
+  const mode = $('mode').value;
+  if (mode === 'band') p.set('band', $('band').value);
+  if (mode === 'pca') p.set('component', $('component').value);
+  if (mode === 'similarity') { p.set('ref', $('ref').value); p.set('metric', $('metric').value); }
+  return p.toString();
+}
+function draw() {
+  const lv = info.levels[level], ts = info.tile_size, tiles = $('tiles');
+  tiles.innerHTML = '';
+  tiles.style.width = lv.shape[1] + 'px';
+  tiles.style.height = lv.shape[0] + 'px';
+  for (let r = 0; r < lv.tiles[0]; r++) for (let c = 0; c < lv.tiles[1]; c++) {
+    const img = document.createElement('img');
+    img.src = `tiles/${$('mode').value}/${level}/${r}/${c}.png?${params()}`;
+    img.style.top = (r * ts) + 'px';
+    img.style.left = (c * ts) + 'px';
+    tiles.appendChild(img);
+  }
+  $('level').textContent = `level ${level}`;
+}
+$('tiles').onclick = async e => {
+  const rect = $('tiles').getBoundingClientRect();
+  // pixels of the zoom level to pixels of the cube
+  const row = Math.floor(e.clientY - rect.top) << level, col = Math.floor(e.clientX - rect.left) << level;
+  const s = await (await fetch(`spectrum?row=${row}&col=${col}`)).json();
+  if (s.error) return;
+  $('status').textContent = `pixel (${row}, ${col})`;
+  $('ref').value = `pixel:${row},${col}`;
+  const w = $('spectrum').clientWidth, h = $('spectrum').clientHeight, ymax = Math.max(...s.y, 1e-6);
+  $('line').setAttribute('points', s.y.map((v, i) =>
+    `${i / (s.y.length - 1) * w},${h - v / ymax * (h - 4)}`).join(' '));
+};
+$('zoomin').onclick = () => { level = Math.max(level - 1, 0); draw(); };
+$('zoomout').onclick = () => { level = Math.min(level + 1, info.levels.length - 1); draw(); };
+for (const id of ['mode', 'band', 'component', 'metric', 'ref', 'brightness']) $(id).onchange = draw;
+fetch('info').then(r => r.json()).then(i => {
+  info = i;
+  level = info.levels.length - 1;
+  $('metric').innerHTML = info.metrics.map(m => `<option>${m}</option>`).join('');
+  $('band').max = info.bands.length - 1;
+  document.title = `Hyperlyse - ${info.file}`;
+  draw();
+});
+</script>
+</body>
+</html>
+"""
@@ -1,6 +1,6 @@
 import sys
+import argparse
 import hyperlyse as hyper
-from PyQt6.QtWidgets import QApplication
 
 
 
@@ -8,13 +8,56 @@ from PyQt6.QtWidgets import QApplication
 __version__ = "1.3.3"
 config = hyper.Config(__version__, 'config.json')
 
+
+def serve(args):
+    """
+    headless mode: serve tiles of the cube's views over http, no Qt app
+    """
+    cube = hyper.Cube(args.file, lazy=args.lazy)
+    db = hyper.Database(args.db if args.db else config.default_db_path)
+    renderer = hyper.TileRenderer(cube, db, tile_size=config.tile_size, cache_size=config.tile_cache_size,
+                                  pca_seed=config.pca_seed)
+    server = hyper.TileServer(renderer,
+                              host=args.host if args.host else config.server_host,
+                              port=args.port if args.port is not None else config.server_port,
+                              verbose=args.verbose)
+    print(f'serving {args.file} on {server.url} (stop with ctrl+c)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+
 # main
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        startup_file = sys.argv[1]
-    else:
-        startup_file = None
+    parser = argparse.ArgumentParser(description='Hyperlyse')
+    parser.add_argument('file', nargs='?', default=None, help='capture to open (ENVI data file or .hlc container)')
+    parser.add_argument('--serve', action='store_true', help='run the headless tile server instead of the GUI')
+    parser.add_argument('--host', default='', help='tile server: address to listen on (SERVER_HOST)')
+    parser.add_argument('--port', type=int, default=None, help='tile server: port (SERVER_PORT)')
+    parser.add_argument('--db', default='', help='tile server: database directory (DEFAULT_DB_PATH)')
+    parser.add_argument('--lazy', action='store_true', help='tile server: read the cube from disk on demand')
+    parser.add_argument('--verbose', action='store_true', help='tile server: log requests')
+    args = parser.parse_args()
     print(f'--- hyperlyse version {__version__} ---')
-    app = QApplication([])
-    win = hyper.MainWindow(config, startup_file)
-    sys.exit(app.exec())
+    if config.profiling:
+        hyper.profiler.configure(log_file=config.profiling_log,
+                                 track_memory=config.profiling_memory,
+                                 cprofile=bool(config.profiling_cprofile))
+    if args.serve:
+        if args.file is None:
+            parser.error('--serve requires a file')
+        exit_code = serve(args)
+    else:
+        # Qt is only needed for the GUI
+        from PyQt6.QtWidgets import QApplication
+        app = QApplication([])
+        win = hyper.MainWindow(config, args.file)
+        exit_code = app.exec()
+    if config.profiling:
+        if config.profiling_trace:
+            hyper.profiler.dump(config.profiling_trace)
+        hyper.profiler.stop_capture(config.profiling_cprofile)
+    sys.exit(exit_code)
@@ -0,0 +1,231 @@
+"""
+Benchmarks for cube loading, access patterns per interleave, comparison, database search, analyses and rendering.
+
+Generates synthetic ENVI captures (with DARKREF/WHITEREF) and synthetic JCAMP-DX libraries in a temporary directory,
+times the main code paths and writes the results to a .json file, such that runs of different versions can be compared.
+
+usage:
+    python benchmark.py [--sizes 256 512] [--library-sizes 100 1000 10000] [--repeats 3] [--output results.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import numpy as np
+import spectral
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+src_dir = os.path.join(os.path.dirname(this_dir), 'src')
+sys.path.insert(0, src_dir)
+import hyperlyse as hyper
+
+N_BANDS = 204
+BANDS = list(np.linspace(397.32, 1003.58, N_BANDS))
+
+
+def make_capture(directory, size, n_bands=N_BANDS, interleave='bil', seed=0):
+    """
+    Write a synthetic SpecimIQ-like capture (raw data, dark and white reference) to directory
+    :return: path of the raw data file
+    """
+    rng = np.random.default_rng(seed)
+    metadata = {'wavelength': BANDS[:n_bands], 'default bands': [70, 53, 19], 'sensor type': 'benchmark'}
+    # smooth random spectra, such that comparisons and PCA behave roughly like on real data
+    n_endmembers = 8
+    endmembers = np.cumsum(rng.standard_normal((n_endmembers, n_bands)), axis=1)
+    endmembers = (endmembers - endmembers.min()) / (endmembers.max() - endmembers.min())
+    abundances = rng.dirichlet(np.ones(n_endmembers), (size, size))
+    raw = 100 + 3000 * (abundances @ endmembers) + rng.normal(0, 20, (size, size, n_bands))
+    for prefix, data in [('', raw),
+                         ('DARKREF_', np.full((1, size, n_bands), 100)),
+                         ('WHITEREF_', np.full((1, size, n_bands), 3100))]:
+        spectral.envi.save_image(os.path.join(directory, f'{prefix}capture.hdr'),
+                                 np.uint16(np.clip(data, 0, 65535)),
+                                 metadata=metadata, ext='.raw', interleave=interleave, force=True)
+    return os.path.join(directory, 'capture.raw')
+
+
+def make_library(directory, n_spectra, seed=0):
+    """
+    Write n_spectra synthetic JCAMP-DX files to directory
+    """
+    rng = np.random.default_rng(seed)
+    for i in range(n_spectra):
+        y = np.cumsum(rng.standard_normal(N_BANDS))
+        y = (y - y.min()) / max(y.max() - y.min(), 1e-6)
+        metadata = hyper.Metadata(f'spectrum{i}', source_object=f'object{i % 100}', device_info='benchmark')
+        hyper.Spectrum(BANDS, y, metadata).save_jcamp(os.path.join(directory, f'spectrum{i}.jdx'))
+
+
+def timeit(func, repeats):
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    return times
+
+
+class Benchmark:
+    def __init__(self, repeats):
+        self.repeats = repeats
+        self.results = []
+
+    def run(self, name, func, **params):
+        times = timeit(func, self.repeats)
+        self.results.append({'name': name, 'params': params, 'seconds': min(times), 'times': times})
+        param_str = ', '.join(f'{k}={v}' for k, v in params.items())
+        print(f'{name:<24} {param_str:<56} {min(times) * 1000:10.1f} ms')
+
+
+def benchmark_cube(bm, directory, size):
+    file_data = make_capture(directory, size)
+    bm.run('cube_load', lambda: hyper.Cube(file_data), size=size)
+    cube = hyper.Cube(file_data)
+    bm.run('cube_to_rgb', cube.to_rgb, size=size)
+
+    query_x = np.array(cube.bands)
+    query_y = cube.data[size // 2, size // 2, :].copy()
+    for metric in hyper.Database.METRICS:
+        for use_gradient in [False, True]:
+            bm.run('compare_spectra_cube',
+                   lambda: hyper.Database.compare_spectra(query_x, cube.data, query_x, query_y,
+                                                          custom_range=(450, 950),
+                                                          use_gradient=use_gradient,
+                                                          metric=metric),
+                   size=size, metric=metric, use_gradient=use_gradient)
+
+    bm.run('pca_fit',
+           lambda: hyper.PCAModel.fit(cube.data, band_min=10, band_max=190, p_keep=0.01, n_components=10),
+           size=size)
+    pca_model = hyper.PCAModel.fit(cube.data, band_min=10, band_max=190, p_keep=0.01, n_components=10)
+    bm.run('pca_project_component',
+           lambda: hyper.PCAModel(pca_model.mean, pca_model.components, pca_model.explained_variance,
+                                  band_min=10, band_max=190).project(cube.data, 0),
+           size=size)
+    return cube
+
+
+def benchmark_access(bm, directory, size, n_queries=100, seed=0):
+    """
+    Access patterns (pixel spectra, band images, region means) on the raw data of each interleave, through the
+    interleave-aware reader of lazily opened cubes and through spectral's memory map. Note: the files are in the OS
+    cache after writing, so this measures the access pattern, not cold disk reads.
+    """
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, size, (n_queries, 2))
+    roi_size = max(size // 4, 1)
+    for interleave in hyper.EnviWriter.INTERLEAVES:
+        interleave_dir = os.path.join(directory, interleave)
+        os.makedirs(interleave_dir)
+        file_data = make_capture(interleave_dir, size, interleave=interleave)
+        cube = hyper.Cube(file_data, lazy=True)
+        img = spectral.envi.open(os.path.splitext(file_data)[0] + '.hdr', file_data)
+        memmap = img.open_memmap()
+
+        bm.run('access_pixel', lambda: [cube.reader.pixel(r, c) for r, c in pixels],
+               size=size, interleave=interleave, method='reader', n=n_queries)
+        bm.run('access_pixel', lambda: [np.array(memmap[r, c, :]) for r, c in pixels],
+               size=size, interleave=interleave, method='spectral', n=n_queries)
+        bm.run('access_band', lambda: cube.reader.band(N_BANDS // 2),
+               size=size, interleave=interleave, method='reader')
+        bm.run('access_band', lambda: np.array(memmap[:, :, N_BANDS // 2]),
+               size=size, interleave=interleave, method='spectral')
+        bm.run('access_roi_mean', lambda: cube.reader.roi_column_means((0, roi_size), (0, roi_size)).mean(axis=0),
+               size=size, interleave=interleave, method='reader', roi=roi_size)
+        bm.run('access_roi_mean', lambda: memmap[:roi_size, :roi_size, :].mean(axis=(0, 1)),
+               size=size, interleave=interleave, method='spectral', roi=roi_size)
+        bm.run('access_roi_mean', lambda: cube.roi_mean((0, roi_size), (0, roi_size)),
+               size=size, interleave=interleave, method='calibrated', roi=roi_size)
+        del memmap
+        cube.reader.close()
+
+
+def benchmark_library(bm, directory, n_spectra, cube):
+    make_library(directory, n_spectra)
+    db = hyper.Database()
+    bm.run('refresh_from_disk', lambda: db.refresh_from_disk(directory), n_spectra=n_spectra)
+    query_y = cube.data[0, 0, :].copy()
+    for metric in hyper.Database.METRICS:
+        def search():
+            return db.search_spectrum(cube.bands, query_y, custom_range=(450, 950), metric=metric)
+
+        def search_cold():
+            # memoized results would make every repeat but the first one free
+            db.clear_results_cache()
+            return search()
+        bm.run('search_spectrum', search_cold, n_spectra=n_spectra, metric=metric, cached=False)
+        bm.run('search_spectrum', search, n_spectra=n_spectra, metric=metric, cached=True)
+
+
+def benchmark_rendering(bm, file_data, size):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt6.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])
+    cwd = os.getcwd()
+    os.chdir(src_dir)
+    try:
+        config = hyper.Config('benchmark', 'config.json')
+        win = hyper.MainWindow(config, file_data)
+    finally:
+        os.chdir(cwd)
+    win.spectrum_y = win.cube.data[size // 2, size // 2, :]
+    tab_names = [win.tabs_img_ctrl.tabText(i) for i in range(win.tabs_img_ctrl.count())]
+    for tab in ['RGB', 'layers', 'similarity', 'pca']:
+        win.tabs_img_ctrl.setCurrentIndex(tab_names.index(tab))
+
+        def render_cold():
+            # recompute everything the tab depends on
+            win.set_recompute_errmap_flag()
+            win.set_recompute_pca_flag()
+            win.pca_models = {}
+            win.update_image_label()
+        bm.run('update_image_label', render_cold, size=size, tab=tab, cached=False)
+        bm.run('update_image_label', win.update_image_label, size=size, tab=tab, cached=True)
+    win.close()
+    app.processEvents()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='hyperlyse benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512], help='cube sizes (pixels per side)')
+    parser.add_argument('--library-sizes', type=int, nargs='+', default=[100, 1000],
+                        help='number of spectra in the synthetic databases (e.g. up to 50000)')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--no-gui', action='store_true', help='skip the (offscreen) rendering benchmarks')
+    parser.add_argument('--output', default=os.path.join(this_dir, 'benchmark_results.json'))
+    args = parser.parse_args()
+
+    bm = Benchmark(args.repeats)
+    tmp_dir = tempfile.mkdtemp(prefix='hyperlyse_benchmark_')
+    try:
+        cube = None
+        for size in args.sizes:
+            cube_dir = os.path.join(tmp_dir, f'cube{size}')
+            os.makedirs(cube_dir)
+            cube = benchmark_cube(bm, cube_dir, size)
+            benchmark_access(bm, os.path.join(cube_dir, 'access'), size)
+            if not args.no_gui:
+                benchmark_rendering(bm, cube.file_data, size)
+        for n_spectra in args.library_sizes:
+            benchmark_library(bm, os.path.join(tmp_dir, f'library{n_spectra}'), n_spectra, cube)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'platform': platform.platform(),
+                   'cpus': os.cpu_count(),
+                   'repeats': args.repeats,
+                   'results': bm.results}, f, indent=2)
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+import os
+import sys
+import numpy as np
+import pytest
+import spectral
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(this_dir), 'src'))
+
+N_BANDS = 40
+BANDS = list(np.linspace(400, 1000, N_BANDS))
+
+
+def write_capture(directory, nrows=12, ncols=10, interleave='bil', reference_lines=1, seed=0):
+    """
+    Write a small synthetic capture (raw data, dark and white reference) to directory
+    :return: (path of the raw data file, calibrated data as np.array)
+    """
+    rng = np.random.default_rng(seed)
+    metadata = {'wavelength': BANDS, 'sensor type': 'test'}
+    raw = rng.integers(500, 3000, (nrows, ncols, N_BANDS)).astype(np.uint16)
+    dark = rng.integers(90, 110, (reference_lines, ncols, N_BANDS)).astype(np.uint16)
+    white = rng.integers(3090, 3110, (reference_lines, ncols, N_BANDS)).astype(np.uint16)
+    for prefix, data in [('', raw), ('DARKREF_', dark), ('WHITEREF_', white)]:
+        spectral.envi.save_image(os.path.join(directory, f'{prefix}capture.hdr'), data, metadata=metadata,
+                                 ext='.raw', interleave=interleave, force=True)
+    calibrated = (raw - dark.mean(axis=0)) / (white.mean(axis=0) - dark.mean(axis=0))
+    return os.path.join(directory, 'capture.raw'), calibrated
+
+
+@pytest.fixture
+def capture(tmp_path):
+    return write_capture(str(tmp_path))
@@ -0,0 +1,141 @@
+import numpy as np
+import pytest
+import hyperlyse as hyper
+
+
+@pytest.fixture
+def segmented_cube():
+    """
+    cube of three materials in vertical stripes, with a little noise
+    """
+    rng = np.random.default_rng(0)
+    materials = rng.random((3, 25))
+    truth = np.repeat(np.arange(3), 10)[np.newaxis, :].repeat(20, axis=0)
+    return materials[truth] + rng.normal(0, 0.01, (20, 30, 25)), truth
+
+
+def same_partition(labels, truth):
+    # equal up to renaming the clusters
+    pairs = set(zip(labels.ravel().tolist(), truth.ravel().tolist()))
+    return len(pairs) == len(set(labels.ravel().tolist())) == len(set(truth.ravel().tolist()))
+
+
+@pytest.mark.parametrize('n_components', [0, 5])
+def test_kmeans_finds_materials(segmented_cube, n_components):
+    cube, truth = segmented_cube
+    labels, means = hyper.kmeans_clustering(cube, n_clusters=3, n_components=n_components, p_keep=0.5,
+                                            chunk_rows=7)
+    assert labels.shape == truth.shape
+    assert same_partition(labels, truth)
+    for label in range(3):
+        np.testing.assert_allclose(means[label], cube[labels == label].mean(axis=0), atol=1e-9)
+
+
+def test_kmeans_reuses_pca_model(segmented_cube):
+    cube, truth = segmented_cube
+    model = hyper.PCAModel.fit(cube, band_min=2, band_max=20, n_components=4)
+    labels, _ = hyper.kmeans_clustering(cube, n_clusters=3, n_components=4, pca_model=model)
+    assert same_partition(labels, truth)
+    with pytest.raises(ValueError):
+        hyper.kmeans_clustering(cube, n_components=4, feature_bands=[1, 3, 5])
+
+
+def test_pca_transform_pixels(segmented_cube):
+    cube, _ = segmented_cube
+    model = hyper.PCAModel.fit(cube, band_min=2, band_max=20, n_components=4)
+    whitened = model.transform_pixels(cube, 3)
+    for component in range(3):
+        np.testing.assert_allclose(whitened[:, :, component], model.project(cube, component), atol=1e-6)
+    scores = model.transform_pixels(cube, 3, whiten=False)
+    np.testing.assert_allclose(scores, whitened * np.sqrt(model.explained_variance[:3]), atol=1e-6)
+
+
+def test_pca_matches_sklearn(segmented_cube):
+    cube, _ = segmented_cube
+    model = hyper.PCAModel.fit(cube, n_components=3)
+    reference = hyper.principal_component_analysis(cube, n_components=3)
+    assert reference.shape == (20, 30, 3)
+    np.testing.assert_allclose(model.transform(cube), reference, atol=1e-6)
+    # unit variance of the whitened components
+    np.testing.assert_allclose(reference.reshape(-1, 3).std(axis=0, ddof=1), 1, rtol=1e-6)
+
+
+def test_pca_projections_follow_the_cube(segmented_cube):
+    cube, _ = segmented_cube
+    model = hyper.PCAModel.fit(cube, band_min=2, band_max=20, n_components=4)
+    first = model.project(cube, 0)
+    assert model.project(cube, 0) is first
+    flipped = cube[::-1]
+    np.testing.assert_allclose(model.project(flipped, 0), first[::-1])
+    np.testing.assert_allclose(model.project(cube, 0), first)
+    model.clear_projections()
+    assert model.project(cube, 0) is not first
+
+
+def test_pca_save_and_load(segmented_cube, tmp_path):
+    cube, _ = segmented_cube
+    models = [hyper.PCAModel.fit(cube, band_min=2, band_max=20, n_components=4),
+              hyper.PCAModel.fit(cube, p_keep=0.5, n_components=3, seed=7)]
+    file = str(tmp_path / 'cache' / 'pca.npz')
+    hyper.PCAModel.save_models(file, models, signature='capture 1')
+    assert hyper.PCAModel.load_models(file, signature='capture 2') == {}
+    assert hyper.PCAModel.load_models(str(tmp_path / 'missing.npz')) == {}
+    loaded = hyper.PCAModel.load_models(file, signature='capture 1')
+    assert set(loaded) == {(2, 20, 0), (0, None, 7)}
+    for model in models:
+        other = loaded[model.key()]
+        np.testing.assert_array_equal(other.components, model.components)
+        np.testing.assert_allclose(other.project(cube, 1), model.project(cube, 1))
+
+
+@pytest.fixture
+def diagonal_cube():
+    """
+    7x7 cube of material a on a diagonal line and a short horizontal line, plus a single separate pixel; material b
+    everywhere else
+    """
+    rng = np.random.default_rng(3)
+    a, b = rng.random((2, 25))
+    data = np.tile(b, (7, 7, 1))
+    region = [(0, 0), (1, 1), (2, 2), (3, 3), (3, 4), (3, 5)]
+    for row, col in region + [(6, 0)]:
+        data[row, col] = a
+    data += rng.normal(0, 1e-3, data.shape)
+    return hyper.Cube.from_array(data.astype(np.float32), np.linspace(400, 1000, 25)), region, a
+
+
+def test_grow_region_connectivity(diagonal_cube):
+    cube, region, a = diagonal_cube
+    mask, mean = hyper.grow_region(cube, (0, 0), threshold=0.05, connectivity=4)
+    assert np.flatnonzero(mask).tolist() == [0]
+    mask, mean = hyper.grow_region(cube, (0, 0), threshold=0.05, connectivity=8)
+    expected = np.zeros((7, 7), dtype=bool)
+    expected[tuple(zip(*region))] = True
+    np.testing.assert_array_equal(mask, expected)
+    np.testing.assert_allclose(mean, cube.data[mask].mean(axis=0), rtol=1e-5)
+    np.testing.assert_allclose(mean, a, atol=1e-2)
+    # starting in the horizontal line, 4-connectivity reaches its neighbours only
+    mask, _ = hyper.grow_region(cube, (3, 4), threshold=0.05, connectivity=4)
+    assert list(zip(*np.nonzero(mask))) == [(3, 3), (3, 4), (3, 5)]
+    with pytest.raises(ValueError):
+        hyper.grow_region(cube, (0, 0), threshold=0.05, connectivity=6)
+
+
+def test_grow_region_max_pixels(diagonal_cube):
+    cube, region, _ = diagonal_cube
+    for max_pixels in range(1, 8):
+        mask, mean = hyper.grow_region(cube, (0, 0), threshold=0.05, connectivity=8, max_pixels=max_pixels)
+        # breadth first: the pixels closest to the seed along the region
+        assert list(zip(*np.nonzero(mask))) == region[:max_pixels]
+        np.testing.assert_allclose(mean, cube.data[mask].mean(axis=0), rtol=1e-5)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_grow_region_whole_cube(capture, lazy):
+    file_data, calibrated = capture
+    mask, mean = hyper.grow_region(hyper.Cube(file_data, lazy=lazy), (5, 5), threshold=np.inf)
+    assert mask.all()
+    np.testing.assert_allclose(mean, calibrated.mean(axis=(0, 1)), rtol=1e-5)
+    mask, mean = hyper.grow_region(hyper.Cube(file_data, lazy=lazy), (5, 5), threshold=-1)
+    assert np.flatnonzero(mask).tolist() == [55]
+    np.testing.assert_allclose(mean, calibrated[5, 5], rtol=1e-5)
@@ -0,0 +1,73 @@
+import operator
+import numpy as np
+import pytest
+import hyperlyse as hyper
+from conftest import BANDS
+
+
+def test_parse():
+    e = hyper.Expression(' (R(800) - R(670)) / (R(800)+R(670)) ')
+    assert str(e) == '(R(800) - R(670)) / (R(800)+R(670))'
+    assert e.wavelength_ranges() == [(800, 800), (670, 670), (800, 800), (670, 670)]
+    assert e.key() == hyper.Expression('((R(800)-R(670))) / (R(800) + R(670))').key()
+    assert e.key() != hyper.Expression('(R(800) - R(670)) / (R(800) - R(670))').key()
+    assert hyper.Expression('R(560, 540)').wavelength_ranges() == [(540, 560)]
+    assert hyper.Expression('sqrt(abs(-R(500))) ** 2 + max(R(500), 0.5)').root[0] == 'binary'
+    e = hyper.Expression('depth(650, 680, 720)')
+    assert sorted(e.wavelength_ranges()) == [(650, 650), (680, 680), (720, 720)]
+    assert e.root[:2] == ('binary', operator.sub)
+
+
+@pytest.mark.parametrize('text', ['R(700', 'R(700) +', 'R()', 'R(1, 2, 3)', 'R(a)', 'R(True)', 'foo(R(500))',
+                                  'sqrt(1, 2)', 'min(R(500))', 'depth(700, 680, 650)', 'depth(650, 680)',
+                                  'R(500) > 1', 'x', '"text"', 'R(500)[0]', 'sqrt(x=1)', 'os.system(1)'])
+def test_invalid_expressions(text):
+    with pytest.raises(ValueError):
+        hyper.Expression(text)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_evaluate(capture, lazy):
+    file_data, calibrated = capture
+    cube = hyper.Cube(file_data, lazy=lazy)
+    band_math = hyper.BandMath(cube, chunk_rows=5, cache_size=2)
+    a, b = BANDS[20], BANDS[10]
+    ratio = band_math.evaluate(f'R({a}) / R({b})')
+    assert ratio.dtype == np.float32 and ratio.shape == calibrated.shape[:2]
+    np.testing.assert_allclose(ratio, calibrated[:, :, 20] / calibrated[:, :, 10], rtol=1e-5)
+    # closest band, and mean of a range
+    np.testing.assert_allclose(band_math.evaluate(f'R({a + 3}) * 2'), calibrated[:, :, 20] * 2, rtol=1e-5)
+    np.testing.assert_allclose(band_math.evaluate(f'R({BANDS[4]}, {BANDS[7]})'),
+                               calibrated[:, :, 4:8].mean(axis=-1), rtol=1e-5)
+    left, center, right = BANDS[5], BANDS[10], BANDS[20]
+    continuum = calibrated[:, :, 5] * (2 / 3) + calibrated[:, :, 20] * (1 / 3)
+    np.testing.assert_allclose(band_math.evaluate(f'depth({left}, {center}, {right})'),
+                               1 - calibrated[:, :, 10] / continuum, rtol=1e-4)
+    assert np.isnan(band_math.evaluate('R(500) * 0 / 0')).all()
+    assert np.isnan(band_math.evaluate('log(R(500) - 100)')).all()
+
+
+def test_cached_results(capture):
+    cube = hyper.Cube(capture[0])
+    band_math = hyper.BandMath(cube, cache_size=1)
+    result = band_math.evaluate('R(600) / R(500)')
+    assert band_math.evaluate('R(600)/R(500)') is result
+    assert not result.flags.writeable
+    with pytest.raises(ValueError):
+        result[0, 0] = 1
+    band_math.evaluate('R(600)')
+    assert band_math.evaluate('R(600) / R(500)') is not result
+
+
+def test_layers(capture):
+    cube = hyper.Cube(capture[0], lazy=True)
+    band_math = hyper.BandMath(cube)
+    layers = band_math.layers(f'R({BANDS[3]}, {BANDS[5]}) + R({BANDS[30] + 1})')
+    assert layers == {(BANDS[3], BANDS[5]): [3, 4, 5], (BANDS[30] + 1, BANDS[30] + 1): [30]}
+    # a range between two bands: the closest one
+    assert band_math.layers(f'R({BANDS[3] + 1}, {BANDS[3] + 2})') == {(BANDS[3] + 1, BANDS[3] + 2): [3]}
+    assert band_math.parse('R(500)') is band_math.parse('R(500)')
+    with pytest.raises(ValueError, match='outside'):
+        band_math.layers('R(1200)')
+    with pytest.raises(ValueError):
+        band_math.evaluate('R(300) / R(500)')
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import hyperlyse as hyper
+from hyperlyse.batch import grid_regions, clip_regions, read_regions_csv, region_means, thumbnail
+
+
+def test_grid_regions():
+    regions = grid_regions(10, 12, step=4, size=3)
+    # grid points 0, 4, 8 (rows) and 1, 5, 9 (columns), regions centered on them
+    assert len(regions) == 9
+    np.testing.assert_array_equal(regions[0], [0, 0, 3, 2])
+    np.testing.assert_array_equal(regions[4], [4, 3, 3, 3])
+    np.testing.assert_array_equal(regions[-1], [8, 7, 3, 3])
+    inside = grid_regions(100, 100, step=5, rect=(10, 20, 10, 5))
+    assert (inside[:, 0] >= 10).all() and (inside[:, 0] < 20).all()
+    assert (inside[:, 1] >= 20).all() and (inside[:, 1] < 25).all()
+    assert (inside[:, 2:] == 1).all()
+
+
+def test_clip_regions():
+    clipped = clip_regions([[-2, -1, 5, 4], [8, 3, 10, 2], [20, 0, 3, 3]], 6, 10)
+    np.testing.assert_array_equal(clipped, [[0, 0, 3, 3], [8, 3, 2, 2], [10, 0, 0, 3]])
+
+
+@pytest.mark.parametrize('delimiter', [',', ';', '\t'])
+def test_read_regions_csv(tmp_path, delimiter):
+    file = tmp_path / 'regions.csv'
+    lines = [['x', 'y', 'w', 'h', 'name'], ['3', '4'], [], ['1', '2', '5', '6', 'red area'], ['7.6', '0', 'point']]
+    file.write_text('\n'.join(delimiter.join(line) for line in lines) + '\n')
+    regions, names = read_regions_csv(str(file))
+    np.testing.assert_array_equal(regions, [[3, 4, 1, 1], [1, 2, 5, 6], [8, 0, 1, 1]])
+    assert names == ['', 'red area', 'point']
+
+
+def test_read_regions_csv_errors(tmp_path):
+    file = tmp_path / 'regions.csv'
+    file.write_text('1,2\n1,2,3\n')
+    with pytest.raises(ValueError, match='line 2'):
+        read_regions_csv(str(file))
+    file.write_text('1,2\nname\n')
+    with pytest.raises(ValueError):
+        read_regions_csv(str(file))
+    file.write_text('')
+    regions, names = read_regions_csv(str(file))
+    assert regions.shape == (0, 4) and names == []
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_region_means(capture, lazy):
+    file_data, calibrated = capture
+    cube = hyper.Cube(file_data, lazy=lazy)
+    regions = np.array([[0, 0, 1, 1], [2, 3, 4, 5], [3, 4, 4, 2], [9, 11, 1, 1], [5, 5, 0, 0]])
+    means = region_means(cube, regions)
+    assert means.shape == (5, cube.nbands) and means.dtype == np.float32
+    for (x, y, w, h), mean in zip(regions[:4], means[:4]):
+        np.testing.assert_allclose(mean, calibrated[y:y + h, x:x + w].mean(axis=(0, 1)), rtol=1e-5)
+    assert (means[4] == 0).all()
+    assert (region_means(cube, np.zeros((2, 4), dtype=int)) == 0).all()
+
+
+def test_thumbnail():
+    img = np.zeros((50, 60, 3), dtype=np.uint8)
+    thumb = thumbnail(img, (20, 10, 5, 4), padding=5)
+    assert thumb.shape == (14, 15, 3)
+    assert (thumb[4, 4:11] == (255, 0, 0)).all()
+    assert (thumb[9, 4:11] == (255, 0, 0)).all()
+    assert (thumb[5:9, 5:10] == 0).all()
+    assert (img == 0).all()
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+import hyperlyse as hyper
+
+
+def reference_distance(y, q, metric, use_gradient=False):
+    if use_gradient:
+        y, q = np.gradient(y), np.gradient(q)
+    if metric == 'correlation':
+        return 1 - np.corrcoef(y, q)[0, 1]
+    cos = np.dot(y, q) / (np.linalg.norm(y) * np.linalg.norm(q))
+    if metric == 'sam':
+        return np.arccos(np.clip(cos, -1, 1))
+    return np.linalg.norm(y / np.linalg.norm(y) - q / np.linalg.norm(q))
+
+
+@pytest.fixture
+def spectra():
+    rng = np.random.default_rng(0)
+    x = np.linspace(400, 1000, 50)
+    cube = rng.random((4, 5, x.size)) + 0.5
+    return x, cube, cube[1, 2] * 1.7 + 0.01 * rng.random(x.size)
+
+
+@pytest.mark.parametrize('metric', ['sam', 'correlation', 'euclidean'])
+@pytest.mark.parametrize('use_gradient', [False, True])
+def test_metrics_match_definition(spectra, metric, use_gradient):
+    x, cube, query = spectra
+    distances = hyper.Database.compare_spectra(x, cube, x, query, metric=metric, use_gradient=use_gradient)
+    assert distances.shape == cube.shape[:2]
+    expected = [[reference_distance(cube[r, c], query, metric, use_gradient) for c in range(cube.shape[1])]
+                for r in range(cube.shape[0])]
+    np.testing.assert_allclose(distances, expected, atol=1e-6)
+    # a single spectrum gives the same distance as the same pixel of the cube
+    single = hyper.Database.compare_spectra(x, cube[3, 4], x, query, metric=metric, use_gradient=use_gradient)
+    assert single == pytest.approx(distances[3, 4], abs=1e-6)
+
+
+@pytest.mark.parametrize('metric', ['sam', 'correlation', 'euclidean'])
+def test_metrics_are_scale_invariant(spectra, metric):
+    x, cube, query = spectra
+    distance = hyper.Database.compare_spectra(x, query, x, query * 3.5, metric=metric)
+    assert distance == pytest.approx(0, abs=1e-6)
+
+
+def test_error_metric(spectra):
+    x, cube, query = spectra
+    errors = hyper.Database.compare_spectra(x, cube, x, query)
+    np.testing.assert_allclose(errors, np.mean((cube - query) ** 2, axis=-1), rtol=1e-6)
+    errors = hyper.Database.compare_spectra(x, cube, x, query, squared_errs=False)
+    np.testing.assert_allclose(errors, np.mean(np.abs(cube - query), axis=-1), rtol=1e-6)
+
+
+def test_unknown_metric(spectra):
+    x, cube, query = spectra
+    with pytest.raises(ValueError):
+        hyper.Database.compare_spectra(x, cube, x, query, metric='manhattan')
+
+
+@pytest.mark.parametrize('use_gradient', [False, True])
+def test_pixel_stats(spectra, use_gradient):
+    x, cube, query = spectra
+    stats = {}
+    preprocessing = hyper.Preprocessing(smoothing=5)
+    kwargs = dict(metric='sam', use_gradient=use_gradient, preprocessing=preprocessing, custom_range=(450, 900))
+    first = hyper.Database.compare_spectra(x, cube, x, query, pixel_stats=stats, **kwargs)
+    assert len(stats) == 1
+    np.testing.assert_allclose(hyper.Database.compare_spectra(x, cube, x, query * 2, pixel_stats=stats, **kwargs),
+                               first, atol=1e-6)
+    assert len(stats) == 1
+    hyper.Database.compare_spectra(x, cube, x, query, pixel_stats=stats, metric='correlation')
+    assert len(stats) == 2
+    # without stats of the caller, changes of the cube are always seen
+    cube[:2] = cube[:2] ** 3
+    changed = hyper.Database.compare_spectra(x, cube, x, query, metric='sam', use_gradient=use_gradient)
+    expected = [[reference_distance(cube[r, c], query, 'sam', use_gradient) for c in range(cube.shape[1])]
+                for r in range(cube.shape[0])]
+    np.testing.assert_allclose(changed, expected, atol=1e-6)
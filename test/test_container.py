@@ -0,0 +1,63 @@
+import zipfile
+import numpy as np
+import pytest
+import hyperlyse as hyper
+
+
+@pytest.fixture
+def data():
+    return np.random.default_rng(0).random((21, 13, 9)).astype(np.float32)
+
+
+def write(file, data, chunk_shape=(4, 5, 4)):
+    with hyper.ContainerWriter(file, data.shape, np.arange(data.shape[2]) * 10 + 400, chunk_shape=chunk_shape,
+                               metadata={'device': 'test'}) as writer:
+        writer.write_rows(0, data[:8])
+        writer.write_rows(8, data[8:])
+
+
+def test_round_trip(tmp_path, data):
+    file = str(tmp_path / 'cube.hlc')
+    write(file, data)
+    container = hyper.ContainerFile(file, cache_size=4)
+    assert container.shape == data.shape
+    assert container.metadata == {'device': 'test'}
+    assert container.bands[:2] == [400, 410]
+    np.testing.assert_array_equal(container.read((0, 21), (0, 13)), data)
+    np.testing.assert_array_equal(container.read((3, 17), (2, 11), (1, 7)), data[3:17, 2:11, 1:7])
+    np.testing.assert_array_equal(container.pixel(20, 12), data[20, 12])
+    np.testing.assert_array_equal(container.band(8), data[:, :, 8])
+    np.testing.assert_array_equal(container.rows(5, 9), data[5:9])
+    np.testing.assert_allclose(container.roi_column_means((2, 19), (1, 12)), data[2:19, 1:12].mean(axis=0),
+                               rtol=1e-6)
+    rows, cols = np.array([0, 4, 4, 20, 7]), np.array([12, 0, 9, 3, 5])
+    np.testing.assert_array_equal(container.pixels(rows, cols), data[rows, cols])
+    assert container.pixels(np.array([], dtype=int), np.array([], dtype=int)).shape == (0, 9)
+    container.close()
+
+
+def test_not_a_container(tmp_path):
+    file = str(tmp_path / 'other.hlc')
+    with zipfile.ZipFile(file, 'w') as z:
+        z.writestr('header.json', '{"format": "something else"}')
+    with pytest.raises(ValueError):
+        hyper.ContainerFile(file)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_save_container(capture, tmp_path, lazy):
+    file_data, calibrated = capture
+    cube = hyper.Cube(file_data, lazy=lazy)
+    file = str(tmp_path / 'capture.hlc')
+    cube.save_container(file, chunk_shape=(5, 4, 16))
+    loaded = hyper.Cube(file, lazy=True)
+    assert loaded.data is None
+    np.testing.assert_allclose(loaded.bands, cube.bands)
+    np.testing.assert_allclose(loaded.roi((0, 12), (0, 10)), calibrated, rtol=1e-5)
+    np.testing.assert_allclose(loaded.pixel_spectrum(11, 9), calibrated[11, 9], rtol=1e-5)
+    np.testing.assert_allclose(hyper.Cube(file).data, calibrated, rtol=1e-5)
+    container = hyper.ContainerFile(file)
+    assert container.pyramid_levels() == [(12, 10)]
+    assert container.pyramid(0).dtype == np.uint8
+    assert not container.has_products()
+    container.close()
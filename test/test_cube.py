@@ -0,0 +1,47 @@
+import warnings
+import numpy as np
+import pytest
+import spectral
+import hyperlyse as hyper
+from conftest import write_capture
+
+
+@pytest.mark.parametrize('interleave', ['bsq', 'bil', 'bip'])
+@pytest.mark.parametrize('reference_lines', [1, 3])
+def test_calibration(tmp_path, interleave, reference_lines):
+    file_data, calibrated = write_capture(str(tmp_path), interleave=interleave, reference_lines=reference_lines)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        cube = hyper.Cube(file_data)
+    assert type(cube.data) is np.ndarray
+    np.testing.assert_allclose(cube.data, calibrated, rtol=1e-5)
+    # loaded data does not keep the file open
+    assert cube.reader is None
+    cube = hyper.Cube(file_data, lazy=True)
+    assert cube.data is None and isinstance(cube.reader, hyper.EnviReader)
+    np.testing.assert_allclose(cube.pixel_spectrum(3, 4), calibrated[3, 4], rtol=1e-5)
+    np.testing.assert_allclose(cube.band_image(7), calibrated[:, :, 7], rtol=1e-5)
+    np.testing.assert_allclose(cube.roi((2, 9), (1, 6)), calibrated[2:9, 1:6], rtol=1e-5)
+    np.testing.assert_allclose(cube.roi_mean((2, 9), (1, 6)), calibrated[2:9, 1:6].mean(axis=(0, 1)), rtol=1e-5)
+    np.testing.assert_allclose(cube.pixels(np.array([0, 5, 11]), np.array([9, 2, 0])),
+                               calibrated[[0, 5, 11], [9, 2, 0]], rtol=1e-5)
+
+
+def test_missing_references(tmp_path, capsys):
+    file_data, _ = write_capture(str(tmp_path))
+    (tmp_path / 'WHITEREF_capture.hdr').unlink()
+    cube = hyper.Cube(file_data, lazy=True)
+    assert 'No reference spectra found' in capsys.readouterr().out
+    raw = np.asarray(spectral.envi.open(str(tmp_path / 'capture.hdr'), file_data).load())
+    np.testing.assert_allclose(cube.pixel_spectrum(1, 1), raw[1, 1], rtol=1e-6)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_save_envi(capture, tmp_path, lazy):
+    file_data, calibrated = capture
+    cube = hyper.Cube(file_data, lazy=lazy)
+    file_header = str(tmp_path / 'export.hdr')
+    saved = cube.save_envi(file_header, interleave='bip', binning=2, chunk_rows=4)
+    image = spectral.envi.open(file_header, saved)
+    expected = calibrated.reshape(6, 2, 5, 2, -1).mean(axis=(1, 3))
+    np.testing.assert_allclose(np.asarray(image.load()), expected, rtol=1e-5)
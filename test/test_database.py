@@ -0,0 +1,119 @@
+import os
+import numpy as np
+import pytest
+import hyperlyse as hyper
+
+
+@pytest.fixture
+def database(tmp_path):
+    rng = np.random.default_rng(0)
+    x = np.linspace(400, 1000, 60)
+    for i in range(6):
+        y = np.cumsum(rng.standard_normal(x.size))
+        hyper.Spectrum(x, y, hyper.Metadata(f'spectrum{i}', source_object=f'object{i % 2}')).save_jcamp(
+            str(tmp_path / f'spectrum{i}.jdx'))
+    return hyper.Database(str(tmp_path))
+
+
+def test_search(database):
+    query = database.spectra[3]
+    results = database.search_spectrum(query.x, query.y)
+    assert len(results) == 6
+    assert results[0]['index'] == 3
+    assert results[0]['error'] == pytest.approx(0, abs=1e-9)
+    errors = [r['error'] for r in results]
+    assert errors == sorted(errors)
+    assert [r['index'] for r in database.search_spectrum(query.x, query.y, k=2)] == [r['index'] for r in results[:2]]
+    filtered = database.search_spectrum(query.x, query.y, indices=database.filter(source_object='object0'))
+    assert {r['spectrum'].metadata.source_object for r in filtered} == {'object0'}
+    assert len(filtered) == 3
+
+
+def test_memoized_results_are_not_shared(database):
+    query = database.spectra[1]
+    results = database.search_spectrum(query.x, query.y, metric='sam')
+    n = len(results)
+    results.reverse()
+    del results[1:]
+    results[0]['note'] = 'changed by the caller'
+    again = database.search_spectrum(query.x, query.y, metric='sam')
+    assert len(again) == n
+    assert again[0]['index'] == 1
+    assert 'note' not in again[0]
+
+
+def test_memoized_results_follow_changes(database):
+    query = database.spectra[2]
+    removed = query.metadata.id
+    assert len(database.search_spectrum(query.x, query.y)) == 6
+    database.remove_indices([2])
+    results = database.search_spectrum(query.x, query.y)
+    assert len(results) == 5
+    assert removed not in [r['spectrum'].metadata.id for r in results]
+    database.clear_results_cache()
+    assert len(database.search_spectrum(query.x, query.y)) == 5
+
+
+def write_spectrum(file, y, name, mtime=None):
+    x = np.linspace(400, 1000, y.size)
+    hyper.Spectrum(x, y, hyper.Metadata(name)).save_jcamp(str(file))
+    if mtime is not None:
+        os.utime(file, ns=(mtime, mtime))
+
+
+def test_sync_from_disk(database, tmp_path):
+    assert database.sync_from_disk() == ([], [], [])
+    version = database.version
+    files = list(database.files)
+    ids = [s.metadata.id for s in database.spectra]
+    changed, deleted = files[1], files[4]
+    write_spectrum(changed, np.ones(60), 'changed', mtime=os.stat(changed).st_mtime_ns + 10 ** 9)
+    os.remove(deleted)
+    (tmp_path / 'sub').mkdir()
+    write_spectrum(tmp_path / 'sub' / 'new.jdx', np.arange(60.0), 'new')
+    (tmp_path / 'bad.dpt').write_text('not a spectrum\n')
+
+    added, updated, removed = database.sync_from_disk(n_jobs=2)
+    assert removed == [4]
+    # indices after the update
+    assert updated == [1] and database.spectra[1].metadata.id == 'changed'
+    np.testing.assert_array_equal(database.spectra[1].y, 1)
+    assert added == [5] and database.spectra[5].metadata.id == 'new'
+    assert database.files[5] == os.path.normpath(str(tmp_path / 'sub' / 'new.jdx'))
+    assert [s.metadata.id for s in database.spectra][:5] == ids[:1] + ['changed'] + ids[2:4] + ids[5:]
+    assert database.files[:5] == files[:4] + files[5:]
+    assert [f for f, _ in database.errors] == [os.path.normpath(str(tmp_path / 'bad.dpt'))]
+    assert database.version > version
+
+    # nothing changed: nothing is read again, the bad file is not retried
+    version = database.version
+    assert database.sync_from_disk() == ([], [], [])
+    assert database.version == version and len(database.errors) == 1
+    # a modified file that cannot be loaded any more is removed
+    (tmp_path / 'bad.dpt').unlink()
+    broken = database.files[2]
+    with open(broken, 'w') as f:
+        f.write('garbage\n')
+    os.utime(broken, ns=(os.stat(broken).st_mtime_ns + 10 ** 9,) * 2)
+    added, updated, removed = database.sync_from_disk()
+    assert (added, updated, removed) == ([], [], [2])
+    assert broken not in database.files and len(database.spectra) == 5
+    assert [f for f, _ in database.errors] == [broken]
+
+
+def test_add_file(database, tmp_path):
+    n = len(database.spectra)
+    file = tmp_path / 'exported.jdx'
+    write_spectrum(file, np.ones(60), 'exported')
+    index = database.add_file(str(file))
+    assert index == n and database.spectra[index].metadata.id == 'exported'
+    # the same file again: replaced, not added
+    write_spectrum(file, np.full(60, 2.0), 'exported again')
+    assert database.add_file(str(file)) == n
+    assert len(database.spectra) == n + 1
+    np.testing.assert_array_equal(database.spectra[n].y, 2)
+    bad = tmp_path / 'bad.jdx'
+    bad.write_text('##TITLE= bad\n##END=\n')
+    assert database.add_file(str(bad)) is None
+    assert len(database.spectra) == n + 1 and len(database.errors) == 1
+    assert str(bad) in database.error_report()
@@ -0,0 +1,54 @@
+import os
+import numpy as np
+import pytest
+import spectral
+import hyperlyse as hyper
+
+
+@pytest.fixture
+def data():
+    return np.random.default_rng(0).random((9, 7, 5)).astype(np.float32)
+
+
+@pytest.mark.parametrize('interleave', hyper.EnviWriter.INTERLEAVES)
+def test_writer_round_trip(tmp_path, data, interleave):
+    file_header = str(tmp_path / 'image.hdr')
+    with hyper.EnviWriter(file_header, *data.shape, interleave=interleave,
+                          metadata={'wavelength': [500, 600, 700, 800, 900]}) as writer:
+        writer.write_rows(0, data[:4])
+        writer.write_rows(4, data[4:])
+    image = spectral.envi.open(file_header, writer.file_data)
+    assert image.metadata['interleave'] == interleave
+    assert [float(w) for w in image.metadata['wavelength']] == [500, 600, 700, 800, 900]
+    np.testing.assert_array_equal(np.asarray(image.load()), data)
+    # the reader gives the same data for every access pattern
+    reader = hyper.EnviReader(file_header, writer.file_data)
+    np.testing.assert_array_equal(reader.roi((2, 8), (1, 6)), data[2:8, 1:6])
+    np.testing.assert_array_equal(reader.band(3), data[:, :, 3])
+    np.testing.assert_array_equal(reader.pixel(4, 5), data[4, 5])
+    np.testing.assert_allclose(reader.roi_column_means((1, 9), (0, 7)), data[1:9].mean(axis=0), rtol=1e-6)
+    reader.close()
+
+
+def test_write_bands(tmp_path, data):
+    layers = [data[:, :, b] for b in range(data.shape[2])]
+    file_data = hyper.save_envi(str(tmp_path / 'layers.hdr'), layers, *data.shape, interleave='bip')
+    image = spectral.envi.open(str(tmp_path / 'layers.hdr'), file_data)
+    np.testing.assert_array_equal(np.asarray(image.load()), data)
+
+
+def test_unknown_interleave(tmp_path):
+    with pytest.raises(ValueError):
+        hyper.EnviWriter(str(tmp_path / 'image.hdr'), 2, 2, 2, interleave='bxl')
+
+
+def test_save_cube_subset(capture, tmp_path):
+    file_data, calibrated = capture
+    cube = hyper.Cube(file_data)
+    file_header = str(tmp_path / 'subset.hdr')
+    saved = cube.save_envi(file_header, rows=(1, 11), cols=(2, 9), bands=(3, 30), binning=2, chunk_rows=2)
+    assert os.path.isfile(saved)
+    image = spectral.envi.open(file_header, saved)
+    expected = calibrated[1:11, 2:8, 3:30].reshape(5, 2, 3, 2, 27).mean(axis=(1, 3))
+    np.testing.assert_allclose(np.asarray(image.load()), expected, rtol=1e-5)
+    np.testing.assert_allclose([float(w) for w in image.metadata['wavelength']], cube.bands[3:30])
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+from hyperlyse.preprocessing import Preprocessing
+
+
+def brute_force_hull(x, y):
+    # at each band: the highest line between two points left and right of it
+    hull = y.copy()
+    for j in range(x.size):
+        for i in range(j + 1):
+            for k in range(j, x.size):
+                if k > i:
+                    hull[j] = max(hull[j], y[i] + (x[j] - x[i]) / (x[k] - x[i]) * (y[k] - y[i]))
+    return hull
+
+
+def test_upper_hull():
+    rng = np.random.default_rng(0)
+    x = np.sort(rng.uniform(400, 1000, 25))
+    y = rng.random((30, 25))
+    y[3] = 1                    # flat
+    y[4] = np.linspace(0, 1, 25)  # straight line
+    hull = Preprocessing.upper_hull(x, y)
+    expected = np.array([brute_force_hull(x, s) for s in y])
+    np.testing.assert_allclose(hull, expected, rtol=1e-10, atol=1e-12)
+    # processing in blocks gives the same result
+    np.testing.assert_allclose(Preprocessing.upper_hull(x, y, block_size=7), hull)
+
+
+def test_parse_ranges():
+    assert Preprocessing.parse_ranges('1340-1460, 1960 - 1790;') == [(1340, 1460), (1790, 1960)]
+    assert Preprocessing.parse_ranges('') == []
+    with pytest.raises(ValueError):
+        Preprocessing.parse_ranges('1340-')
+
+
+def test_settings():
+    with pytest.raises(ValueError):
+        Preprocessing(normalization='max')
+    with pytest.raises(ValueError):
+        Preprocessing(derivative=3)
+    assert Preprocessing().is_identity()
+    assert Preprocessing(smoothing=2, polyorder=5).is_identity()
+    p = Preprocessing(smoothing=7, derivative=1, normalization='vector', band_mask=[(500, 600)])
+    assert Preprocessing.from_dict(p.to_dict()) == p
+    assert hash(Preprocessing.from_dict(p.to_dict())) == hash(p)
+    assert p.describe() == 'mask 500-600, smooth 7, derivative 1, vector norm.'
+    assert Preprocessing().describe() == 'none'
+
+
+def test_apply():
+    x = np.linspace(400, 1000, 61)
+    y = np.stack([2 * x + 5, np.sin(x / 40) + 2])
+    x_out, y_out = Preprocessing().apply(x, y)
+    np.testing.assert_array_equal(y_out, y)
+    x_out, y_out = Preprocessing(band_mask=[(450, 500), (900, 2000)]).apply(x, y)
+    assert x_out.size == 61 - 6 - 11 and y_out.shape == (2, x_out.size)
+    assert not ((x_out >= 450) & (x_out <= 500)).any()
+    _, y_out = Preprocessing(derivative=1).apply(x, y)
+    np.testing.assert_allclose(y_out[0], 2)
+    _, y_out = Preprocessing(derivative=2).apply(x, y[0])
+    np.testing.assert_allclose(y_out, 0, atol=1e-9)
+    _, y_out = Preprocessing(normalization='vector').apply(x, y)
+    np.testing.assert_allclose(np.linalg.norm(y_out, axis=-1), 1)
+    _, y_out = Preprocessing(normalization='area').apply(x, y)
+    np.testing.assert_allclose(np.trapezoid(np.abs(y_out), x, axis=-1), 1)
+    _, y_out = Preprocessing(continuum_removal=True).apply(x, y)
+    assert (y_out <= 1 + 1e-9).all()
+    np.testing.assert_allclose(y_out[0], 1)
+    _, smoothed = Preprocessing(smoothing=9).apply(x, y[0])
+    np.testing.assert_allclose(smoothed, y[0])    # a line is kept by the filter
+    # spectra of a cube, and single spectra
+    cube = np.random.default_rng(0).random((3, 4, 61)).astype(np.float32)
+    p = Preprocessing(smoothing=5, continuum_removal=True, normalization='vector')
+    _, cube_out = p.apply(x, cube)
+    assert cube_out.shape == cube.shape and cube_out.dtype == np.float32
+    np.testing.assert_allclose(cube_out[2, 1], p.apply(x, cube[2, 1])[1], rtol=1e-6)
+
+
+def test_apply_cube(monkeypatch):
+    x = np.linspace(400, 1000, 30)
+    cube = np.random.default_rng(0).random((9, 5, 30)).astype(np.float32)
+    p = Preprocessing(smoothing=5, derivative=1, band_mask=[(600, 700)])
+    x_out, data = p.apply_cube(x, cube, chunk_rows=2)
+    np.testing.assert_allclose(data, p.apply(x, cube)[1], rtol=1e-6)
+    np.testing.assert_array_equal(x_out, p.apply(x, cube)[0])
+    # cached per cube and parameter set
+    assert p.apply_cube(x, cube)[1] is data
+    assert Preprocessing().apply_cube(x, cube)[1] is cube
+    monkeypatch.setattr(Preprocessing, 'cube_cache_size', 0)
+    q = Preprocessing(smoothing=7)
+    assert q.apply_cube(x, cube)[1] is not q.apply_cube(x, cube)[1]
+    monkeypatch.setattr(Preprocessing, 'cube_cache_size', 1)
+    monkeypatch.setattr(Preprocessing, 'cube_cache_max_bytes', cube.nbytes - 1)
+    assert q.apply_cube(x, cube)[1] is not q.apply_cube(x, cube)[1]
+
@@ -0,0 +1,106 @@
+import zipfile
+import numpy as np
+import pytest
+import hyperlyse as hyper
+
+
+@pytest.fixture
+def products(tmp_path):
+    rng = np.random.default_rng(0)
+    error_map = rng.random((11, 9)).astype(np.float32)
+    components = rng.random((11, 9, 3))
+    labels = rng.integers(0, 5, (11, 9)).astype(np.int16)
+    file = str(tmp_path / 'results.npz')
+    computed = []
+
+    def lazy_layers():
+        for i in range(2):
+            computed.append(i)
+            yield labels + i
+
+    with hyper.ProductWriter(file, tile_size=4, metadata={'source_file': 'capture.raw'}) as writer:
+        writer.add('error', error_map, params={'metric': 'sam'})
+        writer.add('pca', components, layer_names=['PC 1', 'PC 2'])
+        writer.add('labels', lazy_layers(), kind='labels')
+        # layers are computed while the product is written
+        assert computed == [0, 1]
+    return file, error_map, components, labels
+
+
+def test_read(products):
+    file, error_map, components, labels = products
+    product_file = hyper.ProductFile(file)
+    assert len(product_file) == 3 and [p.name for p in product_file] == ['error', 'pca', 'labels']
+    assert product_file.metadata == {'source_file': 'capture.raw'}
+
+    error = product_file['error']
+    assert error.shape == (11, 9, 1) and error.dtype == np.float32 and error.kind == 'map'
+    assert error.params == {'metric': 'sam'}
+    np.testing.assert_array_equal(error.read(), error_map)
+
+    pca = product_file['pca']
+    assert pca.n_layers == 3 and pca.dtype == np.float64
+    assert [pca.layer_name(i) for i in range(3)] == ['PC 1', 'PC 2', 'pca 2']
+    for layer in range(3):
+        np.testing.assert_array_equal(pca.read(layer), components[:, :, layer])
+
+    lazy = product_file['labels']
+    assert lazy.kind == 'labels' and lazy.n_layers == 2 and lazy.dtype == np.int16
+    np.testing.assert_array_equal(lazy.read(1), labels + 1)
+    product_file.close()
+
+
+@pytest.mark.parametrize('rows, cols', [((0, 11), (0, 9)),
+                                        ((3, 5), (3, 5)),       # across the borders of four tiles
+                                        ((4, 8), (4, 8)),       # exactly one tile
+                                        ((5, 6), (7, 8)),       # inside a tile
+                                        ((2, 11), (6, 9)),      # incomplete tiles at the border
+                                        ((0, 1), (0, 9))])
+def test_read_window(products, rows, cols):
+    file, _, components, _ = products
+    product_file = hyper.ProductFile(file)
+    window = product_file['pca'].read(2, rows, cols)
+    np.testing.assert_array_equal(window, components[rows[0]:rows[1], cols[0]:cols[1], 2])
+    product_file.close()
+
+
+def test_errors(tmp_path):
+    file = str(tmp_path / 'results.npz')
+    with hyper.ProductWriter(file) as writer:
+        writer.add('map', np.zeros((3, 4)))
+        with pytest.raises(ValueError):
+            writer.add('map', np.zeros((3, 4)))
+        with pytest.raises(ValueError, match='no layers'):
+            writer.add('empty', iter([]))
+        with pytest.raises(ValueError, match='no layers'):
+            writer.add('empty array', np.zeros((3, 4, 0)))
+        with pytest.raises(ValueError):
+            writer.add('shapes', [np.zeros((3, 4)), np.zeros((4, 3))])
+        with pytest.raises(ValueError):
+            writer.add('1d', [np.zeros(3)])
+    product_file = hyper.ProductFile(file)
+    assert [p.name for p in product_file] == ['map']
+    product_file.close()
+
+    with zipfile.ZipFile(str(tmp_path / 'other.npz'), 'w') as f:
+        f.writestr('products.json', '{"format": "other"}')
+    with pytest.raises(ValueError):
+        hyper.ProductFile(str(tmp_path / 'other.npz'))
+
+
+def test_failed_write(tmp_path):
+    file = str(tmp_path / 'results.npz')
+
+    def failing_layers():
+        yield np.zeros((3, 4))
+        raise RuntimeError('analysis failed')
+
+    with pytest.raises(RuntimeError):
+        with hyper.ProductWriter(file) as writer:
+            writer.add('map', np.zeros((3, 4)))
+            writer.add('failing', failing_layers())
+    # no index: the archive is not mistaken for a complete one
+    with zipfile.ZipFile(file) as f:
+        assert 'products.json' not in f.namelist()
+    with pytest.raises(ValueError, match='writing it failed'):
+        hyper.ProductFile(file)
@@ -0,0 +1,69 @@
+import json
+import tracemalloc
+import numpy as np
+import pytest
+from hyperlyse.profiling import Profiler, logger
+
+
+@pytest.fixture
+def profiler():
+    handlers = list(logger.handlers)
+    tracing = tracemalloc.is_tracing()
+    yield Profiler()
+    for handler in logger.handlers:
+        if handler not in handlers:
+            logger.removeHandler(handler)
+            handler.close()
+    if not tracing:
+        tracemalloc.stop()
+
+
+def test_spans(profiler, tmp_path):
+    with profiler.span('disabled'):
+        pass
+    assert len(profiler.spans) == 0
+    profiler.configure()
+    records = []
+    profiler.add_listener(records.append)
+
+    @profiler.timed()
+    def work(n):
+        return sum(range(n))
+
+    with profiler.span('outer', size=3):
+        assert work(1000) == 499500
+        work(10)
+    assert [r['name'] for r in records] == ['test_spans.<locals>.work'] * 2 + ['outer']
+    assert [r['depth'] for r in records] == [1, 1, 0]
+    assert records[-1]['args'] == {'size': 3}
+    summary = profiler.summary()
+    assert summary['test_spans.<locals>.work']['count'] == 2
+    assert summary['outer']['total'] >= summary['test_spans.<locals>.work']['total']
+    profiler.dump(str(tmp_path / 'spans.json'))
+    assert len(json.loads((tmp_path / 'spans.json').read_text())['spans']) == 3
+    profiler.dump(str(tmp_path / 'spans.trace.json'))
+    events = json.loads((tmp_path / 'spans.trace.json').read_text())['traceEvents']
+    assert [e['ph'] for e in events] == ['X'] * 3
+
+
+def test_log_file(profiler, tmp_path):
+    n_handlers = len(logger.handlers)
+    profiler.configure(log_file=str(tmp_path / 'first.log'))
+    profiler.configure(log_file=str(tmp_path / 'second.log'))
+    assert len(logger.handlers) == n_handlers + 1
+    with profiler.span('logged'):
+        pass
+    assert (tmp_path / 'first.log').read_text() == ''
+    assert (tmp_path / 'second.log').read_text().count('logged: ') == 1
+
+
+def test_peak_memory(profiler):
+    profiler.configure(track_memory=True)
+    with profiler.span('outer'):
+        with profiler.span('inner'):
+            data = np.ones(2 ** 20)
+        del data
+    inner, outer = profiler.spans
+    assert inner['peak_memory'] is None
+    assert outer['peak_memory'] >= 8 * 2 ** 20
+    assert 'peak' in Profiler.format_span(outer) and 'peak' not in Profiler.format_span(inner)
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+import hyperlyse as hyper
+from hyperlyse import resampling
+
+
+def brute_force_integration(x_source, y, x_target):
+    # mean of the piecewise constant source spectrum over each target band
+    edges_source = resampling._band_edges(x_source)
+    edges_target = resampling._band_edges(x_target)
+    result = []
+    for lo, hi in zip(edges_target[:-1], edges_target[1:]):
+        overlap = np.maximum(np.minimum(hi, edges_source[1:]) - np.maximum(lo, edges_source[:-1]), 0)
+        result.append((overlap * y).sum() / overlap.sum())
+    return np.array(result)
+
+
+@pytest.fixture
+def grids():
+    rng = np.random.default_rng(0)
+    x_fine = np.sort(rng.uniform(400, 1000, 120))
+    x_coarse = np.linspace(420, 980, 25)
+    return x_fine, x_coarse, rng.random(x_fine.size)
+
+
+def test_linear(grids):
+    x_fine, x_coarse, y = grids
+    x_target = np.concatenate([[300], x_coarse, [1100]])
+    matrix = hyper.resampling_matrix(x_fine, x_target, 'linear')
+    assert matrix.shape == (x_target.size, x_fine.size)
+    np.testing.assert_allclose(matrix @ y, np.interp(x_target, x_fine, y), rtol=1e-12)
+    np.testing.assert_allclose(np.asarray(matrix.sum(axis=1)).ravel(), 1)
+
+
+def test_integrate(grids):
+    x_fine, x_coarse, y = grids
+    matrix = hyper.resampling_matrix(x_fine, x_coarse, 'integrate')
+    np.testing.assert_allclose(matrix @ y, brute_force_integration(x_fine, y, x_coarse), rtol=1e-10)
+    np.testing.assert_allclose(np.asarray(matrix.sum(axis=1)).ravel(), 1)
+    assert (matrix.data > 0).all()
+    # target bands beyond the source: constant, as with linear interpolation
+    x_target = np.array([100, 500, 2000])
+    np.testing.assert_allclose(hyper.resample(x_fine, y, x_target, 'integrate')[[0, 2]], y[[0, -1]])
+
+
+def test_auto_and_identity(grids):
+    x_fine, x_coarse, _ = grids
+
+    def same(a, b):
+        return (a != b).nnz == 0
+    # finer source grid: integrate, coarser source grid: linear
+    assert same(hyper.resampling_matrix(x_fine, x_coarse), hyper.resampling_matrix(x_fine, x_coarse, 'integrate'))
+    assert same(hyper.resampling_matrix(x_coarse, x_fine), hyper.resampling_matrix(x_coarse, x_fine, 'linear'))
+    for method in resampling.METHODS:
+        np.testing.assert_allclose(hyper.resampling_matrix(x_coarse, x_coarse, method).toarray(),
+                                   np.eye(x_coarse.size), atol=1e-12)
+    np.testing.assert_allclose(hyper.resample([550], [0.3], x_coarse), 0.3)
+    with pytest.raises(ValueError):
+        hyper.resampling_matrix(x_fine, x_coarse, 'cubic')
+
+
+def test_cache(grids):
+    x_fine, x_coarse, _ = grids
+    matrix = hyper.resampling_matrix(x_fine, x_coarse, 'linear')
+    assert hyper.resampling_matrix(list(x_fine), x_coarse.copy(), 'linear') is matrix
+    assert hyper.resampling_matrix(x_fine, x_coarse, 'integrate') is not matrix
+
+
+def test_resample_shapes(grids):
+    x_fine, x_coarse, _ = grids
+    cube = np.random.default_rng(1).random((3, 4, x_fine.size)).astype(np.float32)
+    result = hyper.resample(x_fine, cube, x_coarse)
+    assert result.shape == (3, 4, x_coarse.size) and result.dtype == np.float32
+    np.testing.assert_allclose(result[2, 3], hyper.resample(x_fine, cube[2, 3], x_coarse), rtol=1e-6)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_project_cube(capture, lazy):
+    file_data, calibrated = capture
+    cube = hyper.Cube(file_data, lazy=lazy)
+    x_target = np.linspace(450, 950, 11)
+    projected = hyper.project_cube(cube, x_target, chunk_rows=5)
+    assert projected.nrows == cube.nrows and projected.ncols == cube.ncols
+    np.testing.assert_allclose(projected.bands, x_target)
+    np.testing.assert_allclose(projected.data, hyper.resample(cube.bands, calibrated, x_target), rtol=1e-5)
@@ -0,0 +1,163 @@
+import csv
+import numpy as np
+import pytest
+import matplotlib.image
+import hyperlyse as hyper
+
+
+def reference_statistics(data, labels, percentiles):
+    """
+    statistics of each label with plain numpy
+    """
+    ids = np.unique(labels[labels > 0])
+    pixels = [data[labels == label].astype(np.float64) for label in ids]
+    with np.errstate(invalid='ignore'):
+        return {'labels': ids,
+                'count': np.array([p.shape[0] for p in pixels]),
+                'mean': np.array([p.mean(axis=0) for p in pixels]),
+                'std': np.array([p.std(axis=0) for p in pixels]),
+                'percentiles': {q: np.array([np.percentile(p, q, axis=0) for p in pixels]) for q in percentiles}}
+
+
+def assert_statistics(stats, expected, rtol=1e-5, atol=1e-6):
+    np.testing.assert_array_equal(stats['labels'], expected['labels'])
+    np.testing.assert_array_equal(stats['count'], expected['count'])
+    for key in ['mean', 'std']:
+        np.testing.assert_allclose(stats[key], expected[key], rtol=rtol, atol=atol, err_msg=key)
+    assert sorted(stats['percentiles']) == sorted(expected['percentiles'])
+    for q, values in expected['percentiles'].items():
+        np.testing.assert_allclose(stats['percentiles'][q], values, rtol=rtol, atol=atol, err_msg=str(q))
+
+
+@pytest.fixture
+def labelled_cube():
+    rng = np.random.default_rng(0)
+    data = rng.random((13, 11, 7)).astype(np.float32)
+    # labels with gaps, background 0 and -1, one region of a single pixel
+    labels = rng.choice([-1, 0, 2, 3, 7, 40], size=(13, 11))
+    labels[labels == 40] = 3
+    labels[6, 5] = 40
+    return hyper.Cube.from_array(data, np.linspace(400, 1000, 7)), labels
+
+
+@pytest.mark.parametrize('chunk_rows', [1, 4, 64])
+def test_region_statistics(labelled_cube, chunk_rows):
+    cube, labels = labelled_cube
+    stats = hyper.region_statistics(cube, labels, percentiles=(0, 10, 33.3, 90, 100), chunk_rows=chunk_rows,
+                                    n_jobs=2)
+    expected = reference_statistics(cube.data, labels, [0, 10, 33.3, 50, 90, 100])
+    assert_statistics(stats, expected)
+    assert stats['median'] is stats['percentiles'][50]
+    assert stats['mean'].dtype == np.float32 and stats['mean'].shape == (4, 7)
+
+
+def test_region_statistics_lazy(capture):
+    file_data, calibrated = capture
+    labels = np.zeros((12, 10), dtype=int)
+    labels[2:9, 1:4] = 1
+    labels[5:12, 6:] = 5
+    stats = hyper.region_statistics(hyper.Cube(file_data, lazy=True), labels, chunk_rows=3)
+    assert_statistics(stats, reference_statistics(calibrated, labels, [25, 50, 75]))
+
+
+def test_region_statistics_without_percentiles(labelled_cube):
+    cube, labels = labelled_cube
+    stats = hyper.region_statistics(cube, labels, percentiles=())
+    assert stats['percentiles'] == {} and 'median' not in stats
+    np.testing.assert_allclose(stats['std'], reference_statistics(cube.data, labels, [])['std'], rtol=1e-5)
+
+
+def test_region_statistics_empty_and_errors(labelled_cube):
+    cube, labels = labelled_cube
+    stats = hyper.region_statistics(cube, np.zeros_like(labels))
+    assert stats['labels'].size == 0 and stats['mean'].shape == (0, 7) and stats['percentiles'] == {}
+    with pytest.raises(ValueError):
+        hyper.region_statistics(cube, labels[1:])
+
+
+def test_region_statistics_large_mean():
+    # small deviations on a large mean: no cancellation in the std, no precision loss in the percentiles
+    rng = np.random.default_rng(1)
+    data = (3000 + rng.normal(0, 1e-2, (40, 6, 3))).astype(np.float32)
+    labels = np.repeat([1, 2], 120).reshape(40, 6)
+    stats = hyper.region_statistics(hyper.Cube.from_array(data, [500, 600, 700]), labels, chunk_rows=7)
+    assert_statistics(stats, reference_statistics(data, labels, [25, 50, 75]), rtol=1e-6, atol=1e-4)
+    assert (stats['std'] > 5e-3).all()
+
+
+def test_region_statistics_nan_and_inf():
+    rng = np.random.default_rng(2)
+    data = rng.random((6, 8, 4)).astype(np.float32)
+    labels = np.repeat([1, 2, 3, 4], 12).reshape(6, 8)
+    data[0, 1, 2] = np.nan      # region 1, band 2
+    data[2, 0, 1] = np.inf      # region 2, band 1
+    data[2, 3, 1] = -np.inf     # region 2, band 1
+    data[3, 3, 0] = data[3, 5, 0] = np.inf      # region 3, band 0
+    data[4, 2, 3] = -1e30       # region 3: a huge finite value
+    stats = hyper.region_statistics(hyper.Cube.from_array(data, [500, 600, 700, 800]), labels,
+                                    percentiles=(0, 20, 80, 100), chunk_rows=2)
+    expected = reference_statistics(data, labels, [0, 20, 50, 80, 100])
+    # nan only where a pixel is nan; other regions and bands are not affected
+    has_nan = np.array([np.isnan(data[labels == label]).any(axis=0) for label in range(1, 5)])
+    for q in [0, 20, 50, 80, 100]:
+        np.testing.assert_array_equal(np.isnan(stats['percentiles'][q]), has_nan)
+    assert np.isnan(stats['percentiles'][50][0, 2]) and np.isnan(stats['mean'][0, 2])
+    assert np.isnan(stats['std'][0, 2])
+    assert stats['percentiles'][0][1, 1] == -np.inf and stats['percentiles'][100][1, 1] == np.inf
+    assert stats['percentiles'][100][2, 0] == np.inf and np.isfinite(stats['percentiles'][80][2, 0])
+    np.testing.assert_allclose(stats['percentiles'][0][2, 3], -1e30, rtol=1e-6)
+    finite = np.isfinite(expected['percentiles'][50])
+    for q in [20, 50, 80]:
+        np.testing.assert_allclose(stats['percentiles'][q][finite], expected['percentiles'][q][finite], rtol=1e-5)
+    for key in ['mean', 'std']:
+        finite = np.isfinite(expected[key]) & (np.abs(expected[key]) < 1e20)
+        np.testing.assert_allclose(stats[key][finite], expected[key][finite], rtol=1e-5)
+
+
+def test_save_region_statistics(labelled_cube, tmp_path):
+    cube, labels = labelled_cube
+    stats = hyper.region_statistics(cube, labels, percentiles=(10,))
+    hyper.save_region_statistics(str(tmp_path / 'stats.csv'), stats, cube.bands, names={2: 'red pigment'})
+    with open(tmp_path / 'stats.csv', newline='') as f:
+        rows = list(csv.reader(f))
+    text = '\n'.join(','.join(row) for row in rows)
+    assert 'red pigment' in text and '40' in text
+    assert len(rows) > 4 * 4
+
+
+def test_polygon_mask():
+    # a square of pixel centers 1.5..3.5 in x, 2.5..4.5 in y
+    mask = hyper.polygon_mask((8, 6), [(1, 2), (4, 2), (4, 5), (1, 5)])
+    expected = np.zeros((8, 6), dtype=bool)
+    expected[2:5, 1:4] = True
+    np.testing.assert_array_equal(mask, expected)
+    # a triangle, closed implicitly
+    mask = hyper.polygon_mask((5, 5), [(0, 0), (5.5, 0), (0, 5.5)])
+    rows, cols = np.mgrid[0:5, 0:5]
+    np.testing.assert_array_equal(mask, rows + cols < 5)
+    # clipped at the image borders, empty outside and for lines
+    assert hyper.polygon_mask((4, 4), [(-10, -10), (10, -10), (10, 10), (-10, 10)]).all()
+    assert not hyper.polygon_mask((4, 4), [(5, 5), (9, 5), (9, 9)]).any()
+    assert not hyper.polygon_mask((4, 4), [(0, 0), (3, 3)]).any()
+
+
+def test_load_label_map(tmp_path):
+    labels = np.array([[0, 1, 1], [3, 0, 2]], dtype=np.int16)
+    np.save(tmp_path / 'labels.npy', labels)
+    loaded = hyper.load_label_map(str(tmp_path / 'labels.npy'))
+    assert loaded.dtype == np.int32
+    np.testing.assert_array_equal(loaded, labels)
+    np.save(tmp_path / 'float.npy', labels.astype(np.float32))
+    with pytest.raises(ValueError):
+        hyper.load_label_map(str(tmp_path / 'float.npy'))
+
+    # one region per color, black is the background
+    colors = np.array([[0, 0, 0], [255, 0, 0], [0, 0, 255], [0, 128, 0]], dtype=np.uint8)
+    img = colors[np.array([[0, 1, 1], [3, 0, 2]])]
+    matplotlib.image.imsave(tmp_path / 'labels.png', img)
+    loaded = hyper.load_label_map(str(tmp_path / 'labels.png'))
+    assert loaded.shape == (2, 3)
+    assert (loaded == 0).tolist() == (labels == 0).tolist()
+    # the same colors get the same label, different colors different ones
+    assert loaded[0, 1] == loaded[0, 2] and len(set(loaded[labels > 0].tolist())) == 3
+    assert loaded.min() == 0 and loaded.max() == 3
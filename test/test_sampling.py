@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import hyperlyse as hyper
+from conftest import write_capture
+
+
+@pytest.mark.parametrize('strategy', hyper.PixelSampler.STRATEGIES)
+def test_sample_indices(strategy):
+    sampler = hyper.PixelSampler(strategy, seed=3, tile_size=8)
+    rows, cols = sampler.sample_indices(30, 20, 100)
+    flat = rows * 20 + cols
+    assert np.all(np.diff(flat) > 0)       # unique, in memory order
+    assert rows.min() >= 0 and rows.max() < 30 and cols.min() >= 0 and cols.max() < 20
+    assert 50 <= flat.size <= 200
+    # equal seeds give equal samples
+    rows2, cols2 = hyper.PixelSampler(strategy, seed=3, tile_size=8).sample_indices(30, 20, 100)
+    np.testing.assert_array_equal(rows, rows2)
+    np.testing.assert_array_equal(cols, cols2)
+
+
+def test_sample_array():
+    cube = np.random.default_rng(0).random((15, 11, 6))
+    sampler = hyper.PixelSampler(seed=1, chunk_size=7)
+    sample = sampler.sample(cube, n_samples=40, bands=slice(1, 4))
+    rows, cols = sampler.sample_indices(15, 11, 40)
+    np.testing.assert_array_equal(sample, cube[rows, cols, 1:4])
+
+
+@pytest.mark.parametrize('interleave', ['bsq', 'bil', 'bip'])
+def test_sample_lazy_cube_and_reader(tmp_path, interleave):
+    file_data, calibrated = write_capture(str(tmp_path), interleave=interleave)
+    sampler = hyper.PixelSampler(seed=2, chunk_size=16)
+    rows, cols = sampler.sample_indices(*calibrated.shape[:2], 50)
+    cube = hyper.Cube(file_data, lazy=True)
+    np.testing.assert_allclose(sampler.sample(cube, n_samples=50), calibrated[rows, cols], rtol=1e-5)
+    raw = sampler.sample(cube.reader, n_samples=50, bands=slice(5, 9))
+    eager = hyper.Cube(file_data)
+    np.testing.assert_array_equal(raw, cube.reader.roi((0, cube.nrows), (0, cube.ncols))[rows, cols, 5:9])
+    np.testing.assert_allclose(sampler.sample(eager.data, n_samples=50), sampler.sample(cube, n_samples=50),
+                               rtol=1e-5)
@@ -0,0 +1,104 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import pytest
+import hyperlyse as hyper
+from multiprocessing import shared_memory
+
+
+def row_means(cube, row_start, row_end, scale):
+    return cube.data[row_start:row_end].mean(axis=(1, 2)) * scale, os.getpid()
+
+
+@pytest.mark.parametrize('backend', hyper.SharedCube.BACKENDS)
+@pytest.mark.parametrize('lazy', [False, True])
+def test_lifecycle(capture, tmp_path, backend, lazy):
+    file_data, calibrated = capture
+    cube = hyper.Cube(file_data, lazy=lazy)
+    shared = hyper.SharedCube(cube, backend=backend, directory=str(tmp_path), chunk_rows=5)
+    descriptor = shared.descriptor
+    assert descriptor.shape == (12, 10, 40) and descriptor.backend == backend
+    np.testing.assert_allclose(shared.data, calibrated, rtol=1e-5)
+    if backend == 'file':
+        assert os.path.dirname(descriptor.name) == str(tmp_path)
+
+    attached = descriptor.attach()
+    assert hyper.attach_cube(descriptor) is attached
+    assert not attached.data.flags.writeable
+    np.testing.assert_array_equal(attached.data, shared.data)
+    np.testing.assert_allclose(attached.bands, cube.bands)
+    assert attached.pixel_spectrum(3, 4).shape == (40,)
+    hyper.detach_cube(descriptor)
+    assert attached.data is None
+    hyper.detach_cube(descriptor)
+    assert hyper.attach_cube(descriptor) is not attached
+    hyper.detach_cube(descriptor)
+
+    assert not shared.closed
+    shared.close()
+    assert shared.closed and shared.data is None
+    shared.close()
+    if backend == 'file':
+        assert not os.path.exists(descriptor.name)
+    else:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=descriptor.name)
+
+
+def test_context_and_errors(capture):
+    cube = hyper.Cube(capture[0])
+    with pytest.raises(ValueError):
+        hyper.SharedCube(cube, backend='gpu')
+    with hyper.SharedCube(cube, dtype=np.float64) as shared:
+        assert shared.data.dtype == np.float64
+    assert shared.closed
+    with pytest.raises(ValueError):
+        shared.map_rows(row_means, 1)
+
+
+@pytest.mark.parametrize('backend', hyper.SharedCube.BACKENDS)
+def test_map_rows(capture, backend):
+    file_data, calibrated = capture
+    with hyper.SharedCube(hyper.Cube(file_data), backend=backend) as shared:
+        results = shared.map_rows(row_means, 2, chunk_rows=5, n_jobs=2)
+        assert len(results) == 3
+        means = np.concatenate([r[0] for r in results])
+        np.testing.assert_allclose(means, calibrated.mean(axis=(1, 2)) * 2, rtol=1e-5)
+        assert os.getpid() not in {r[1] for r in results}
+        # the pool is gone, the data is still published
+        np.testing.assert_allclose(shared.map_rows(row_means, 1, chunk_rows=12, n_jobs=1)[0][0],
+                                   calibrated.mean(axis=(1, 2)), rtol=1e-5)
+
+
+_SPAWN_SCRIPT = '''
+import sys
+import multiprocessing
+import numpy as np
+sys.path[:0] = [{src!r}, {test!r}]
+import hyperlyse as hyper
+from test_sharedcube import row_means
+
+if __name__ == '__main__':
+    multiprocessing.set_start_method('spawn')
+    cube = hyper.Cube.from_array(np.ones((6, 4, 3), dtype=np.float32), [500, 600, 700])
+    shared = hyper.SharedCube(cube)
+    hyper.attach_cube(shared.descriptor)
+    print([float(r[0][0]) for r in shared.map_rows(row_means, 3, chunk_rows=2, n_jobs=2)])
+    hyper.detach_cube(shared.descriptor)
+    shared.close()
+'''
+
+
+def test_resource_tracker():
+    """
+    spawned workers share the resource tracker of the publishing process: attaching to the block there (and in the
+    publishing process) neither unlinks it early nor leaves a wrong registration, which would be reported as a leak
+    or as a KeyError when the block is unlinked
+    """
+    this_dir = os.path.dirname(os.path.realpath(__file__))
+    script = _SPAWN_SCRIPT.format(src=os.path.join(os.path.dirname(this_dir), 'src'), test=this_dir)
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == '[3.0, 3.0, 3.0]'
+    assert 'Traceback' not in result.stderr and 'leaked' not in result.stderr, result.stderr
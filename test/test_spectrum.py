@@ -0,0 +1,121 @@
+import os
+import numpy as np
+import pytest
+import hyperlyse as hyper
+from hyperlyse.database import SpectrumStore
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+@pytest.fixture
+def spectrum():
+    x = np.linspace(397.32, 1003.58, 204)
+    y = np.abs(np.sin(x / 50)) + 0.1
+    metadata = hyper.Metadata('sample 1', description='red area', source_object='bull', source_file='capture.raw',
+                              source_coordinates='(3,4)', device_info='test device', intensity='bright')
+    return hyper.Spectrum(x, y, metadata)
+
+
+def test_jcamp_round_trip(tmp_path, spectrum):
+    file = str(tmp_path / 'spectrum.jdx')
+    spectrum.save_jcamp(file)
+    loaded = hyper.Spectrum.load(file)
+    np.testing.assert_allclose(loaded.x, spectrum.x, rtol=1e-6)
+    np.testing.assert_allclose(loaded.y, spectrum.y, rtol=1e-6)
+    for field in hyper.Metadata.__slots__:
+        assert getattr(loaded.metadata, field) == getattr(spectrum.metadata, field)
+
+
+def test_dpt_round_trip(tmp_path, spectrum):
+    file = str(tmp_path / 'spectrum.dpt')
+    spectrum.save_dpt(file)
+    loaded = hyper.Spectrum.load(file)
+    np.testing.assert_allclose(loaded.x, spectrum.x, atol=1e-4)
+    np.testing.assert_allclose(loaded.y, spectrum.y, atol=1e-4)
+    assert loaded.metadata.id == 'spectrum'
+
+
+def test_jcamp_several_values_per_line(tmp_path):
+    file = tmp_path / 'other.jdx'
+    file.write_text('##TITLE= other software\n'
+                    '##JCAMP-DX= 4.24\n'
+                    '##XFACTOR= 1.0\n'
+                    '##YFACTOR= 0.001\n'
+                    '##FIRSTX= 400\n'
+                    '##LASTX= 414\n'
+                    '##DELTAX= 2\n'
+                    '##XYDATA= (X++(Y..Y))\n'
+                    '400 100 200 300 400\n'
+                    '408 500,600;700 800 $$ comment\n'
+                    '##END=\n')
+    loaded = hyper.Spectrum.load(str(file))
+    np.testing.assert_allclose(loaded.x, np.arange(400, 416, 2))
+    np.testing.assert_allclose(loaded.y, np.arange(1, 9) / 10)
+    assert loaded.metadata.id == 'other software'
+
+
+def test_jcamp_xy_pairs(tmp_path):
+    file = tmp_path / 'pairs.jdx'
+    file.write_text('##TITLE= pairs\n##XYPOINTS= (XY..XY)\n500, 0.5; 510, 0.6\n520, 0.7\n##END=\n')
+    loaded = hyper.Spectrum.load(str(file))
+    np.testing.assert_allclose(loaded.x, [500, 510, 520])
+    np.testing.assert_allclose(loaded.y, [0.5, 0.6, 0.7])
+
+
+def test_invalid_files(tmp_path):
+    compressed = tmp_path / 'compressed.jdx'
+    compressed.write_text('##TITLE= asdf\n##DELTAX= 1\n##XYDATA= (X++(Y..Y))\n400@JKL\n##END=\n')
+    with pytest.raises(ValueError):
+        hyper.Spectrum.load(str(compressed))
+    empty = tmp_path / 'empty.dpt'
+    empty.write_text('wavelength,reflectance\n')
+    with pytest.raises(ValueError):
+        hyper.Spectrum.load(str(empty))
+    with pytest.raises(ValueError):
+        hyper.Spectrum.load(str(tmp_path / 'spectrum.txt'))
+
+
+def test_files_of_the_repository():
+    jcamp = hyper.Spectrum.load(os.path.join(this_dir, 'bull_bottomrightpixel_hyperlyse_newx.jdx'))
+    dpt = hyper.Spectrum.load(os.path.join(this_dir, 'bull_bottomrightpixel_hyperlyse_newx.dpt'))
+    np.testing.assert_allclose(jcamp.x, dpt.x, atol=1e-4)
+    np.testing.assert_allclose(jcamp.y, dpt.y, atol=1e-4)
+
+
+def test_store(spectrum):
+    store = SpectrumStore()
+    short = hyper.Spectrum(spectrum.x[:50], spectrum.y[:50] * 2, hyper.Metadata('short'))
+    for s in [spectrum, short, spectrum]:
+        store.append(s)
+    assert len(store) == 3
+    assert len(store.grids) == 2
+    # no loss of precision
+    assert store[0].y.dtype == np.float64
+    np.testing.assert_array_equal(store[0].y, spectrum.y)
+    np.testing.assert_array_equal(store[1].x, short.x)
+    assert store[-1].metadata.id == 'sample 1'
+    assert np.isnan(store.y_matrix()[1, 50:]).all()
+    del store[0]
+    assert [s.metadata.id for s in store] == ['short', 'sample 1']
+    store[0] = spectrum
+    np.testing.assert_array_equal(store.y_matrix()[0], spectrum.y)
+    assert list(store.column('id')) == ['sample 1', 'sample 1']
+    with pytest.raises(IndexError):
+        store[2]
+
+
+def test_store_views_are_read_only(spectrum):
+    store = SpectrumStore()
+    store.append(spectrum)
+    view = store[0]
+    with pytest.raises(ValueError):
+        view.y[0] = 5
+    with pytest.raises(ValueError):
+        view.x *= 2
+    np.testing.assert_array_equal(store[0].y, spectrum.y)
+    np.testing.assert_array_equal(store.grids[0], spectrum.x)
+    # copies can be changed, the store changes by item assignment only
+    y = view.y.copy()
+    y[0] = 5
+    store[0] = hyper.Spectrum(view.x, y, view.metadata)
+    assert store[0].y[0] == 5
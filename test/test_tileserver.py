@@ -0,0 +1,134 @@
+import io
+import json
+import urllib.error
+import urllib.request
+import numpy as np
+import pytest
+import matplotlib.image
+import hyperlyse as hyper
+from conftest import write_capture
+
+
+@pytest.fixture(scope='module')
+def capture(tmp_path_factory):
+    return write_capture(str(tmp_path_factory.mktemp('capture')))
+
+
+@pytest.fixture(scope='module', params=[False, True], ids=['loaded', 'lazy'])
+def server(request, capture, tmp_path_factory):
+    file_data, calibrated = capture
+    database_dir = tmp_path_factory.mktemp('db')
+    hyper.Spectrum(np.linspace(400, 1000, 40), calibrated[3, 4], hyper.Metadata('pixel 3,4')).save_jcamp(
+        str(database_dir / 'pixel.jdx'))
+    cube = hyper.Cube(file_data, lazy=request.param)
+    renderer = hyper.TileRenderer(cube, hyper.Database(str(database_dir)), tile_size=4, cache_size=64)
+    server = hyper.TileServer(renderer, port=0, n_jobs=2)
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get(server, path):
+    """
+    :return: (status, content type, body)
+    """
+    try:
+        with urllib.request.urlopen(server.url + path, timeout=30) as response:
+            return response.status, response.headers['Content-Type'], response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers['Content-Type'], e.read()
+
+
+def get_image(server, path):
+    status, content_type, body = get(server, path)
+    assert (status, content_type) == (200, 'image/png'), body
+    return matplotlib.image.imread(io.BytesIO(body), format='png')
+
+
+def test_info_and_spectrum(server, capture):
+    _, calibrated = capture
+    status, content_type, body = get(server, 'info')
+    assert (status, content_type) == (200, 'application/json')
+    info = json.loads(body)
+    assert (info['rows'], info['cols']) == (12, 10)
+    assert len(info['bands']) == 40
+    # 12x10, 6x5, 3x2 pixels
+    assert [(level['shape'], level['tiles']) for level in info['levels']] == [([12, 10], [3, 3]),
+                                                                                ([6, 5], [2, 2]),
+                                                                                ([3, 2], [1, 1])]
+    assert info['views'] == hyper.TileRenderer.VIEWS
+    assert info['db_spectra'] == ['pixel 3,4']
+    spectrum = json.loads(get(server, 'spectrum?row=11&col=9')[2])
+    np.testing.assert_allclose(spectrum['y'], calibrated[11, 9], rtol=1e-5)
+    assert get(server, '')[:2] == (200, 'text/html; charset=utf-8')
+
+
+@pytest.mark.parametrize('view, query', [('rgb', ''),
+                                         ('band', 'band=7'),
+                                         ('band', 'wavelength=700&brightness=50'),
+                                         ('similarity', 'ref=db:0&metric=sam'),
+                                         ('similarity', 'ref=pixel:3,4&gradient=1&threshold=50'),
+                                         ('pca', 'component=1&xmin=450&xmax=900')])
+def test_tiles(server, view, query):
+    info = json.loads(get(server, 'info')[2])
+    for level in info['levels']:
+        (rows, cols), (n_rows, n_cols) = level['shape'], level['tiles']
+        shapes = []
+        for tile_row in range(n_rows):
+            for tile_col in range(n_cols):
+                img = get_image(server, f"tiles/{view}/{level['level']}/{tile_row}/{tile_col}.png?{query}")
+                shapes.append(img.shape[:2])
+        # the tiles cover the level
+        assert sum(shape[1] for shape in shapes[:n_cols]) == cols
+        assert sum(shape[0] for shape in shapes[::n_cols]) == rows
+
+
+def test_band_tile_values(server, capture):
+    _, calibrated = capture
+    img = get_image(server, 'tiles/band/1/0/1.png?band=5')
+    expected = np.uint8(np.clip(calibrated[0:8:2, 8:10:2, 5], 0, 1) * 255)
+    np.testing.assert_allclose(img[:, :, 0] * 255, expected, atol=1)
+
+
+def test_similarity_to_itself(server):
+    img = get_image(server, 'tiles/similarity/0/0/1.png?ref=pixel:3,4&metric=sam')
+    assert img.shape[:2] == (4, 4)
+    # a database spectrum equal to the pixel gives the same map
+    same = get_image(server, 'tiles/similarity/0/0/1.png?ref=db:0&metric=sam')
+    np.testing.assert_allclose(img, same, atol=1 / 255)
+
+
+@pytest.mark.parametrize('path, status', [('tiles/nir/0/0/0.png', 400),
+                                          ('tiles/band/0/0/0.png?band=40', 400),
+                                          ('tiles/band/0/0/0.png?band=x', 400),
+                                          ('tiles/similarity/0/0/0.png?ref=db:5', 400),
+                                          ('tiles/similarity/0/0/0.png?ref=pixel:3', 400),
+                                          ('tiles/similarity/0/0/0.png?ref=db:0&metric=l1', 400),
+                                          ('tiles/pca/0/0/0.png?component=10', 400),
+                                          ('spectrum?row=1', 400),
+                                          ('spectrum?row=12&col=0', 404),
+                                          ('tiles/rgb/3/0/0.png', 404),
+                                          ('tiles/rgb/0/3/0.png', 404),
+                                          ('tiles/rgb/1/0/2.png', 404),
+                                          ('tiles/rgb/0/0.png', 404),
+                                          ('other', 404)])
+def test_errors(server, path, status):
+    response_status, content_type, body = get(server, path)
+    assert (response_status, content_type) == (status, 'application/json')
+    assert json.loads(body)['error']
+
+
+def test_tile_cache(server):
+    renderer = server.renderer
+    png = renderer.tile('band', 0, 1, 1, {'band': '3', 'unused': 'x'})
+    # equal parameters share the cache entry, others do not
+    assert renderer.tile('band', 0, 1, 1, {'band': '3'}) is png
+    assert renderer.tile('band', 0, 1, 1, {'wavelength': str(renderer.cube.bands[3])}) is png
+    assert renderer.tile('band', 0, 1, 1, {'band': '3', 'brightness': '50'}) is not png
+    assert get(server, 'tiles/band/0/1/1.png?band=3')[2] == png
+    # least recently used tiles are dropped
+    for band in range(40):
+        for tile_col in range(3):
+            renderer.tile('band', 0, 0, tile_col, {'band': str(band)})
+    assert renderer.tile('band', 0, 1, 1, {'band': '3'}) is not png
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import hyperlyse as hyper
+
+
+@pytest.fixture
+def mixture():
+    rng = np.random.default_rng(0)
+    endmembers = rng.random((3, 30)) + 0.1
+    abundances = rng.dirichlet(np.ones(3), (6, 7))
+    return endmembers, abundances, abundances @ endmembers
+
+
+@pytest.mark.parametrize('sum_to_one', [False, True])
+def test_recovers_abundances(mixture, sum_to_one):
+    endmembers, abundances, cube = mixture
+    result, residuals = hyper.linear_unmixing(cube, endmembers, sum_to_one=sum_to_one, chunk_rows=4, max_iter=5000,
+                                              tol=1e-9)
+    assert result.shape == abundances.shape
+    np.testing.assert_allclose(result, abundances, atol=1e-3)
+    assert residuals.max() < 1e-3
+
+
+def test_fully_constrained(mixture):
+    endmembers, abundances, cube = mixture
+    rng = np.random.default_rng(1)
+    noisy = cube * rng.uniform(0.5, 1.5, cube.shape[:2])[:, :, np.newaxis] + rng.normal(0, 0.05, cube.shape)
+    result, _ = hyper.linear_unmixing(noisy, endmembers, sum_to_one=True)
+    assert result.min() >= 0
+    np.testing.assert_allclose(result.sum(axis=-1), 1, atol=1e-5)
+
+
+def test_non_negative(mixture):
+    endmembers, abundances, cube = mixture
+    # pixels that would need negative abundances
+    cube = cube - 0.8 * endmembers[0]
+    result, _ = hyper.linear_unmixing(cube, endmembers)
+    assert result.min() >= 0
+
+
+def test_band_mismatch(mixture):
+    endmembers, abundances, cube = mixture
+    with pytest.raises(ValueError):
+        hyper.linear_unmixing(cube, endmembers[:, :-1])